@@ -0,0 +1,125 @@
+"""
+A benchmark for the memory footprint of the master's metadata. For each size, a
+global state holding that many chunks, spread over files of 16 chunks each, is
+built in a fresh process from a synthetic snapshot view, and the growth in the
+process's resident memory is reported in total and per chunk. Results are written
+as JSON.
+
+Run from the repository root, for example:
+
+    python -m benchmarks.memory --chunks 1000000 10000000 50000000
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import argparse
+import gc
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks.recovery import synthetic_view
+from src.globalstate import GlobalState
+
+
+DEFAULT_CHUNKS = [10 ** 6, 10 ** 7, 5 * 10 ** 7]
+
+
+def resident_bytes():
+    """
+    Get the resident memory of this process
+
+    :rtype : int
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # ru_maxrss is the peak, in kilobytes on Linux and bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(chunks, chunks_per_file, hosts):
+    """
+    Build a global state in this process and measure the memory it takes
+
+    :rtype : dict
+    """
+    gc.collect()
+    before = resident_bytes()
+    start = time.time()
+    gs = GlobalState.from_checkpoint(synthetic_view(chunks, chunks_per_file, hosts))
+    seconds = time.time() - start
+    gc.collect()
+    used = resident_bytes() - before
+
+    return {
+        'chunks': len(gs.chunk_map),
+        'files': len(gs.file_map),
+        'bytes': used,
+        'bytes_per_chunk': float(used) / chunks,
+        'build_seconds': seconds,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--chunks', type=int, nargs='+', default=DEFAULT_CHUNKS, help='numbers of chunks to hold')
+    parser.add_argument('--chunks-per-file', type=int, default=16)
+    parser.add_argument('--hosts', type=int, default=100, help='chunkservers holding the chunks')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print json.dumps(measure(args.chunks[0], args.chunks_per_file, args.hosts))
+        return
+
+    results = []
+    for chunks in args.chunks:
+        # Each size is measured in a fresh process, so memory freed by one does not hide the growth of the next
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.memory', '--child',
+                                          '--chunks', str(chunks), '--chunks-per-file', str(args.chunks_per_file),
+                                          '--hosts', str(args.hosts)])
+        result = json.loads(output.splitlines()[-1])
+        results.append(result)
+        sys.stderr.write("{chunks:>10} chunks {mb:10.1f} MB {bytes_per_chunk:8.1f} B/chunk\n".format(
+            mb=result['bytes'] / 2.0 ** 20, **result))
+
+    report = json.dumps({'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
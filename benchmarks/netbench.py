@@ -0,0 +1,257 @@
+"""
+A loopback benchmark for the net module. Echo and chunk servers built on the
+MasterServer and ChunkServer base classes are started in-process, and client
+threads drive requests at them over persistent connections. For every payload
+size and concurrency level the benchmark reports throughput along with the
+p50, p99 and p999 request latencies, and writes all results as JSON.
+
+Run from the repository root, for example:
+
+    python -m benchmarks.netbench --engine eventloop --output bench.json
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from src import config
+from src.message import Message
+from src.net import MasterServer, ChunkServer, Connection, FileRegion, get_engine
+
+
+DEFAULT_SIZES = [16, 256, 4096, 65536, 2 ** 20, 4 * 2 ** 20]
+DEFAULT_CONCURRENCY = [1, 8, 64]
+
+
+class EchoServer(MasterServer):
+    """
+    Replies to every request with its own arguments
+    """
+
+    def __init__(self):
+        super(EchoServer, self).__init__()
+        self._port = 0
+
+    def process(self, sysmsg, args):
+        return [Message().SUCCESS] + args
+
+
+class ChunkBenchServer(ChunkServer):
+    """
+    Serves APPEND and READ requests against chunk files in a scratch directory,
+    the same way the Chunkserver does
+    """
+
+    def __init__(self, chunkstore):
+        super(ChunkBenchServer, self).__init__()
+        self.port = 0
+        self.chunkstore = chunkstore
+        self._lock = threading.Lock()
+
+    def path(self, chunk_handle):
+        return os.path.join(self.chunkstore, chunk_handle)
+
+    def process(self, sysmsg, args):
+        m = Message()
+        if sysmsg == m.APPEND:
+            chunk_handle, data = args
+            with self._lock:
+                with open(self.path(chunk_handle), 'ab') as f:
+                    f.write(data)
+            return [m.SUCCESS]
+
+        elif sysmsg == m.READ:
+            chunk_handle, offset, size = args
+            return [m.SUCCESS, FileRegion(open(self.path(chunk_handle), 'rb'), int(offset), int(size))]
+
+        return [m.FAILURE]
+
+
+def start(server):
+    """
+    Bind a server to an ephemeral loopback port and serve it from a daemon thread
+
+    :rtype : tuple
+    :param server:
+    :return: the address the server is listening on
+    """
+    server.initialize_socket()
+    server.engine = get_engine(server)
+    t = threading.Thread(target=server.engine.serve_forever)
+    t.daemon = True
+    t.start()
+    return server.sock.getsockname()
+
+
+def percentile(ordered, fraction):
+    """
+    Get a percentile of an ordered list of samples by the nearest rank
+
+    :rtype : float
+    :param ordered:
+    :param fraction:
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_case(address, request, concurrency, duration, compression):
+    """
+    Drive one request from a number of client threads, each over its own connection,
+    for a fixed duration
+
+    :rtype : dict
+    :param address:
+    :param request: The message code and arguments to send
+    :param concurrency: The number of client threads
+    :param duration: The number of seconds to run for
+    :param compression: Whether the connections negotiate compression
+    """
+    latencies = [[] for _ in range(concurrency)]
+    errors = []
+    start_event = threading.Event()
+    deadline = []
+
+    def client(samples):
+        try:
+            conn = Connection(*address)
+            if compression:
+                conn.negotiate()
+            start_event.wait()
+            while time.time() < deadline[0]:
+                began = time.time()
+                if conn.call(*request)[0] != Message().SUCCESS:
+                    raise RuntimeError("Request failed")
+                samples.append(time.time() - began)
+            conn.close()
+        except Exception as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=client, args=(samples,)) for samples in latencies]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    # Give every client a moment to connect before the clock starts
+    time.sleep(0.1)
+    deadline.append(time.time() + duration)
+    began = time.time()
+    start_event.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - began
+
+    samples = sorted(sample for client_samples in latencies for sample in client_samples)
+    return {
+        'ops': len(samples),
+        'seconds': elapsed,
+        'ops_per_sec': len(samples) / elapsed,
+        'latency_us': {
+            'p50': percentile(samples, 0.50) * 1e6,
+            'p99': percentile(samples, 0.99) * 1e6,
+            'p999': percentile(samples, 0.999) * 1e6,
+        },
+        'errors': len(errors),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--engine', default=config.server_engine, choices=['threaded', 'eventloop'])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='payload sizes in bytes')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY,
+                        help='numbers of concurrent client connections')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds to run each case for')
+    parser.add_argument('--workloads', nargs='+', default=['echo', 'append', 'read'],
+                        choices=['echo', 'append', 'read'])
+    parser.add_argument('--compression', action='store_true', help='negotiate compression on every connection')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    config.server_engine = args.engine
+
+    m = Message()
+    chunkstore = tempfile.mkdtemp()
+    try:
+        echo_address = start(EchoServer())
+        chunk_address = start(ChunkBenchServer(chunkstore))
+
+        with open(os.path.join(chunkstore, 'read'), 'wb') as f:
+            f.write(os.urandom(max(args.sizes)))
+
+        results = []
+        for workload in args.workloads:
+            for size in args.sizes:
+                payload = os.urandom(size)
+                if workload == 'echo':
+                    address, request = echo_address, (m.APPEND, payload)
+                elif workload == 'append':
+                    address, request = chunk_address, (m.APPEND, 'append', payload)
+                else:
+                    address, request = chunk_address, (m.READ, 'read', '0', str(size))
+
+                for concurrency in args.concurrency:
+                    result = run_case(address, request, concurrency, args.duration, args.compression)
+                    result.update({
+                        'workload': workload,
+                        'size': size,
+                        'concurrency': concurrency,
+                        'mb_per_sec': result['ops_per_sec'] * size / 2.0 ** 20,
+                    })
+                    results.append(result)
+                    sys.stderr.write("{workload:>6} {size:>8} B x{concurrency:<4} {ops_per_sec:10.0f} ops/s "
+                                     "p50 {p50:8.0f} us p99 {p99:8.0f} us\n".format(
+                                         p50=result['latency_us']['p50'], p99=result['latency_us']['p99'],
+                                         **result))
+
+                # Keep the append chunk from growing without bound between cases
+                open(os.path.join(chunkstore, 'append'), 'wb').close()
+    finally:
+        shutil.rmtree(chunkstore)
+
+    report = json.dumps({
+        'engine': args.engine,
+        'compression': args.compression,
+        'duration': args.duration,
+        'results': results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+A benchmark for master recovery. A synthetic namespace is written as a snapshot,
+followed by an operation log tail, and a Master is restored from them the way it is
+on restart. The benchmark reports the time to write the snapshot and the time to
+serving, split in to loading the snapshot and replaying the log, and writes all
+results as JSON.
+
+The target is for a master holding 10 million chunks to be serving within
+60 seconds of starting. Run from the repository root, for example:
+
+    python -m benchmarks.recovery --chunks 10000000 --output recovery.json
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from src import config
+from src import oplog
+from src import snapshot
+from src.master import Master
+from src.oplog import OperationLog
+
+
+TARGET_SECONDS = 60
+
+
+class Generated(object):
+    """
+    A sized sequence whose items are generated as it is iterated, so that a namespace
+    far larger than the benchmark could hold twice is written without building it first
+    """
+
+    def __init__(self, length, item):
+        self.length = length
+        self.item = item
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self.item(i)
+
+
+def synthetic_view(chunks, chunks_per_file, hosts):
+    """
+    Build a view of a namespace in the form returned by GlobalState.checkpoint_view
+
+    :rtype : dict
+    :param chunks: The number of chunks in the namespace
+    :param chunks_per_file: The number of chunks in each file
+    :param hosts: The number of chunkservers the chunks are spread over
+    """
+    host_names = ["10.0.{}.{}".format(i // 256, i % 256) for i in range(hosts)]
+    files = (chunks + chunks_per_file - 1) // chunks_per_file
+
+    def file_item(i):
+        return "/bench/file{}".format(i), range(i * chunks_per_file + 1, min(chunks, (i + 1) * chunks_per_file) + 1)
+
+    def chunk_item(i):
+        return i + 1, config.chunk_size, [host_names[(i + r) % hosts] for r in range(config.replica_amount)]
+
+    return {
+        'chunk_handle': chunks,
+        'files': Generated(files, file_item),
+        'chunks': Generated(chunks, chunk_item),
+        'to_delete': [],
+    }
+
+
+def write_oplog(path, records, first_handle):
+    """
+    Write an operation log tail of ADD_CHUNK and UPDATE_OFFSET records after the snapshot
+
+    :rtype : None
+    """
+    log = OperationLog(path)
+    log.append(oplog.ADD_FILE, ["/bench/tail"])
+    for i in xrange(records - 1):
+        handle = str(first_handle + i // 2 + 1)
+        if i % 2:
+            log.append(oplog.UPDATE_OFFSET, [handle, "1"])
+        else:
+            log.append(oplog.ADD_CHUNK, ["/bench/tail", handle, "10.0.0.1", "10.0.0.2", "10.0.0.3"])
+    log.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--chunks', type=int, default=10 ** 7, help='chunks in the snapshot')
+    parser.add_argument('--chunks-per-file', type=int, default=16)
+    parser.add_argument('--hosts', type=int, default=100, help='chunkservers holding the chunks')
+    parser.add_argument('--oplog-records', type=int, default=10 ** 5, help='records in the oplog tail')
+    parser.add_argument('--target', type=float, default=TARGET_SECONDS, help='time to serving target in seconds')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp()
+    saved = config.metasnapshot, config.oplog
+    config.metasnapshot = os.path.join(tmp, "meta.snapshot")
+    config.oplog = os.path.join(tmp, "OPLOG.log")
+    try:
+        path = config.metasnapshot + ".00000000T000000000000"
+        start = time.time()
+        with open(path, 'wb') as f:
+            snapshot.dump(f, 0, synthetic_view(args.chunks, args.chunks_per_file, args.hosts))
+            f.flush()
+            os.fsync(f.fileno())
+        write_seconds = time.time() - start
+        snapshot_bytes = os.path.getsize(path)
+        sys.stderr.write("snapshot of {} chunks written in {:.2f}s\n".format(args.chunks, write_seconds))
+
+        write_oplog(config.oplog, args.oplog_records, args.chunks)
+
+        start = time.time()
+        master = Master(run=True)
+        recovery = master.restore_state()
+        serving = time.time()
+        master.oplog.close()
+
+        if len(master.gs.chunk_map) != args.chunks + args.oplog_records // 2:
+            raise RuntimeError("Recovered {} chunks.".format(len(master.gs.chunk_map)))
+    finally:
+        config.metasnapshot, config.oplog = saved
+        shutil.rmtree(tmp)
+
+    result = {
+        'chunks': args.chunks,
+        'files': (args.chunks + args.chunks_per_file - 1) // args.chunks_per_file,
+        'snapshot_bytes': snapshot_bytes,
+        'snapshot_write_seconds': write_seconds,
+        'snapshot_load_seconds': recovery['snapshot_seconds'],
+        'oplog_records': recovery['replayed'],
+        'oplog_replay_seconds': recovery['replay_seconds'],
+        'time_to_serving_seconds': serving - start,
+        'target_seconds': args.target,
+        'met_target': serving - start <= args.target,
+    }
+    sys.stderr.write("serving after {time_to_serving_seconds:.2f}s (snapshot {snapshot_load_seconds:.2f}s, "
+                     "oplog {oplog_replay_seconds:.2f}s), target {target_seconds:.0f}s\n".format(**result))
+
+    report = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -49,18 +49,54 @@ from threading import Lock
 import config
 
 
+# The master holds millions of chunks, so rather than each holding a lock of its own,
+# chunks share a pool of locks keyed by chunk handle
+_locks = [Lock() for _ in range(config.lock_stripes)]
+
+
 class Chunk(object):
     """
-    Contains the metadata associated with a chunk.
+    Contains the metadata associated with a chunk. A chunk is shared by the files which
+    hold its handle, as after a snapshot; references counts them. The count is not
+    persisted, as it is rebuilt from the files when the global state is loaded.
     """
-    def __init__(self, chunk_handle, chunkserver_locations=None):
+    __slots__ = ('chunk_handle', 'chunkserver_locations', '_offset', 'references')
+
+    def __init__(self, chunk_handle, chunkserver_locations=None, offset=0):
         if not chunkserver_locations:
             chunkserver_locations = []
 
         self.chunk_handle = chunk_handle
         self.chunkserver_locations = chunkserver_locations
-        self._offset = 0
-        self.lock = Lock()
+        self._offset = offset
+        self.references = 0
+
+    def __getstate__(self):
+        return self.chunk_handle, self.chunkserver_locations, self._offset
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before chunks had slots
+            state = state['chunk_handle'], state['chunkserver_locations'], state['_offset']
+        self.chunk_handle, self.chunkserver_locations, self._offset = state
+        self.references = 0
+
+    @property
+    def lock(self):
+        """
+        The lock from the shared pool which guards this chunk
+
+        :rtype : Lock
+        """
+        return _locks[hash(self.chunk_handle) % len(_locks)]
+
+    def offset(self):
+        """
+        Get the offset within the chunk at which the next append begins
+
+        :rtype : int
+        """
+        return self._offset
 
     def check_remaining_size(self, size_to_append):
         """
@@ -71,6 +107,49 @@ class Chunk(object):
         """
         return (self._offset + size_to_append) <= config.chunk_size
 
+    def reserve(self, size):
+        """
+        Reserve space for an append. Checking that the append fits and moving the offset
+        past it happen in a single step under the chunk's lock, so concurrent appends can
+        neither overlap nor overflow the chunk.
+
+        :rtype : int
+        :param size: The size of the append
+        :return: the offset the append begins at, or None if it does not fit
+        """
+        with self.lock:
+            offset = self._offset
+            if offset + size > config.chunk_size:
+                return None
+            self._offset = offset + size
+            return offset
+
+    def pad(self):
+        """
+        Close the chunk to further appends by moving its offset to the end of the chunk
+
+        :rtype : int
+        :return: the size of the padding
+        """
+        with self.lock:
+            padding = config.chunk_size - self._offset
+            self._offset = config.chunk_size
+            return max(padding, 0)
+
+    def extend(self, length):
+        """
+        Move the offset of the chunk forward to a length reported by its primary. The
+        offset never moves back.
+
+        :rtype : int
+        :param length: The length of the chunk
+        :return: the number of bytes the offset moved forward by
+        """
+        with self.lock:
+            size = max(length - self._offset, 0)
+            self._offset += size
+            return size
+
     def update_offset(self, size):
         """
         Updates the offset of the chunk. This method contains locking to prevent asynchronous overwrites
@@ -79,4 +158,26 @@ class Chunk(object):
         :param size: The size to update the offset by
         """
         with self.lock:
-            self._offset += size
\ No newline at end of file
+            self._offset += size
+
+    def reference(self):
+        """
+        Count another file which holds the chunk
+
+        :rtype : int
+        :return: the number of files which hold the chunk
+        """
+        with self.lock:
+            self.references += 1
+            return self.references
+
+    def dereference(self):
+        """
+        Stop counting a file which held the chunk
+
+        :rtype : int
+        :return: the number of files which still hold the chunk
+        """
+        with self.lock:
+            self.references -= 1
+            return self.references
\ No newline at end of file
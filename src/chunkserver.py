@@ -29,12 +29,16 @@ THE SOFTWARE.
 ###############################################################################
 """
 import os
+import shutil
 import threading
+import time
 import logging
 
 import config
 from heartbeat import HeartbeatClient
-from net import ChunkServer
+from net import ChunkServer, FileRegion, Connection
+from client import ConnectionPool
+from locks import StripedLocks
 from message import Message
 
 
@@ -49,16 +53,26 @@ class Chunkserver(ChunkServer):
     to the master on request.
     """
 
-    def __init__(self):
+    def __init__(self, run=False):
+        """
+        Constructor
+
+        :param run: Flag for debug, defaults to False. If True, skips initialization and server starting
+        """
         super(Chunkserver, self).__init__()
-        self.check_chunkstore()
-        self.heartbeat = HeartbeatClient()
         self._m = Message()
         self.chunk_set = set()
-        self._rLock = threading.Lock()
-        self._wLock = threading.Lock()
-        self.start_heartbeat()
-        self.run()
+        self.leases = {}
+        self.lapsed = set()
+        self._lease_lock = threading.Lock()
+        self._chunk_locks = StripedLocks()
+        self.pool = ConnectionPool()
+        if not run:
+            self.check_chunkstore()
+            self.heartbeat = HeartbeatClient()
+            self.start_heartbeat()
+            self.start_lease_renewer()
+            self.run()
 
     @staticmethod
     def check_chunkstore():
@@ -90,10 +104,21 @@ class Chunkserver(ChunkServer):
 
         log.info("Chunkserver heartbeat started.")
 
+    def start_lease_renewer(self):
+        """
+        Start a background thread which renews the chunkserver's leases with the master
+
+        :rtype : None
+        """
+        t = threading.Thread(target=self.renew_leases_forever)
+        t.daemon = True
+        t.start()
+        self.threads.add(t)
+
     def run(self):
         """
-        Run the server. Initializes a socket and listens over it. Each incoming request is passed
-        to a handler thread.
+        Run the server. Initializes a socket and listens over it. Incoming connections are served
+        by the engine chosen in the configuration file.
 
         :rtype : object
         """
@@ -101,92 +126,117 @@ class Chunkserver(ChunkServer):
 
         self.initialize_socket()
 
-        while True:
-            sock, addr = self.sock.accept()
-
-            t = threading.Thread(target=self.handle, args=(sock, addr))
-            t.daemon = True
-            t.start()
-            self.threads.add(t)
-
-        self.sock.close()
-        for t in self.threads:
-            t.join()
+        self.serve_forever()
 
     def handle(self, sock, address):
         """
-        Method to handle incoming requests to the chunkserver
+        Method to handle incoming connections to the chunkserver. Requests are served over
+        the connection until the client closes it.
 
         :rtype : object
         :param sock: 
         :param address: 
         """
         log.info("Handling request for thread " + threading.current_thread().name)
-        sysmsg = self.recv(sock)
+        self.serve_session(sock, address)
+
+    def process(self, sysmsg, args):
+        """
+        Process a single request to the chunkserver
 
+        :rtype : list
+        :param sysmsg: The message code of the request
+        :param args: The arguments of the request
+        :return: the list of reply arguments
+        """
         # Request to create a new chunk
         if sysmsg == self._m.CREATE:
-            chunk_handle = self.recv(sock)
+            chunk_handle = args[0]
             log.info('creating chunk {}'.format(chunk_handle))
             if not self.create_chunk(chunk_handle):
-                self.send(sock, self._m.FAILURE)
-            self.send(sock, self._m.SUCCESS)
+                return [self._m.FAILURE]
+            return [self._m.SUCCESS]
 
-        # Request to append data to an existing chunk
+        # Request to append data to a chunk this chunkserver is the primary of. The append
+        # is ordered and forwarded to the other replicas; without a lease it is refused.
         elif sysmsg == self._m.APPEND:
-            chunk_handle = self.recv(sock)
-            data = self.recv(sock)
-
-            if not self.append_chunk(chunk_handle, data):
-                self.send(sock, self._m.FAILURE)
-            self.send(sock, self._m.SUCCESS)
+            chunk_handle, data = args
+            return self.record_append(chunk_handle, data)
 
         # Request to permanently delete a chunk from the system
         elif sysmsg == self._m.DELETE:
-            chunk_handle = self.recv(sock)
+            chunk_handle = args[0]
 
             if not self.delete_chunk(chunk_handle):
-                self.send(sock, self._m.FAILURE)
-            self.send(sock, self._m.SUCCESS)
+                return [self._m.FAILURE]
+            return [self._m.SUCCESS]
 
         # Request to read from a chunk
         elif sysmsg == self._m.READ:
-            chunk_handle = self.recv(sock)
-            offset = self.recv(sock)
-            size = self.recv(sock)
-            data = self.read_chunk(chunk_handle, offset, size)
+            chunk_handle, offset, size = args
+            region = self.read_chunk(chunk_handle, int(offset), int(size))
 
-            if not data:
-                self.send(sock, self._m.FAILURE)
-            self.send(sock, data)
+            if region is None:
+                return [self._m.FAILURE]
+            return [self._m.SUCCESS, region]
 
-        # Request to write to a chunk
+        # Request to write to a chunk at an offset chosen by its primary
         elif sysmsg == self._m.WRITE:
-            # data = struct.unpack("!L", self.recv(sock))[0]
-            #if not self.write_chunk():
-            #    self.send(sock, self._m.FAILURE)
-            #self.send(sock, self._m.SUCCESS)
-            pass
+            chunk_handle, offset, data = args
+
+            with self._chunk_locks.write(chunk_handle):
+                if not self.write_chunk(chunk_handle, int(offset), data):
+                    return [self._m.FAILURE]
+            return [self._m.SUCCESS]
+
+        # Request from the master granting or, with a duration of 0, revoking a lease on a chunk
+        elif sysmsg == self._m.LEASE:
+            chunk_handle, duration, secondaries = args[0], float(args[1]), args[2:]
+            self.grant_lease(chunk_handle, duration, secondaries)
+            if duration > 0:
+                return [self._m.SUCCESS]
+            # The master learns the length of a chunk from its primary as the lease is given up
+            return [self._m.SUCCESS, str(self.chunk_length(chunk_handle))]
+
+        # Request from the master to pad a chunk it has closed out to its final length
+        elif sysmsg == self._m.PAD:
+            chunk_handle, length = args
+
+            if not self.pad_chunk(chunk_handle, int(length)):
+                return [self._m.FAILURE]
+            return [self._m.SUCCESS]
 
         # Request for chunks managed by the chunkserver
         elif sysmsg == self._m.CONTENTS:
-            contents = self.get_contents()
+            return [self._m.SUCCESS] + self.get_contents()
+
+        # Request from the master to copy a chunk to another chunkserver
+        elif sysmsg == self._m.REPLICATE:
+            chunk_handle, target = args
 
-            if not contents:
-                self.send(sock, self._m.FAILURE)
-            self.send(sock, contents)
+            if not self.replicate_chunk(chunk_handle, target):
+                return [self._m.FAILURE]
+            return [self._m.SUCCESS]
+
+        # Request from the master to copy a chunk locally, before a chunk shared with a snapshot is written
+        elif sysmsg == self._m.CLONE:
+            chunk_handle, new_handle = args
+
+            if not self.clone_chunk(chunk_handle, new_handle):
+                return [self._m.FAILURE]
+            return [self._m.SUCCESS]
 
         # Request for the amount of chunkstore space is left on the chunkserver
         elif sysmsg == self._m.CHUNKSPACE:
-            chunk_handle = self.recv(sock)
-            chunk_space = self.get_remaining_chunk_space(chunk_handle)
-
-            if not chunk_space:
-                self.send(sock, self._m.FAILURE)
-            self.send(sock, chunk_space)
+            chunk_handle = args[0]
+            try:
+                return [self._m.SUCCESS, self.get_remaining_chunk_space(chunk_handle)]
+            except OSError:
+                return [self._m.FAILURE]
 
         else:
             log.warn("Message not recognized")
+            return [self._m.FAILURE]
 
     def create_chunk(self, chunk_handle):
         """
@@ -203,40 +253,59 @@ class Chunkserver(ChunkServer):
             log.error("IOError when trying to create chunk " + str(chunk_handle))
             return False
 
-    def append_chunk(self, chunk_handle, data):
+    def read_chunk(self, chunk_handle, offset, size):
         """
-        Append data to a specified chunk
+        Open a region of a specified chunk for reading. The region is streamed from the chunk
+        file to the socket when the reply is sent, so the data is never read in to memory.
 
-        :rtype : object
-        :param chunk_handle: 
-        :param data: 
+        :rtype : FileRegion
+        :param chunk_handle:
+        :param offset:
+        :param size: The number of bytes to read, or -1 to read to the end of the chunk
         """
         try:
-            with self._wLock:
-                with open(config.chunkstore + str(chunk_handle), 'a') as f:
-                    f.write(data)
-                return True
-        except IOError:
-            log.error("Unable to append data to chunk " + str(chunk_handle))
+            return FileRegion(open(config.chunkstore + str(chunk_handle), 'rb'), offset, size)
+        except (IOError, OSError):
+            log.error("Unable to read data from chunk " + str(chunk_handle))
+            return None
+
+    def replicate_chunk(self, chunk_handle, target):
+        """
+        Copy a chunk to another chunkserver, which writes its data to a new chunk
+
+        :rtype : bool
+        :param chunk_handle:
+        :param target: The chunkserver to copy the chunk to
+        """
+        try:
+            with open(config.chunkstore + str(chunk_handle), 'rb') as f:
+                data = f.read()
+
+            conn = Connection(target, timeout=config.client_timeout)
+            try:
+                return conn.call(self._m.WRITE, str(chunk_handle), "0", data)[0] == self._m.SUCCESS
+            finally:
+                conn.close()
+        except (IOError, OSError, RuntimeError):
+            log.error("Unable to copy chunk {} to {}".format(chunk_handle, target))
             return False
 
-    def read_chunk(self, chunk_handle, offset, size):
+    def clone_chunk(self, chunk_handle, new_handle):
         """
-        Read from a specified chunk
+        Copy a chunk to a new chunk on this chunkserver. The chunk's lock is held for reading,
+        so the copy holds no partial write.
 
-        :rtype : object
+        :rtype : bool
         :param chunk_handle:
-        :param offset:
-        :param size:
+        :param new_handle: The handle of the copy
         """
         try:
-            with self._rLock:
-                with open(config.chunkstore + str(chunk_handle), 'r') as f:
-                    f.seek(offset)
-                    data = f.read(size)
-                return data
-        except IOError:
-            log.error("Unable to read data from chunk " + str(chunk_handle))
+            with self._chunk_locks.read(chunk_handle):
+                shutil.copyfile(config.chunkstore + str(chunk_handle), config.chunkstore + str(new_handle))
+            self.chunk_set.add(str(new_handle))
+            return True
+        except (IOError, OSError):
+            log.error("Unable to copy chunk {} to {}".format(chunk_handle, new_handle))
             return False
 
     @staticmethod
@@ -254,13 +323,190 @@ class Chunkserver(ChunkServer):
             log.error("Unable to delete chunk " + str(chunk_handle))
             return False
 
-    def write_chunk(self):
+    def write_chunk(self, chunk_handle, offset, data):
         """
-        Write data to a chunk
+        Write data to a chunk at an offset, creating the chunk if it does not exist
 
-        :rtype : object
+        :rtype : bool
+        :param chunk_handle:
+        :param offset:
+        :param data:
+        """
+        path = config.chunkstore + str(chunk_handle)
+        try:
+            with open(path, 'r+b' if os.path.isfile(path) else 'wb') as f:
+                f.seek(offset)
+                f.write(data)
+            self.chunk_set.add(str(chunk_handle))
+            return True
+        except IOError:
+            log.error("Unable to write data to chunk " + str(chunk_handle))
+            return False
+
+    def pad_chunk(self, chunk_handle, length):
+        """
+        Extend a chunk with zeros to a length, as the master does when it closes the chunk
+        out on roll-over. Appends reserved by the master but not yet written may still land
+        inside the padding, so a chunk already as long is left alone.
+
+        :rtype : bool
+        :param chunk_handle:
+        :param length:
+        """
+        path = config.chunkstore + str(chunk_handle)
+        try:
+            with self._chunk_locks.write(chunk_handle):
+                with open(path, 'r+b' if os.path.isfile(path) else 'wb') as f:
+                    f.seek(0, os.SEEK_END)
+                    if f.tell() < length:
+                        f.truncate(length)
+            self.chunk_set.add(str(chunk_handle))
+            return True
+        except IOError:
+            log.error("Unable to pad chunk " + str(chunk_handle))
+            return False
+
+    def grant_lease(self, chunk_handle, duration, secondaries=()):
+        """
+        Become the primary of a chunk for some seconds. The lease is taken to expire
+        config.lease_margin seconds early, so it ends here before it ends on the master.
+        A duration of 0 gives the lease up.
+
+        :rtype : None
+        :param chunk_handle:
+        :param duration:
+        :param secondaries: The other chunkservers which hold the chunk
+        """
+        with self._lease_lock:
+            if duration > 0:
+                self.leases[chunk_handle] = (time.time() + duration - config.lease_margin, list(secondaries))
+            else:
+                self.leases.pop(chunk_handle, None)
+
+    def record_append(self, chunk_handle, data):
+        """
+        Append data to a chunk this chunkserver is the primary of. The primary chooses the
+        offset, writes the data there and forwards it to the secondaries, holding the
+        chunk's lock so every replica applies the appends in the same order. An append
+        which does not fit in the chunk is refused with FULL and the chunk's length, and
+        the client moves on to a new chunk.
+
+        :rtype : list
+        :param chunk_handle:
+        :param data:
+        :return: the reply, SUCCESS and the offset the data was written at if it succeeded
+        """
+        with self._chunk_locks.write(chunk_handle):
+            lease = self.leases.get(chunk_handle)
+            if lease is None or lease[0] <= time.time():
+                return [self._m.FAILURE]
+            expires, secondaries = lease
+
+            path = config.chunkstore + str(chunk_handle)
+            offset = os.path.getsize(path) if os.path.isfile(path) else 0
+            if offset + len(data) > config.chunk_size:
+                return [self._m.FULL, str(offset)]
+
+            if not self.write_chunk(chunk_handle, offset, data):
+                return [self._m.FAILURE]
+            for host in secondaries:
+                if not self.forward_write(host, chunk_handle, offset, data):
+                    return [self._m.FAILURE]
+            return [self._m.SUCCESS, str(offset)]
+
+    def chunk_length(self, chunk_handle):
+        """
+        Get the length of a chunk, once any append to it in progress has finished
+
+        :rtype : int
+        :param chunk_handle:
+        """
+        path = config.chunkstore + str(chunk_handle)
+        with self._chunk_locks.read(chunk_handle):
+            return os.path.getsize(path) if os.path.isfile(path) else 0
+
+    def forward_write(self, host, chunk_handle, offset, data):
+        """
+        Write data to a secondary replica of a chunk at the offset chosen by the primary
+
+        :rtype : bool
+        :param host:
+        :param chunk_handle:
+        :param offset:
+        :param data:
+        """
+        try:
+            with self.pool.connection(host) as conn:
+                return conn.call(self._m.WRITE, str(chunk_handle), str(offset), data)[0] == self._m.SUCCESS
+        except (IOError, RuntimeError):
+            log.error("Unable to forward a write of chunk {} to {}".format(chunk_handle, host))
+            return False
+
+    def renew_leases_forever(self):
+        """
+        Renew the chunkserver's leases periodically
+
+        :rtype : None
+        """
+        while True:
+            time.sleep(config.lease_renew_period)
+            try:
+                self.renew_leases()
+            except (IOError, RuntimeError):
+                log.warn("Unable to renew leases with the master")
+
+    def renew_leases(self):
+        """
+        Ask the master to extend every lease the chunkserver holds, in a single request.
+        Expired leases are dropped, and the leases the master did not extend are left to
+        expire. An extended lease is taken to start when the request was sent, so it
+        ends here before it ends on the master.
+
+        The length of each chunk is reported with its lease, since the master does not
+        learn the offsets the primary chooses. The chunks of leases which have lapsed are
+        reported until a request reaches the master, so it learns their final lengths.
+
+        :rtype : list
+        :return: the handles of the chunks whose leases were extended
+        """
+        now = time.time()
+        with self._lease_lock:
+            for chunk_handle, (expires, _) in self.leases.items():
+                if expires <= now:
+                    del self.leases[chunk_handle]
+                    self.lapsed.add(chunk_handle)
+            chunk_handles = list(self.leases)
+            lapsed = list(self.lapsed)
+        if not chunk_handles and not lapsed:
+            return []
+
+        reports = []
+        for chunk_handle in chunk_handles:
+            reports += [chunk_handle, str(self.chunk_length(chunk_handle)), "1"]
+        for chunk_handle in lapsed:
+            reports += [chunk_handle, str(self.chunk_length(chunk_handle)), "0"]
+        reply = self.call_master(self._m.RENEW, self.host, *reports)
+        renewed = reply[1:] if reply[0] == self._m.SUCCESS else []
+
+        with self._lease_lock:
+            if reply[0] == self._m.SUCCESS:
+                self.lapsed.difference_update(lapsed)
+            for chunk_handle in renewed:
+                if chunk_handle in self.leases:
+                    self.leases[chunk_handle] = (now + config.lease_duration - config.lease_margin,
+                                                 self.leases[chunk_handle][1])
+        return renewed
+
+    def call_master(self, sysmsg, *args):
+        """
+        Send a request to the master and wait for its reply
+
+        :rtype : list
+        :param sysmsg:
+        :param args:
         """
-        pass
+        with self.pool.connection(config.HOST, config.PORT) as conn:
+            return conn.call(sysmsg, *args)
 
     def get_contents(self):
         """
@@ -1,4 +1,16 @@
 """
+The Client is the interface applications use to work with the system. Metadata
+requests go to the master, and chunk data is exchanged directly with the
+chunkservers which hold it.
+
+Connections are kept in a pool per host and reused between requests, so a job
+issuing many small operations talks over warm sockets instead of opening a new
+connection for each one.
+
+The locations of the chunks of a file are cached, and the master sends those of the
+next few chunks with each lookup, so a sequential reader asks the master once per
+several chunks rather than once per chunk.
+
 ###############################################################################
 The MIT License (MIT)
 
@@ -24,59 +36,513 @@ THE SOFTWARE.
 ###############################################################################
 """
 import socket
+import select
+import threading
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import config
+from net import Connection, readable
+from message import Message
+
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("client_logger")
+
+
+class ConnectionPool(object):
+    """
+    Keeps open connections to each host for reuse. At most max_per_host connections are
+    open to a host at once; callers wait for one to be released beyond that. Connections
+    idle for longer than idle_timeout are closed, and an idle connection is checked before
+    it is handed out again so that connections closed by the server are not reused.
+    """
+
+    def __init__(self, max_per_host=config.client_max_connections, idle_timeout=config.client_idle_timeout,
+                 timeout=config.client_timeout):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._open = {}
+        self._lock = threading.Condition(threading.Lock())
+
+    @contextmanager
+    def connection(self, host, port=config.PORT):
+        """
+        Borrow a connection to a host for the duration of a with block. A connection which
+        raised an error is closed instead of being returned to the pool.
+
+        :param host:
+        :param port:
+        """
+        conn = self.acquire(host, port)
+        try:
+            yield conn
+        except:
+            self.release(conn, healthy=False)
+            raise
+        else:
+            self.release(conn)
+
+    def acquire(self, host, port=config.PORT):
+        """
+        Take an idle connection to a host from the pool, or open a new one
+
+        :rtype : Connection
+        :param host:
+        :param port:
+        """
+        address = (host, port)
+        with self._lock:
+            while True:
+                self._evict(address)
+                idle = self._idle.get(address)
+                while idle:
+                    conn, last_used = idle.pop()
+                    if self.is_healthy(conn):
+                        return conn
+                    self._discard(conn)
+
+                if self._open.get(address, 0) < self.max_per_host:
+                    self._open[address] = self._open.get(address, 0) + 1
+                    break
+                self._lock.wait()
+
+        try:
+            conn = Connection(host, port, self.timeout)
+        except (socket.error, socket.timeout):
+            with self._lock:
+                self._open[address] -= 1
+                self._lock.notify()
+            raise
+
+        conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        try:
+            conn.negotiate()
+        except (socket.error, socket.timeout, RuntimeError):
+            self.release(conn, healthy=False)
+            raise
+        return conn
+
+    def release(self, conn, healthy=True):
+        """
+        Return a connection to the pool
+
+        :rtype : None
+        :param conn:
+        :param healthy: False if the connection should be closed rather than reused
+        """
+        with self._lock:
+            if healthy:
+                self._idle.setdefault(conn.address, []).append((conn, time.time()))
+            else:
+                self._discard(conn)
+            self._lock.notify()
+
+    def evict_idle(self):
+        """
+        Close every connection which has been idle for longer than the idle timeout
+
+        :rtype : None
+        """
+        with self._lock:
+            for address in self._idle.keys():
+                self._evict(address)
+
+    def close(self):
+        """
+        Close every idle connection in the pool
+
+        :rtype : None
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, last_used in idle:
+                    self._discard(conn)
+            self._idle.clear()
+            self._lock.notify_all()
+
+    @staticmethod
+    def is_healthy(conn):
+        """
+        Check that an idle connection is still usable. An idle connection should have
+        nothing to read, so a readable socket means the server closed it.
+
+        :rtype : bool
+        :param conn:
+        """
+        try:
+            return not readable(conn.sock)
+        except (select.error, socket.error):
+            return False
+
+    def _evict(self, address):
+        """
+        Close the connections to an address which have been idle for too long. Idle
+        connections are kept oldest first, so the expired ones are at the front.
+
+        :param address:
+        """
+        idle = self._idle.get(address)
+        if not idle:
+            return
+
+        expired = time.time() - self.idle_timeout
+        while idle and idle[0][1] < expired:
+            self._discard(idle.pop(0)[0])
+
+    def _discard(self, conn):
+        """
+        Close a connection and forget it
+
+        :param conn:
+        """
+        self._open[conn.address] -= 1
+        conn.close()
+
+
+class MetadataCache(object):
+    """
+    A bounded cache of chunk metadata by file name and chunk index. The least recently
+    used entry is evicted when the cache is full, and entries expire after ttl seconds,
+    so chunks which moved are eventually looked up again even if no read fails.
+    """
+
+    def __init__(self, size=config.client_cache_size, ttl=config.client_cache_ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.files = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, file_name, chunk_index, now=None):
+        """
+        Get the cached metadata of a chunk of a file
+
+        :rtype : tuple
+        :param file_name:
+        :param chunk_index:
+        :param now:
+        :return: a three-tuple of the chunk handle, its length and its locations, or None
+        """
+        key = (file_name, chunk_index)
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= (time.time() if now is None else now):
+                if entry is not None:
+                    self._forget(key)
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, file_name, chunk_index, chunk, now=None):
+        """
+        Cache the metadata of a chunk of a file
+
+        :rtype : None
+        :param file_name:
+        :param chunk_index:
+        :param chunk: A three-tuple of the chunk handle, its length and its locations
+        :param now:
+        """
+        key = (file_name, chunk_index)
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = ((time.time() if now is None else now) + self.ttl, chunk)
+            self.files.setdefault(file_name, set()).add(chunk_index)
+            while len(self.entries) > self.size:
+                self._forget(self.entries.popitem(last=False)[0])
+
+    def invalidate(self, file_name):
+        """
+        Forget the cached metadata of every chunk of a file
+
+        :rtype : None
+        :param file_name:
+        """
+        with self._lock:
+            for chunk_index in self.files.pop(file_name, ()):
+                self.entries.pop((file_name, chunk_index), None)
+
+    def _forget(self, key):
+        """
+        Remove an entry which has left the cache from its file's index. Must be called with the lock held.
+
+        :param key:
+        """
+        chunk_indexes = self.files.get(key[0])
+        if chunk_indexes is not None:
+            chunk_indexes.discard(key[1])
+            if not chunk_indexes:
+                del self.files[key[0]]
 
 
 class Client(object):
     """
     Client API for the DFS system. Contains the calls to create, delete, undelete, read, append, and snapshot.
     """
-    def __init__(self):
-        pass
+    def __init__(self, master_host=config.HOST, master_port=config.PORT, pool=None, cache=None):
+        self._m = Message()
+        self.master = (master_host, master_port)
+        self.pool = pool or ConnectionPool()
+        self.cache = cache or MetadataCache()
+        self.leases = {}
+
+    def call_master(self, sysmsg, *args):
+        """
+        Send a request to the master and wait for its reply
+
+        :rtype : list
+        :param sysmsg:
+        :param args:
+        """
+        with self.pool.connection(*self.master) as conn:
+            return conn.call(sysmsg, *args)
+
+    def call_chunkserver(self, host, sysmsg, *args):
+        """
+        Send a request to a chunkserver and wait for its reply
+
+        :rtype : list
+        :param host:
+        :param sysmsg:
+        :param args:
+        """
+        with self.pool.connection(host) as conn:
+            return conn.call(sysmsg, *args)
 
     def create(self, file_name):
         """
+        Create a new, empty file
 
-        :rtype : object
+        :rtype : bool
         :param file_name:
         """
-        pass
+        return self.call_master(self._m.CREATE, file_name)[0] == self._m.SUCCESS
 
     def delete(self, file_name):
         """
+        Mark a file for deletion
 
         :param file_name:
-        :rtype : object
+        :rtype : bool
         """
-        pass
+        self.cache.invalidate(file_name)
+        return self.call_master(self._m.DELETE, file_name)[0] == self._m.SUCCESS
 
     def undelete(self, file_name):
         """
+        Remove the deletion mark from a file which has not been removed yet
 
         :param file_name:
-        :rtype : object
+        :rtype : bool
         """
-        pass
+        return self.call_master(self._m.UNDELETE, file_name)[0] == self._m.SUCCESS
 
-    def read(self):
+    def list(self, directory='', recursive=False, page_size=None):
         """
+        Iterate over the listing of a directory, asking the master for a page at a time
 
-        :rtype : object
+        :rtype : generator
+        :param directory:
+        :param recursive: List the paths of the files at any depth beneath the directory,
+                          rather than the names of its children
+        :param page_size: The number of names to ask for at a time, defaults to config.list_page_size
         """
-        pass
+        cursor = ""
+        while True:
+            reply = self.call_master(self._m.LIST, directory, cursor, str(page_size or config.list_page_size),
+                                     "1" if recursive else "0")
+            if reply[0] != self._m.SUCCESS:
+                return
+            cursor = reply[1]
+            for name in reply[2:]:
+                yield name
+            if not cursor:
+                return
 
-    def append(self):
+    def batch(self, requests):
         """
+        Send many metadata requests to the master in a single round trip. CREATE, DELETE,
+        UNDELETE and LOOKUP requests may be batched.
 
-        :rtype : object
+        :rtype : list
+        :param requests: A list of two-tuples of a message code and a file name
+        :return: for each request, in order, a list of the status code of its reply followed
+                 by the chunk handles for a LOOKUP
         """
-        pass
+        with self.pool.connection(*self.master) as conn:
+            reply = conn.call(self._m.BATCH, *[conn.pack_args([chr(sysmsg), file_name])
+                                               for sysmsg, file_name in requests])
+            if reply[0] != self._m.SUCCESS:
+                return [[self._m.FAILURE] for _ in requests]
+
+            replies = [conn.unpack_args(bytearray(item)) for item in reply[1:]]
+        return [[ord(item[0])] + item[1:] for item in replies]
 
-    def snapshot(self):
+    def read(self, file_name):
         """
+        Read the contents of a file. Each chunk is read from the first of its replicas
+        which answers. Chunk locations are taken from the cache when they are there; if
+        no replica at the cached locations can serve a chunk, the file's cached metadata
+        is dropped and the chunk is looked up again.
+
+        :rtype : str
+        :param file_name:
+        :return: the contents of the file, or None if the file could not be read
+        """
+        data = []
+        chunk_index = 0
+        while True:
+            chunk = self.cache.get(file_name, chunk_index)
+            cached = chunk is not None
+            if not cached:
+                chunks = self.lookup_chunks(file_name, chunk_index)
+                if chunks is None:
+                    return None
+                if not chunks:
+                    break
+                chunk = chunks[0]
+
+            chunk_data = self.read_chunk(*chunk)
+            if chunk_data is None:
+                if not cached:
+                    return None
+                self.cache.invalidate(file_name)
+                continue
+            data.append(chunk_data)
+            chunk_index += 1
+
+        return "".join(data)
 
-        :rtype : object
+    def lookup_chunks(self, file_name, chunk_index):
         """
-        pass
+        Ask the master for the metadata of a chunk of a file and the few chunks after it,
+        and cache them. The last chunk of a file may still grow, and the master does not
+        say which chunk is last, so one chunk more than is cached is asked for and the
+        final chunk of each reply is never cached.
 
+        :rtype : list
+        :param file_name:
+        :param chunk_index: The position of the first chunk within the file
+        :return: three-tuples of the handle, length and locations of each chunk, empty past
+                 the end of the file, or None if the file could not be read
+        """
+        with self.pool.connection(*self.master) as conn:
+            reply = conn.call(self._m.READ, file_name, str(chunk_index), str(config.client_prefetch_chunks + 1))
+            if reply[0] != self._m.SUCCESS:
+                return None
+            replies = [conn.unpack_args(bytearray(item)) for item in reply[1:]]
+
+        chunks = [(item[0], item[1], item[2:]) for item in replies]
+        for i, chunk in enumerate(chunks[:-1]):
+            self.cache.put(file_name, chunk_index + i, chunk)
+        return chunks
+
+    def read_chunk(self, chunk_handle, length, locations):
+        """
+        Read the first length bytes of a chunk from one of its replicas
+
+        :rtype : str
+        :param chunk_handle:
+        :param length:
+        :param locations:
+        """
+        for host in locations:
+            try:
+                reply = self.call_chunkserver(host, self._m.READ, chunk_handle, "0", length)
+            except (socket.error, socket.timeout, RuntimeError) as e:
+                log.warn("Unable to read chunk {} from {}: {}".format(chunk_handle, host, e))
+                continue
+
+            if reply[0] == self._m.SUCCESS:
+                return reply[1]
+
+        log.error("Unable to read chunk {} from any replica".format(chunk_handle))
+        return None
+
+    def append(self, file_name, data):
+        """
+        Append data to the end of a file. The data is sent to the primary of the file's
+        last chunk, which chooses the offset and writes the data to every replica. The
+        chunk and its primary are cached until the lease expires, so the master is only
+        asked again when the lease runs out, the primary refuses the append or the chunk
+        is full.
+
+        :rtype : bool
+        :param file_name:
+        :param data:
+        """
+        if len(data) > config.chunk_size:
+            return False
+
+        full = ()
+        for _ in range(config.client_append_retries):
+            lease = self.leases.get(file_name)
+            if lease is None or lease[2] <= time.time() or full:
+                lease = self.lease(file_name, *full)
+                if lease is None:
+                    return False
+                full = ()
+
+            chunk_handle, primary, _ = lease
+            try:
+                reply = self.call_chunkserver(primary, self._m.APPEND, chunk_handle, data)
+            except (socket.error, socket.timeout, RuntimeError) as e:
+                log.warn("Unable to append to chunk {} on {}: {}".format(chunk_handle, primary, e))
+                self.leases.pop(file_name, None)
+                continue
+
+            if reply[0] == self._m.SUCCESS:
+                return True
+            if reply[0] == self._m.FULL:
+                full = (chunk_handle, reply[1])
+            else:
+                self.leases.pop(file_name, None)
+
+        log.error("Unable to append to file '{}'".format(file_name))
+        return False
+
+    def lease(self, file_name, *full):
+        """
+        Ask the master for the chunk which appends to a file go to and its primary, and
+        cache them until the lease expires
+
+        :rtype : tuple
+        :param file_name:
+        :param full: The handle and length of a chunk the primary reported full, if any
+        :return: a three-tuple of the chunk handle, the primary and the time the lease
+                 expires, or None
+        """
+        if full:
+            self.cache.invalidate(file_name)
+        reply = self.call_master(self._m.LEASE, file_name, *full)
+        if reply[0] != self._m.SUCCESS:
+            self.leases.pop(file_name, None)
+            return None
+
+        lease = self.leases[file_name] = (reply[1], reply[2], time.time() + float(reply[3]))
+        return lease
+
+    def snapshot(self, source, target):
+        """
+        Snapshot a file, or the files beneath a directory, in to a new name. The snapshot
+        shares the chunks of its files until either is appended to, so no data is copied.
+
+        :rtype : bool
+        :param source: The file or directory to snapshot
+        :param target: The name of the snapshot, which must not exist
+        """
+        self.cache.invalidate(target)
+        return self.call_master(self._m.SNAPSHOT, source, target)[0] == self._m.SUCCESS
@@ -30,6 +30,7 @@ THE SOFTWARE.
 oplog = "../resources/OPLOG.log"
 hosts = "../resources/all.hosts"
 activehosts = "../resources/active.hosts"
+racks = "../resources/racks"
 metasnapshot = "../resources/meta.snapshot"
 chunkstore = "../chunkstore/"
 
@@ -39,6 +40,46 @@ chunk_size = 2 ** 10
 replica_amount = 3
 PORT = 9500  # TODO: look in to which port would be best, if it even matters
 HOST = '127.0.0.1'
+listen_backlog = 128
+server_engine = 'threaded'  # 'threaded' or 'eventloop'
+worker_count = 32
+worker_queue_size = 128
+server_idle_timeout = 300
+client_max_connections = 8
+client_idle_timeout = 60
+client_timeout = 10
+master_rpc_timeout = 3  # LEASE and CLONE calls made by the master while it serves a request
+compression = True
+compression_level = 6
+compression_threshold = 2 ** 10
+compression_sample_size = 2 ** 12
+compression_min_ratio = 0.9
+max_frame_size = 2 ** 27  # The largest payload a frame may carry, or a compressed frame expand to
+oplog_flush_interval = 0.002
+checkpoint_interval = 60
+checkpoint_retain = 10
+lock_stripes = 64
+chunk_handle_range = 1024
+placement_half_life = 60
+placement_recent_weight = 0.01
+placement_inflight_weight = 0.01
+placement_rescore_interval = 5
+replication_interval = 1
+replication_max_inflight = 16
+replication_host_max_inflight = 2
+replication_bandwidth = 2 ** 27
+replication_host_bandwidth = 2 ** 25
+replication_blocking_boost = 0.5
+lease_duration = 60
+lease_renew_period = 15
+lease_margin = 1
+client_append_retries = 3
+client_cache_size = 4096
+client_cache_ttl = 30
+client_prefetch_chunks = 8
+read_prefetch_max = 64
+list_page_size = 1000
+list_page_max = 10000
 heartbeat_fresh_period = 15
 heartbeat_timeout = 10
 heartbeat_port = 9550
@@ -38,22 +38,45 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 ###############################################################################
 """
+from array import array
 import hashlib
 
+from namespace import parent
+
 
 class File(object):
     """
-    Contains the metadata associated with a file.
+    Contains the metadata associated with a file. The chunk handles of a file are held
+    in an array of unsigned longs rather than a list of int objects.
     """
+    __slots__ = ('file_name', 'chunk_handles', 'delete', 'size', '_password')
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, chunk_handles=()):
         self.file_name = file_name
-        self.chunk_handles = []
+        self.chunk_handles = array('L', chunk_handles)
         self.delete = False
         self.size = None
-        self.namespace = None
         self._password = None
 
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        state.pop('namespace', None)
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+        if not isinstance(self.chunk_handles, array):
+            self.chunk_handles = array('L', self.chunk_handles)
+
+    @property
+    def namespace(self):
+        """
+        The path of the directory holding the file
+
+        :rtype : str
+        """
+        return parent(self.file_name)
+
     def set_password(self, password):
         """
         Set the password for the file
@@ -33,30 +33,234 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 ###############################################################################
 """
-from threading import Lock
+from contextlib import contextmanager
+from threading import Lock, local
 import logging
 
 from file import File
 from chunk import Chunk
+from locks import RWLock, StripedLocks
+from namespace import Namespace, ancestors, components
 import config
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("global_state_logger")
 
 
+MAX_CHUNK_HANDLE = 2 ** 64 - 1
+
+
 class GlobalState(object):
     """
-    Contains important global state, including the chunkHandle incrementer
+    Contains important global state, including the chunkHandle incrementer.
+
+    Files are kept both in a flat map, for lookups by name, and in a namespace tree, for
+    listing directories. Files and chunks are guarded by reader-writer locks striped by
+    path and chunk handle; an operation on a file also holds the locks of the directories
+    above it for reading. Mutations also hold the global lock for reading, so that taking
+    it for writing gives a point-in-time view of the whole state. Locks are always taken
+    in the order: global lock, path stripes, chunk stripes.
+
+    Chunk handles are 64 bit and never reused. Each thread allocates handles from a range
+    of config.chunk_handle_range handles which it leases from the handle counter, so only
+    the first handle of a range touches c_lock, and a range only needs to be made durable
+    once.
+
+    An index from each chunkserver to the handles of the chunks it holds is kept up to
+    date as chunk locations change, so that the chunks of a failed or departing
+    chunkserver are found without scanning every chunk. The index is not persisted; it
+    is rebuilt from the chunk locations on load.
+
+    A snapshot copies only the chunk handles of its files, so its chunks are shared with
+    the files it was taken of. Each chunk counts the files which hold it; a chunk is
+    removed once no file holds it, and a shared chunk is split before it is written to.
+    The counts are rebuilt from the files on load, like the host index.
+
+    A checkpoint holds the global lock for writing only to freeze the state, which takes
+    shallow copies of the file and chunk maps. The files and chunks are copied after the
+    lock is released; until then, a file or chunk keeps the image it had when frozen
+    before it is first changed, and the copy takes that image instead.
     """
     def __init__(self):
-        # FIXME: As per the GFS paper, chunk ids are immutable 64 bit UIDs
         self.c_lock = Lock()
+        self._leases = local()
+        self.lock = RWLock()
+        self.file_locks = StripedLocks()
+        self.chunk_locks = StripedLocks()
         self._chunk_handle = 0
         self.to_delete = set()
         self.file_map = {}
+        self.namespace = Namespace()
         self.chunk_map = {}
+        self.host_chunks = {}
         self.hosts = []
         self.active_hosts = []
+        self._frozen = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('c_lock', '_leases', 'lock', 'file_locks', 'chunk_locks', 'namespace', 'host_chunks',
+                     '_frozen'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.c_lock = Lock()
+        self._leases = local()
+        self.lock = RWLock()
+        self.file_locks = StripedLocks()
+        self.chunk_locks = StripedLocks()
+        self._frozen = None
+        self.namespace = Namespace()
+        for filename, f in self.file_map.iteritems():
+            self.namespace.add(filename, f)
+        self.host_chunks = {}
+        for chunk in self.chunk_map.itervalues():
+            self._index_locations(chunk.chunk_handle, (), chunk.chunkserver_locations)
+        self._count_references()
+
+    def _count_references(self):
+        """
+        Count the files which hold each chunk, after the global state is loaded
+
+        :rtype : None
+        """
+        chunk_map = self.chunk_map
+        for f in self.file_map.itervalues():
+            for chunk_handle in f.chunk_handles:
+                chunk = chunk_map.get(chunk_handle)
+                if chunk is not None:
+                    chunk.references += 1
+
+    def locked_for_write(self, *filenames):
+        """
+        Hold the global lock for reading and the locks of some files for writing, with the
+        locks of the directories above them for reading, for the duration of a with block
+
+        :param filenames:
+        """
+        return self._locked(filenames, write=True)
+
+    def locked_for_read(self, *paths):
+        """
+        Hold the locks of some paths and of the directories above them for reading for the
+        duration of a with block
+
+        :param paths:
+        """
+        return self._locked(paths, write=False)
+
+    @contextmanager
+    def _locked(self, paths, write):
+        directories = [directory for path in paths for directory in ancestors(path)]
+        if write:
+            with self.lock.read(), self.file_locks.acquire(reads=directories, writes=paths):
+                yield
+        else:
+            with self.file_locks.acquire(reads=directories + list(paths)):
+                yield
+
+    def freeze(self):
+        """
+        Mark the point in time a checkpoint copies. Must be called with the global lock held
+        for writing; only the file and chunk maps are copied, and only shallowly, so the lock
+        is held briefly however large the state is.
+
+        :rtype : dict
+        :return: the frozen state, to be passed to checkpoint_view
+        """
+        self._frozen = {}
+        return {
+            'chunk_handle': self._chunk_handle,
+            'files': self.file_map.copy(),
+            'chunks': self.chunk_map.copy(),
+            'to_delete': list(self.to_delete),
+            'images': self._frozen,
+        }
+
+    def preserve_file(self, f):
+        """
+        Keep the image a file had when the state was frozen, before the file is changed.
+        Must be called with the file's lock held for writing.
+
+        :rtype : None
+        :param f:
+        """
+        images = self._frozen
+        if images is not None and id(f) not in images:
+            images.setdefault(id(f), (f.file_name, f.chunk_handles[:]))
+
+    def preserve_chunk(self, chunk):
+        """
+        Keep the image a chunk had when the state was frozen, before its offset or locations
+        are changed
+
+        :rtype : None
+        :param chunk:
+        """
+        images = self._frozen
+        if images is not None and id(chunk) not in images:
+            images.setdefault(id(chunk), (chunk.chunk_handle, chunk.offset(), list(chunk.chunkserver_locations)))
+
+    def checkpoint_view(self, frozen=None):
+        """
+        Copy the persistent state in to plain lists, which can be serialized while mutations
+        carry on. The copy is taken without any lock: each file and chunk is read as it is,
+        and the image it was preserved with is taken instead if it has changed since the
+        state was frozen. An object is always preserved before it changes, so reading it
+        before looking for its image never sees a change made after the freeze.
+
+        :rtype : dict
+        :param frozen: The state returned by freeze, or None to freeze it now
+        """
+        if frozen is None:
+            with self.lock.write():
+                frozen = self.freeze()
+
+        images = frozen['images']
+        try:
+            files = []
+            for f in frozen['files'].itervalues():
+                image = f.file_name, f.chunk_handles[:]
+                files.append(images.get(id(f), image))
+            chunks = []
+            for c in frozen['chunks'].itervalues():
+                image = c.chunk_handle, c.offset(), list(c.chunkserver_locations)
+                chunks.append(images.get(id(c), image))
+        finally:
+            if self._frozen is images:
+                self._frozen = None
+
+        return {
+            'chunk_handle': frozen['chunk_handle'],
+            'files': files,
+            'chunks': chunks,
+            'to_delete': frozen['to_delete'],
+        }
+
+    @classmethod
+    def from_checkpoint(cls, view):
+        """
+        Build a global state from a view returned by checkpoint_view
+
+        :rtype : GlobalState
+        :param view:
+        """
+        gs = cls()
+        gs._chunk_handle = view['chunk_handle']
+        for file_name, chunk_handles in view['files']:
+            f = File(file_name, chunk_handles)
+            gs.file_map[file_name] = f
+            gs.namespace.add(file_name, f)
+        chunk_map = gs.chunk_map
+        for chunk_handle, offset, chunkserver_locations in view['chunks']:
+            chunk_map[chunk_handle] = Chunk(chunk_handle, chunkserver_locations, offset)
+            gs._index_locations(chunk_handle, (), chunkserver_locations)
+        gs._count_references()
+        for file_name in view['to_delete']:
+            gs.queue_delete(file_name)
+        return gs
 
     @property
     def get_current_chunk(self):
@@ -65,22 +269,59 @@ class GlobalState(object):
         only be used as a check for the current chunk handle, not as a means to allocate a chunk handle to
         a new Chunk.
 
-        :return: the current (most recent) chunk handle
+        :return: the highest chunk handle leased so far. No chunk has a greater handle, but
+                 handles are leased in ranges, so no chunk need have this one.
         """
         return self._chunk_handle
 
     @property
     def get_next_chunk(self):
         """
-        Increments the most current chunk handle and then returns the new chunk handle value. This should
-        NOT be used to check chunk handles, but instead, it should be used to allocate chunk handles for
-        new chunks.
+        Allocate a chunk handle for a new chunk without logging the lease of a new range.
+        This should NOT be used to check chunk handles, nor by the master, whose handles must
+        go through allocate_chunk_handle with a callback which logs each range it leases.
+
+        :return: a new chunk handle
+        """
+        return self.allocate_chunk_handle()
+
+    def allocate_chunk_handle(self, on_lease=None):
+        """
+        Allocate a chunk handle from the calling thread's range, leasing a new range from the
+        handle counter when the thread's range is used up
 
+        :rtype : int
+        :param on_lease: Called with the first and last handle of a newly leased range before
+                         any handle from it is returned, to make the lease durable
         :return: a new chunk handle
         """
+        leases = self._leases
+        if getattr(leases, 'next', 1) > getattr(leases, 'last', 0):
+            with self.c_lock:
+                first = self._chunk_handle + 1
+                last = min(self._chunk_handle + config.chunk_handle_range, MAX_CHUNK_HANDLE)
+                if first > last:
+                    raise OverflowError("Chunk handles are exhausted.")
+                self._chunk_handle = last
+
+            if on_lease is not None:
+                on_lease(first, last)
+            leases.next, leases.last = first, last
+
+        chunk_handle = leases.next
+        leases.next += 1
+        return chunk_handle
+
+    def lease_chunk_handles(self, last):
+        """
+        Move the handle counter past a leased range of chunk handles, so that none of its
+        handles is handed out again
+
+        :rtype : None
+        :param last: The last handle of the range
+        """
         with self.c_lock:
-            self._chunk_handle += 1
-        return self._chunk_handle
+            self._chunk_handle = max(self._chunk_handle, last)
 
     def refresh_hosts(self):
         """
@@ -107,12 +348,14 @@ class GlobalState(object):
         :rtype : object
         :param filename:
         """
-        if filename not in self.file_map.keys():
-            self.file_map[filename] = File(filename)
-            return 1
-        else:
-            log.error("Filename '{}' already exists.".format(filename))
-            return 0
+        with self.locked_for_write(filename):
+            f = File(filename)
+            if filename not in self.file_map and self.namespace.add(filename, f):
+                self.file_map[filename] = f
+                return 1
+
+        log.error("Filename '{}' already exists.".format(filename))
+        return 0
 
     def queue_delete(self, filename):
         """
@@ -121,11 +364,12 @@ class GlobalState(object):
         :rtype : object
         :param filename:
         """
-        if filename in self.file_map.keys():
-            self.to_delete.add(filename)
-            return 1
-        else:
-            return 0
+        with self.locked_for_write(filename):
+            if filename in self.file_map:
+                self.to_delete.add(filename)
+                return 1
+            else:
+                return 0
 
     def dequeue_delete(self, filename):
         """
@@ -134,11 +378,12 @@ class GlobalState(object):
         :rtype : object
         :param filename:
         """
-        try:
-            self.to_delete.remove(filename)
-            return 1
-        except KeyError:
-            return 0
+        with self.locked_for_write(filename):
+            try:
+                self.to_delete.remove(filename)
+                return 1
+            except KeyError:
+                return 0
 
     def get_file(self, filename):
         """
@@ -147,26 +392,78 @@ class GlobalState(object):
         :rtype : File
         :param filename:
         """
-        try:
-            return self.file_map[filename]
-        except KeyError:
-            return None
+        with self.locked_for_read(filename):
+            return self.file_map.get(filename)
 
-    def get_files(self):
+    def get_chunk_handles(self, filename):
         """
-        Get a list of all file objects in the system
+        Get the handles of the chunks which make up a file, in order
 
-        :rtype : object
+        :rtype : list
+        :param filename:
+        :return: the list of chunk handles, or None if the file does not exist
         """
-        return self.file_map.values()
+        with self.locked_for_read(filename):
+            f = self.file_map.get(filename)
+            return None if f is None else list(f.chunk_handles)
 
-    def get_file_names(self):
+    def apply_batch(self, operations):
         """
-        Get a list of all file names currently used in the system
+        Apply a batch of operations while holding the locks of every file it names, so that
+        no other operation on those files is interleaved with it
 
-        :rtype : object
+        :rtype : list
+        :param operations: A list of two-tuples of a GlobalState method name and its arguments,
+                           the first of which is a file name
+        :return: the list of results of the operations, in order
+        """
+        with self.locked_for_write(*[args[0] for _, args in operations]):
+            return [getattr(self, name)(*args) for name, args in operations]
+
+    def get_files(self, directory=None, after=None):
         """
-        return self.file_map.keys()
+        Iterate over the file objects in the system, or those beneath a directory, in
+        path order
+
+        :rtype : generator
+        :param directory:
+        :param after: The name of the file to resume after
+        """
+        for name in self.get_file_names(directory, after):
+            f = self.file_map.get(name)
+            if f is not None:
+                yield f
+
+    def get_file_names(self, directory=None, after=None):
+        """
+        Iterate over the file names used in the system, or those beneath a directory, in
+        path order. Only the files beneath the directory are visited, and no lock is held
+        between names, so files may be created and deleted while the names are consumed.
+
+        :rtype : generator
+        :param directory:
+        :param after: The name of the file to resume after, as the last name of an earlier listing
+        """
+        directory = directory or ''
+        prefix = directory.rstrip('/') + '/' if components(directory) else ''
+        if after is not None:
+            after = after[len(prefix):] if after.startswith(prefix) else after.lstrip('/')
+        for _, f in self.namespace.walk(directory, after):
+            yield f.file_name
+
+    def list_directory(self, directory, after=None, limit=None):
+        """
+        List the files and subdirectories directly within a directory, in name order, a
+        page at a time. The names of subdirectories end with '/'.
+
+        :rtype : list
+        :param directory:
+        :param after: The name to list after, as the last name of the previous page
+        :param limit: The largest number of names to list, or None for all of them
+        :return: the list of names, or None if there is no such directory
+        """
+        with self.locked_for_read(directory):
+            return self.namespace.list(directory, after, limit)
 
     def clean_file_map(self, filename):
         """
@@ -175,12 +472,14 @@ class GlobalState(object):
         :rtype : object
         :param filename:
         """
-        associated_chunks = self.file_map[filename].chunk_handles
+        with self.locked_for_write(filename):
+            associated_chunks = self.file_map[filename].chunk_handles
 
-        for chunk_handle in associated_chunks:
-            self.clean_chunk_map(chunk_handle)
+            for chunk_handle in associated_chunks:
+                self.clean_chunk_map(chunk_handle)
 
-        del self.file_map[filename]
+            del self.file_map[filename]
+            self.namespace.remove(filename)
 
     def add_chunk(self, chunk_handle):
         """
@@ -189,11 +488,116 @@ class GlobalState(object):
         :rtype : object
         :param chunk_handle:
         """
-        if chunk_handle not in self.chunk_map.keys():
-            self.chunk_map[chunk_handle] = Chunk(chunk_handle)
+        with self.lock.read(), self.chunk_locks.write(chunk_handle):
+            if chunk_handle not in self.chunk_map:
+                self.chunk_map[chunk_handle] = Chunk(chunk_handle)
+                return 1
+            else:
+                return 0
+
+    def add_file_chunk(self, filename, chunk_handle, chunkserver_locations):
+        """
+        Add a new chunk object to the chunk map and append it to the chunks of a file. The
+        chunk handle counter is moved past the handle, so that a chunk added while replaying
+        the operation log is not handed out again.
+
+        :rtype : object
+        :param filename:
+        :param chunk_handle:
+        :param chunkserver_locations:
+        """
+        with self.locked_for_write(filename), self.chunk_locks.write(chunk_handle):
+            f = self.file_map.get(filename)
+            if f is None or not self.add_chunk(chunk_handle):
+                return 0
+
+            self.set_chunk_locations(chunk_handle, chunkserver_locations)
+            self.chunk_map[chunk_handle].reference()
+            self.preserve_file(f)
+            f.chunk_handles.append(chunk_handle)
+            self.lease_chunk_handles(chunk_handle)
+            return 1
+
+    def snapshot(self, source, target):
+        """
+        Copy a file, or the files beneath a directory, to a new name. Only the metadata is
+        copied: each copy holds the chunk handles of its file, and each chunk counts the
+        copy among the files which hold it. No chunk is copied until it is written to.
+
+        :rtype : list
+        :param source: The file or directory to copy
+        :param target: The name of the copy, which must not exist
+        :return: the new file objects, or an empty list if the source does not exist or the
+                 target does
+        """
+        with self.locked_for_write(source, target):
+            f = self.file_map.get(source)
+            if f is not None:
+                copies = [(f, target)]
+            else:
+                prefix = target.rstrip('/') + '/'
+                copies = [(entry, prefix + path) for path, entry in self.namespace.walk(source)]
+            if not copies or target in self.file_map or self.namespace.is_directory(target):
+                return []
+
+            files = []
+            for f, file_name in copies:
+                copy = File(file_name, f.chunk_handles)
+                if not self.namespace.add(file_name, copy):
+                    # Only the first copy can fail, when a file is in the way of the target
+                    log.error("Unable to snapshot '{}' to '{}'.".format(source, target))
+                    return []
+                self.file_map[file_name] = copy
+                for chunk_handle in f.chunk_handles:
+                    chunk = self.chunk_map.get(chunk_handle)
+                    if chunk is not None:
+                        chunk.reference()
+                files.append(copy)
+            return files
+
+    def split_chunk(self, filename, chunk_handle, new_handle, chunkserver_locations):
+        """
+        Replace the last chunk of a file, which it shares with other files, by a copy of its
+        own, before the chunk is written to. The copy starts at the length of the chunk.
+
+        :rtype : object
+        :param filename:
+        :param chunk_handle: The handle of the shared chunk
+        :param new_handle: The handle of the copy
+        :param chunkserver_locations: The chunkservers which hold the copy
+        :return: 1, or 0 if the chunk is no longer the last chunk of the file
+        """
+        with self.locked_for_write(filename), self.chunk_locks.write(chunk_handle, new_handle):
+            f = self.file_map.get(filename)
+            chunk = self.chunk_map.get(chunk_handle)
+            if (f is None or chunk is None or not f.chunk_handles or f.chunk_handles[-1] != chunk_handle or
+                    new_handle in self.chunk_map):
+                return 0
+
+            copy = self.chunk_map[new_handle] = Chunk(new_handle, offset=chunk.offset())
+            self.set_chunk_locations(new_handle, chunkserver_locations)
+            copy.reference()
+            self.preserve_file(f)
+            f.chunk_handles[-1] = new_handle
+            self.clean_chunk_map(chunk_handle)
+            self.lease_chunk_handles(new_handle)
+            return 1
+
+    def update_chunk_offset(self, chunk_handle, size):
+        """
+        Move the offset of a chunk forward after an append
+
+        :rtype : object
+        :param chunk_handle:
+        :param size:
+        """
+        with self.lock.read(), self.chunk_locks.write(chunk_handle):
+            chunk = self.get_chunk(chunk_handle)
+            if chunk is None:
+                return 0
+            self.preserve_chunk(chunk)
+            chunk.update_offset(size)
             return 1
-        else:
-            return 0
 
     def get_chunk(self, chunk_handle):
         """
@@ -202,37 +606,119 @@ class GlobalState(object):
         :rtype : Chunk
         :param chunk_handle:
         """
-        try:
-            return self.chunk_map[chunk_handle]
-        except KeyError:
+        with self.chunk_locks.read(chunk_handle):
+            chunk = self.chunk_map.get(chunk_handle)
+
+        if chunk is None:
             log.error('Chunk handle {} does not exist in chunk map.'.format(chunk_handle))
-            return None
+        return chunk
 
     def get_chunks(self):
         """
-        Get a list of all chunk objects in the system
+        Iterate over the chunk objects in the system. Like get_chunk_ids, the map is
+        iterated in place.
 
-        :rtype : object
+        :rtype : iterator
         """
-        return self.chunk_map.values()
+        return self.chunk_map.itervalues()
 
     def get_chunk_ids(self):
         """
-        Get a list of all the chunkHandles currently used in the system
+        Iterate over the chunk handles used in the system. The map is iterated in place
+        rather than copied, so chunks must not be added or removed while the handles are
+        walked; a caller which cannot rule that out takes a copy, as list(get_chunk_ids()).
 
-        :rtype : object
+        :rtype : iterator
         """
-        return self.chunk_map.keys()
+        return self.chunk_map.iterkeys()
 
     def clean_chunk_map(self, chunk_handle):
         """
         When a file is deleted, its chunks must be deleted. Cleans the map and
-        removes its metadata footprint
+        removes its metadata footprint, once no other file shares the chunk
 
         :rtype : object
         :param chunk_handle:
         """
-        try:
-            del self.chunk_map[chunk_handle]
-        except KeyError:
-            log.error('Unable to delete chunk handle from map.')
\ No newline at end of file
+        with self.lock.read(), self.chunk_locks.write(chunk_handle):
+            chunk = self.chunk_map.get(chunk_handle)
+            if chunk is None:
+                log.error('Unable to delete chunk handle from map.')
+            elif chunk.dereference() <= 0:
+                del self.chunk_map[chunk_handle]
+                self._index_locations(chunk_handle, chunk.chunkserver_locations, ())
+
+    def set_chunk_locations(self, chunk_handle, chunkserver_locations):
+        """
+        Replace the chunkservers a chunk is placed on
+
+        :rtype : object
+        :param chunk_handle:
+        :param chunkserver_locations:
+        """
+        with self.lock.read(), self.chunk_locks.write(chunk_handle):
+            chunk = self.chunk_map.get(chunk_handle)
+            if chunk is None:
+                return 0
+            chunkserver_locations = list(chunkserver_locations)
+            self._index_locations(chunk_handle, chunk.chunkserver_locations, chunkserver_locations)
+            self.preserve_chunk(chunk)
+            chunk.chunkserver_locations = chunkserver_locations
+            return 1
+
+    def add_chunk_location(self, chunk_handle, host):
+        """
+        Record a new replica of a chunk on a chunkserver
+
+        :rtype : object
+        :param chunk_handle:
+        :param host:
+        """
+        with self.lock.read(), self.chunk_locks.write(chunk_handle):
+            chunk = self.chunk_map.get(chunk_handle)
+            if chunk is None or host in chunk.chunkserver_locations:
+                return 0
+            return self.set_chunk_locations(chunk_handle, chunk.chunkserver_locations + [host])
+
+    def remove_chunk_location(self, chunk_handle, host):
+        """
+        Forget the replica of a chunk on a chunkserver
+
+        :rtype : object
+        :param chunk_handle:
+        :param host:
+        """
+        with self.lock.read(), self.chunk_locks.write(chunk_handle):
+            chunk = self.chunk_map.get(chunk_handle)
+            if chunk is None or host not in chunk.chunkserver_locations:
+                return 0
+            return self.set_chunk_locations(chunk_handle, [h for h in chunk.chunkserver_locations if h != host])
+
+    def get_host_chunks(self, host):
+        """
+        Get the handles of the chunks a chunkserver holds a replica of
+
+        :rtype : set
+        :param host:
+        """
+        # Copying a set is a single step under the GIL, so a concurrent update cannot disturb it
+        return set(self.host_chunks.get(host, ()))
+
+    def _index_locations(self, chunk_handle, old_locations, new_locations):
+        """
+        Move a chunk between chunkservers in the host index. Must be called with the chunk's
+        lock held for writing.
+
+        :rtype : None
+        :param chunk_handle:
+        :param old_locations:
+        :param new_locations:
+        """
+        for host in old_locations:
+            if host not in new_locations and host in self.host_chunks:
+                self.host_chunks[host].discard(chunk_handle)
+        for host in new_locations:
+            chunks = self.host_chunks.get(host)
+            if chunks is None:
+                chunks = self.host_chunks.setdefault(host, set())
+            chunks.add(chunk_handle)
\ No newline at end of file
@@ -34,6 +34,7 @@ THE SOFTWARE.
 ###############################################################################
 """
 import socket
+import struct
 import threading
 import time
 import logging
@@ -46,6 +47,10 @@ from message import Message
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("heartbeat_logger")
 
+# The optional load report which follows the heartbeat message code: the capacity and
+# used bytes of the chunkserver's storage and the number of its reads and writes in flight
+load_report = struct.Struct('!QQL')
+
 
 # TODO: Need a way to persist this dict?
 class HeartbeatDict(dict):
@@ -120,8 +125,13 @@ class HeartbeatListener(threading.Thread):
     from the master to the chunkservers are handled by a separate two-way message (TCP) protocol.
     """
 
-    def __init__(self):
+    def __init__(self, on_report=None):
+        """
+        :param on_report: Called with the host, capacity, used bytes and I/O in flight of
+                          each load report received
+        """
         super(HeartbeatListener, self).__init__()
+        self.on_report = on_report
         self.hbdict = HeartbeatDict()
         self.sock = None
         self.m = Message()
@@ -155,9 +165,11 @@ class HeartbeatListener(threading.Thread):
         while True:
             try:
                 # log.debug("Heartbeat Listening... {}".format(time.time()))
-                data, addr = self.sock.recvfrom(8)
-                if data == self.m.HEARTBEAT:
+                data, addr = self.sock.recvfrom(64)
+                if data[:1] == chr(self.m.HEARTBEAT):
                     self.hbdict[addr[0]] = time.time()
+                    if self.on_report is not None and len(data) == 1 + load_report.size:
+                        self.on_report(addr[0], *load_report.unpack_from(data, 1))
             except socket.timeout:
                 pass
 
@@ -172,13 +184,19 @@ class HeartbeatClient(UDP):
         super(HeartbeatClient, self).__init__()
         self.m = Message()
 
-    def ping(self):
+    def ping(self, capacity=None, used=None, inflight=None):
         """
-        Ping the heartbeat listener
+        Ping the heartbeat listener, reporting the chunkserver's load if it is given
 
         :rtype : object
-        """
-        self.send(self.socket, self.m.HEARTBEAT)
+        :param capacity: The bytes the chunkserver can store
+        :param used: The bytes the chunkserver stores
+        :param inflight: The number of reads and writes in progress
+        """
+        data = chr(self.m.HEARTBEAT)
+        if capacity is not None:
+            data += load_report.pack(capacity, used or 0, inflight or 0)
+        self.send(self.socket, data)
 
     def ping_forever(self):
         """
@@ -0,0 +1,220 @@
+"""
+Chunk leases. The master grants a lease on a chunk to one of the chunkservers which
+hold it, the primary, for config.lease_duration seconds. While the lease lasts the
+primary orders the appends to the chunk and assigns their offsets, so clients send
+appends straight to the primary and the master is only asked for a chunk once per
+lease rather than once per append.
+
+A primary keeps its leases by renewing them with the master before they expire. A
+revoked lease is not renewed, and no other chunkserver is granted the chunk until it
+has expired, so two primaries never believe they hold the same chunk.
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import threading
+import time
+
+import config
+
+
+class Lease(object):
+    """
+    A lease on a chunk held by its primary chunkserver
+    """
+    __slots__ = ('chunk_handle', 'primary', 'expires', 'revoked')
+
+    def __init__(self, chunk_handle, primary, expires):
+        self.chunk_handle = chunk_handle
+        self.primary = primary
+        self.expires = expires
+        self.revoked = False
+
+    def remaining(self, now=None):
+        """
+        Get the seconds left until the lease expires
+
+        :rtype : float
+        :param now:
+        """
+        return self.expires - (time.time() if now is None else now)
+
+
+class LeaseTable(object):
+    """
+    The leases the master has granted, by chunk handle and by primary
+    """
+
+    def __init__(self, duration=None):
+        """
+        :param duration: The seconds a lease lasts, defaults to config.lease_duration
+        """
+        self.duration = config.lease_duration if duration is None else duration
+        self.leases = {}
+        self.host_leases = {}
+        self._lock = threading.Lock()
+
+    def get(self, chunk_handle, now=None):
+        """
+        Get the lease on a chunk, if one is in force
+
+        :rtype : Lease
+        :param chunk_handle:
+        :param now:
+        """
+        now = time.time() if now is None else now
+        lease = self.leases.get(chunk_handle)
+        if lease is None or lease.revoked or lease.expires <= now:
+            return None
+        return lease
+
+    def outstanding(self, chunk_handle, now=None):
+        """
+        Check whether a primary may still believe it holds a lease on a chunk, including
+        a revoked lease which has not yet expired
+
+        :rtype : bool
+        :param chunk_handle:
+        :param now:
+        """
+        lease = self.leases.get(chunk_handle)
+        return lease is not None and lease.expires > (time.time() if now is None else now)
+
+    def grant(self, chunk_handle, locations, now=None):
+        """
+        Get the lease on a chunk, granting one if none is outstanding. The new primary is
+        the location which holds the fewest leases, which spreads the work of ordering
+        appends over the chunkservers.
+
+        :rtype : tuple
+        :param chunk_handle:
+        :param locations: The chunkservers which hold the chunk
+        :param now:
+        :return: a two-tuple of the lease and whether it was just granted, or (None, False)
+                 if the chunk has no location or an earlier lease has yet to expire
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            lease = self.leases.get(chunk_handle)
+            if lease is not None and lease.expires > now:
+                if lease.revoked or lease.primary not in locations:
+                    return None, False
+                return lease, False
+            if lease is not None:
+                self._drop(lease)
+            if not locations:
+                return None, False
+
+            primary = min(locations, key=lambda host: len(self.host_leases.get(host, ())))
+            lease = self.leases[chunk_handle] = Lease(chunk_handle, primary, now + self.duration)
+            self.host_leases.setdefault(primary, set()).add(chunk_handle)
+            return lease, True
+
+    def renew(self, host, chunk_handles, now=None):
+        """
+        Extend the leases a primary holds on some chunks
+
+        :rtype : list
+        :param host: The primary
+        :param chunk_handles:
+        :param now:
+        :return: the handles of the chunks whose leases were extended
+        """
+        now = time.time() if now is None else now
+        renewed = []
+        with self._lock:
+            for chunk_handle in chunk_handles:
+                lease = self.leases.get(chunk_handle)
+                if lease is not None and lease.primary == host and not lease.revoked and lease.expires > now:
+                    lease.expires = now + self.duration
+                    renewed.append(chunk_handle)
+        return renewed
+
+    def revoke(self, chunk_handle):
+        """
+        Stop renewing the lease on a chunk. No new lease is granted until it expires, or
+        until the primary acknowledges the revocation and the lease is released.
+
+        :rtype : Lease
+        :param chunk_handle:
+        :return: the revoked lease, or None if there was none
+        """
+        with self._lock:
+            lease = self.leases.get(chunk_handle)
+            if lease is not None:
+                lease.revoked = True
+            return lease
+
+    def revoke_host(self, host):
+        """
+        Stop renewing the leases held by a chunkserver
+
+        :rtype : int
+        :param host:
+        :return: the number of leases revoked
+        """
+        with self._lock:
+            chunk_handles = self.host_leases.get(host, ())
+            for chunk_handle in chunk_handles:
+                self.leases[chunk_handle].revoked = True
+            return len(chunk_handles)
+
+    def release(self, chunk_handle):
+        """
+        Forget the lease on a chunk, once its primary is known to have given it up
+
+        :rtype : None
+        :param chunk_handle:
+        """
+        with self._lock:
+            lease = self.leases.get(chunk_handle)
+            if lease is not None:
+                self._drop(lease)
+
+    def expire(self, now=None):
+        """
+        Forget the leases which have expired
+
+        :rtype : int
+        :param now:
+        :return: the number of leases forgotten
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [lease for lease in self.leases.itervalues() if lease.expires <= now]
+            for lease in expired:
+                self._drop(lease)
+            return len(expired)
+
+    def _drop(self, lease):
+        """
+        Remove a lease from the table. Must be called with the lock held.
+
+        :rtype : None
+        """
+        del self.leases[lease.chunk_handle]
+        held = self.host_leases.get(lease.primary)
+        if held is not None:
+            held.discard(lease.chunk_handle)
+            if not held:
+                del self.host_leases[lease.primary]
\ No newline at end of file
@@ -0,0 +1,206 @@
+"""
+Locks for the master's global state. RWLock is a reader-writer lock which lets
+any number of threads read at once while writers take it exclusively. StripedLocks
+spreads the keys of a map over a fixed set of RWLocks by hash, so that operations
+on different keys rarely contend, without a lock per key.
+
+Both kinds of lock are reentrant: a thread holding a lock may take it again for
+reading or writing, except that a read lock cannot be upgraded to a write lock.
+Waiting writers keep new readers out, so a steady stream of readers cannot starve
+a writer.
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+from contextlib import contextmanager
+import thread
+import threading
+
+import config
+
+
+class RWLock(object):
+    """
+    A reentrant, writer preferring reader-writer lock
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        """
+        Acquire the lock for reading, waiting while a writer holds or is waiting for it
+
+        :rtype : None
+        """
+        me = thread.get_ident()
+        with self._cond:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        """
+        Release one acquisition of the lock for reading
+
+        :rtype : None
+        """
+        me = thread.get_ident()
+        with self._cond:
+            if self._readers[me] > 1:
+                self._readers[me] -= 1
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        """
+        Acquire the lock for writing, waiting until no other thread holds it
+
+        :rtype : None
+        """
+        me = thread.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("A read lock cannot be upgraded to a write lock.")
+
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        """
+        Release one acquisition of the lock for writing
+
+        :rtype : None
+        """
+        with self._cond:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        """
+        Hold the lock for reading for the duration of a with block
+        """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """
+        Hold the lock for writing for the duration of a with block
+        """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class StripedLocks(object):
+    """
+    A fixed set of reader-writer locks shared by the keys of a map
+    """
+
+    def __init__(self, stripes=None):
+        """
+        :param stripes: The number of locks, defaults to config.lock_stripes
+        """
+        self.locks = [RWLock() for _ in range(stripes or config.lock_stripes)]
+
+    def stripe(self, key):
+        """
+        Get the lock which guards a key
+
+        :rtype : RWLock
+        :param key:
+        """
+        return self.locks[hash(key) % len(self.locks)]
+
+    def _stripes(self, keys):
+        """
+        Get the distinct locks which guard a set of keys, in a fixed order so that threads
+        locking overlapping sets of keys cannot deadlock
+
+        :rtype : list
+        :param keys:
+        """
+        return [self.locks[i] for i in sorted(set(hash(key) % len(self.locks) for key in keys))]
+
+    @contextmanager
+    def acquire(self, reads=(), writes=()):
+        """
+        Hold the locks guarding some keys for reading and others for writing for the duration
+        of a with block. A lock guarding keys of both kinds is taken for writing.
+
+        :param reads: The keys to lock for reading
+        :param writes: The keys to lock for writing
+        """
+        locks = self._stripes(list(reads) + list(writes))
+        write_locks = set(self._stripes(writes))
+        acquired = []
+        try:
+            for lock in locks:
+                if lock in write_locks:
+                    lock.acquire_write()
+                    acquired.append(lock.release_write)
+                else:
+                    lock.acquire_read()
+                    acquired.append(lock.release_read)
+            yield
+        finally:
+            for release in reversed(acquired):
+                release()
+
+    def read(self, *keys):
+        """
+        Hold the locks guarding some keys for reading for the duration of a with block
+        """
+        return self.acquire(reads=keys)
+
+    def write(self, *keys):
+        """
+        Hold the locks guarding some keys for writing for the duration of a with block
+        """
+        return self.acquire(writes=keys)
\ No newline at end of file
@@ -31,15 +31,26 @@ THE SOFTWARE.
 ###############################################################################
 """
 import os.path
-from random import choice
+import gc
+import glob
+import time
+from datetime import datetime
 import logging
 import cPickle as pickle
 import threading
+from itertools import islice
 
 import config
+import oplog
+import snapshot
+from oplog import OperationLog
 from net import MasterServer
+from client import ConnectionPool
 from message import Message
 from globalstate import GlobalState
+from placement import PlacementEngine
+from replication import ReplicationScheduler
+from lease import LeaseTable
 import heartbeat
 
 
@@ -52,6 +63,10 @@ class Master(MasterServer):
     Centralized administrator of system metadata. Initiates a global state to
     track the adding and updating of Chunks and Files. Includes (or will include) methods
     to persist global state.
+
+    Granting and revoking leases and splitting shared chunks call out to chunkservers while
+    a request is served. Those calls block for up to config.master_rpc_timeout over pooled
+    connections, holding only the worker thread serving the request on either engine.
     """
     def __init__(self, run=False):
         """
@@ -63,9 +78,22 @@ class Master(MasterServer):
         super(Master, self).__init__()
         self._m = Message()
         self.gs = GlobalState()
+        self.oplog = OperationLog(config.oplog)
+        self._checkpoint_lock = threading.Lock()
+        self.last_checkpoint = None
+        self.last_recovery = None
+        self.placement = PlacementEngine()
+        self._placement_hosts = None
+        self.heartbeat_listener = None
+        self.replication = ReplicationScheduler(self)
+        self.leases = LeaseTable()
+        self.pool = ConnectionPool(timeout=config.master_rpc_timeout)
+        self.copy_pool = ConnectionPool(max_per_host=config.replication_host_max_inflight, timeout=config.client_timeout)
         if not run:
             self.initialize_master()
             self.initialize_heart_beat_listener()
+            self.initialize_checkpointer()
+            self.initialize_replicator()
             self.run()
 
     def initialize_master(self):
@@ -78,19 +106,21 @@ class Master(MasterServer):
 
         self.check_resources()
         self.restore_state()
+        self.gs.refresh_hosts()
+        self.gs.refresh_active_hosts()
 
         log.info("Master initialized successfully")
 
-    @staticmethod
-    def initialize_heart_beat_listener():
+    def initialize_heart_beat_listener(self):
         """
-        Initialize an instance of the heartbeat listener
+        Initialize an instance of the heartbeat listener. Load reported in heartbeats is
+        passed to the placement engine.
 
         :rtype : None
         """
         log.info("Initializing heartbeat listener...")
 
-        listener = heartbeat.HeartbeatListener()
+        listener = self.heartbeat_listener = heartbeat.HeartbeatListener(on_report=self.placement.update_host)
         listener.daemon = True
         listener.start()
 
@@ -98,107 +128,324 @@ class Master(MasterServer):
 
     def run(self):
         """
-        Run the server. Initializes a socket and listens over it. Each incoming request is passed
-        to a handler thread.
+        Run the server. Initializes a socket and listens over it. Incoming connections are served
+        by the engine chosen in the configuration file.
 
         :rtype : object
         """
         log.info("Running master server")
         self.initialize_socket()
-        while True:
-            sock, addr = self.sock.accept()
-            t = threading.Thread(target=self.handle, args=(sock, addr))
-            t.daemon = True
-            t.start()
-            self.threads.add(t)
-        self.sock.close()
-        for t in self.threads:
-            t.join()
+        self.serve_forever()
 
     def handle(self, sock, address):
         """
-        Method called by the run method when the server receives an incoming request. The request
-        is parsed and delegated out accordingly.
+        Method called by the run method when the server receives an incoming connection. Each
+        request received over the connection is parsed and delegated out accordingly until the
+        client closes the connection.
 
         :rtype : object
         :param sock:
         :param address:
         """
         log.info(threading.current_thread().name)
-        sysmsg = self.recv(sock)
+        self.serve_session(sock, address)
 
+    def process(self, sysmsg, args):
+        """
+        Parse a single request and delegate it accordingly
+
+        :rtype : list
+        :param sysmsg: The message code of the request
+        :param args: The arguments of the request
+        :return: the list of reply arguments
+        """
         # ========================================
         #
         # TODO: Implement parsing and delegation
-        # FIXME: Would it make sense to have this in a loop so one connection could
-        # yield multiple actions? Or does a new connection have to be made for every
-        # new action?
         #
         # ========================================
 
-        if sysmsg == self._m.APPEND:
-            #self.append(fileName, appendSize)
-            log.info("Append received")
+        try:
+            if sysmsg == self._m.APPEND:
+                file_name, append_size = args
+                try:
+                    result = self.append(file_name, int(append_size))
+                except (IOError, OSError):
+                    log.exception("Unable to append to file '{}'".format(file_name))
+                    return [self._m.FAILURE]
+                if result is None:
+                    return [self._m.FAILURE]
+                chunk, offset = result
+                return [self._m.SUCCESS, str(chunk.chunk_handle), str(offset)] + chunk.chunkserver_locations
+
+            elif sysmsg == self._m.READ:
+                (file_name, chunk_index), prefetch = args[:2], args[2:]
+                if self.gs.get_file(file_name) is None:
+                    return [self._m.FAILURE]
+
+                # With a count, the reply holds that many chunks from the index on, each packed
+                if prefetch:
+                    count = min(int(prefetch[0]), config.read_prefetch_max)
+                    chunks = self.read_chunks(file_name, int(chunk_index), count)
+                    if chunks is None:
+                        return [self._m.FAILURE]
+                    return [self._m.SUCCESS] + [
+                        self.pack_args([str(chunk.chunk_handle), str(self.chunk_length(chunk))] +
+                                       chunk.chunkserver_locations) for chunk in chunks]
+
+                # A read past the last chunk of the file is answered without a chunk
+                chunk = self.read(file_name, int(chunk_index))
+                if chunk is None:
+                    return [self._m.SUCCESS]
+                return [self._m.SUCCESS, str(chunk.chunk_handle), str(self.chunk_length(chunk))] + \
+                    chunk.chunkserver_locations
+
+            elif sysmsg == self._m.LEASE:
+                file_name, full = args[0], args[1:]
+                if full:
+                    full_handle, length = full
+                    result = self.lease(file_name, int(full_handle), int(length))
+                else:
+                    result = self.lease(file_name)
+                if result is None:
+                    return [self._m.FAILURE]
+                chunk, lease = result
+                secondaries = [host for host in chunk.chunkserver_locations if host != lease.primary]
+                return [self._m.SUCCESS, str(chunk.chunk_handle), lease.primary,
+                        "{:.3f}".format(lease.remaining())] + secondaries
+
+            elif sysmsg == self._m.RENEW:
+                # Each chunk is reported as its handle, its length, and "1" if its lease is to be renewed
+                host, reports = args[0], args[1:]
+                if len(reports) % 3:
+                    raise ValueError("RENEW reports chunks in threes")
+                lengths = [(int(reports[i]), int(reports[i + 1])) for i in xrange(0, len(reports), 3)]
+                chunk_handles = [int(reports[i]) for i in xrange(0, len(reports), 3) if reports[i + 2] == "1"]
+                self.record_lengths(lengths, host)
+                return [self._m.SUCCESS] + [str(chunk_handle) for chunk_handle in self.leases.renew(host, chunk_handles)]
+
+            elif sysmsg == self._m.LIST:
+                # An empty cursor starts from the first name; an empty next cursor ends the listing
+                directory, options = args[0], args[1:]
+                after = options[0] if options and options[0] else None
+                limit = int(options[1]) if len(options) > 1 else None
+                recursive = len(options) > 2 and options[2] == "1"
+                result = self.list(directory, after, limit, recursive)
+                if result is None:
+                    return [self._m.FAILURE]
+                names, cursor = result
+                return [self._m.SUCCESS, cursor or ""] + names
+
+            elif sysmsg == self._m.SNAPSHOT:
+                source, target = args
+                return [self._m.SUCCESS if self.snapshot(source, target) else self._m.FAILURE]
+
+            elif sysmsg == self._m.SANITIZE:
+                #self.sanitize()
+                log.info("Sanitize received")
+
+            elif sysmsg == self._m.DELETE:
+                file_name, = args
+                return [self._m.SUCCESS if self.delete(file_name) else self._m.FAILURE]
+
+            elif sysmsg == self._m.UNDELETE:
+                file_name, = args
+                return [self._m.SUCCESS if self.undelete(file_name) else self._m.FAILURE]
+
+            elif sysmsg == self._m.CREATE:
+                file_name, = args
+                return [self._m.SUCCESS if self.create_new_file(file_name) else self._m.FAILURE]
+
+            elif sysmsg == self._m.LOOKUP:
+                file_name, = args
+                chunk_handles = self.gs.get_chunk_handles(file_name)
+                if chunk_handles is None:
+                    return [self._m.FAILURE]
+                return [self._m.SUCCESS] + [str(chunk_handle) for chunk_handle in chunk_handles]
+
+            elif sysmsg == self._m.BATCH:
+                requests = [self.unpack_args(bytearray(request)) for request in args]
+                return [self._m.SUCCESS] + [self.pack_args(reply) for reply in self.batch(requests)]
+
+            elif sysmsg == self._m.OPEN:
+                log.info("Open received")
+
+            elif sysmsg == self._m.CLOSE:
+                log.info("Close received")
+
+            elif sysmsg == self._m.WRITE:
+                log.info("Write received")
+
+            else:
+                log.warn("Message not recognized.")
+                return [self._m.FAILURE]
+
+        except ValueError:
+            log.error("Malformed request with message code {}".format(sysmsg))
+            return [self._m.FAILURE]
+
+        #========================================
 
-        elif sysmsg == self._m.READ:
-            #self.read()
-            log.info("Read received")
+        return [self._m.SUCCESS]
 
-        elif sysmsg == self._m.SANITIZE:
-            #self.sanitize()
-            log.info("Sanitize received")
+    def initialize_checkpointer(self):
+        """
+        Start a background thread which checkpoints the global state every
+        config.checkpoint_interval seconds
 
-        elif sysmsg == self._m.DELETE:
-            #self.delete()
-            log.info("Delete received")
+        :rtype : None
+        """
+        log.info("Initializing checkpointer...")
 
-        elif sysmsg == self._m.UNDELETE:
-            #self.undelete()
-            log.info("Undelete received")
+        checkpointer = threading.Thread(target=self.checkpoint_forever)
+        checkpointer.daemon = True
+        checkpointer.start()
 
-        elif sysmsg == self._m.CREATE:
-            log.info("Create received")
+        log.info("Checkpointer initialized successfully")
 
-        elif sysmsg == self._m.OPEN:
-            log.info("Open received")
+    def initialize_replicator(self):
+        """
+        Queue the chunks which are short of replicas, then start the re-replication scheduler
+        and a background thread which watches for lost chunkservers
 
-        elif sysmsg == self._m.CLOSE:
-            log.info("Close received")
+        :rtype : None
+        """
+        log.info("Initializing replicator...")
 
-        elif sysmsg == self._m.WRITE:
-            log.info("Write received")
+        # No request is served yet, so no chunk is added or removed while the map is walked
+        for chunk_handle in self.gs.get_chunk_ids():
+            self.replicate_chunk(chunk_handle)
+        self.replication.start()
 
-        else:
-            log.warn("Message not recognized.")
+        watcher = threading.Thread(target=self.watch_hosts_forever)
+        watcher.daemon = True
+        watcher.start()
 
-        #========================================
+        log.info("Replicator initialized successfully")
 
-        # FIXME: Eventually, will want to send back some kind of message.
-        sock.send("PLACEHOLDER")
+    def watch_hosts_forever(self):
+        """
+        Check the chunkservers' heartbeats periodically, and forget expired leases
 
-    def get_current_chunk(self):
+        :rtype : None
         """
-        Gets the most recent chunk in the system. If initial start up,
-        it first creates a chunk.
+        while True:
+            time.sleep(config.heartbeat_fresh_period)
+            try:
+                self.check_hosts()
+                self.leases.expire()
+            except Exception:
+                log.exception("Unable to check chunkserver heartbeats")
 
-        :rtype : object
+    def check_hosts(self):
+        """
+        Update the active hosts from the heartbeats received. A host whose heartbeats have
+        lapsed is lost, and a host which resumes them is active again.
+
+        :rtype : list
+        :return: the hosts lost
+        """
+        fresh, stale = self.heartbeat_listener.hbdict.get_entries()
+        active_hosts = self.gs.active_hosts
+        lost = [host for host in active_hosts if host in stale]
+        joined = sorted(fresh - set(active_hosts))
+        if lost or joined:
+            # The list is replaced rather than changed in place, as choose_chunk_locations expects
+            self.gs.active_hosts = [host for host in active_hosts if host not in stale] + joined
+
+        for host in lost:
+            self.lose_host(host)
+        return lost
+
+    def lose_host(self, host):
+        """
+        Forget the replicas held by a chunkserver which has been lost, and queue its chunks
+        to be re-replicated
+
+        :rtype : int
+        :param host:
+        :return: the number of chunks which lost a replica
         """
-        if self.gs.get_current_chunk == 0:
-            self.gs.add_chunk(self.gs.get_next_chunk)
-        return self.gs.get_chunk(self.gs.get_current_chunk)
+        log.warn("Chunkserver {} lost".format(host))
+        self.placement.remove_host(host)
+        self.leases.revoke_host(host)
+        chunk_handles = self.gs.get_host_chunks(host)
+        for chunk_handle in chunk_handles:
+            self.remove_replica(chunk_handle, host)
+            self.replicate_chunk(chunk_handle)
+        return len(chunk_handles)
+
+    def checkpoint_forever(self):
+        """
+        Checkpoint the global state periodically
+
+        :rtype : None
+        """
+        while True:
+            time.sleep(config.checkpoint_interval)
+            try:
+                self.global_state_snapshot()
+            except (IOError, OSError):
+                log.exception("Unable to checkpoint the global state")
 
     def global_state_snapshot(self):
         """
-        Take a snapshot of the metadata and persist it to disk
+        Take a snapshot of the metadata and persist it to disk in the snapshot module's format.
+        Only freezing the state holds the global lock for writing; copying, serializing and
+        writing it happen while requests are served. The snapshot is written to a temporary file which is
+        renamed in to place, so a crash never leaves a partial snapshot behind. Snapshots are
+        timestamped, and the newest config.checkpoint_retain of them are kept. Once the
+        snapshot is durable, the operation log records covered by the oldest snapshot kept
+        are cut from the log, so the state can be restored from any of them.
+
+        :rtype : dict
+        :return: the path, size in bytes and duration in seconds of the checkpoint
+        """
+        with self._checkpoint_lock:
+            start = time.time()
+            with self.gs.lock.write():
+                frozen = self.gs.freeze()
+                sequence = self.oplog.sequence
+            view = self.gs.checkpoint_view(frozen)
+
+            path = "{}.{}".format(config.metasnapshot, datetime.utcnow().strftime("%Y%m%dT%H%M%S%f"))
+            temp = path + '.tmp'
+            with open(temp, 'wb') as f:
+                snapshot.dump(f, sequence, view)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, path)
+
+            for old in self.list_snapshots()[:-config.checkpoint_retain]:
+                os.remove(old)
+
+            cut = sequence
+            for old in self.list_snapshots():
+                try:
+                    cut = min(cut, snapshot.read_sequence(old))
+                    break
+                except (snapshot.SnapshotError, EnvironmentError):
+                    continue
+            self.oplog.commit(sequence)
+            self.oplog.truncate(cut)
+
+            self.last_checkpoint = {
+                'path': path,
+                'size': os.path.getsize(path),
+                'duration': time.time() - start,
+                'sequence': sequence,
+            }
+            log.info("Checkpoint {path} of {size} bytes written in {duration:.3f}s".format(**self.last_checkpoint))
+            return self.last_checkpoint
 
-        :rtype : object
+    @staticmethod
+    def list_snapshots():
+        """
+        Get the paths of the retained snapshots, oldest first
+
+        :rtype : list
         """
-        # FIXME: Instead of replacing the previous snapshot, could have snapshots be incremental or
-        # timestamped, and persist them in their own directory. This could allow you to return to
-        # a state older than that of the previous snapshot. Since snapshots should be taken somewhat
-        # frequently, it is possible that keeping only the past 10? 100? 1000? would be necessary.
-        with open(config.metasnapshot, 'wb') as f:
-            pickle.dump(self.gs, f)
+        return sorted(path for path in glob.glob(config.metasnapshot + '.*') if not path.endswith('.tmp'))
 
     @staticmethod
     def check_resources():
@@ -223,24 +470,82 @@ class Master(MasterServer):
 
     def restore_state(self):
         """
-        Restore the master's global state to a previously pickled state. If loading in a
-        pickled state was unsuccessful, log the error and create a new instance of global state.
+        Restore the master's global state from the newest snapshot, then replay the operation
+        log records written after it. If loading the snapshot was unsuccessful, log the error
+        and create a new instance of global state.
 
-        :rtype : object
+        :rtype : dict
+        :return: the time taken to load the snapshot and to replay the log, in seconds
         """
-        if os.path.isfile(config.metasnapshot):
-            try:
-                self.gs = pickle.load(open(config.metasnapshot, 'rb'))
+        start = time.time()
+        sequence = self.load_snapshot()
+        loaded = time.time()
+
+        # Replay allocates only acyclic objects, and with a large state loaded every pass
+        # of the cycle collector would scan all of it
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            replayed = 0
+            for record_type, args in OperationLog.replay(config.oplog, after=sequence):
+                self.replay_operation(record_type, args)
+                replayed += 1
+        finally:
+            if collecting:
+                gc.enable()
+
+        self.last_recovery = {
+            'snapshot_seconds': loaded - start,
+            'replay_seconds': time.time() - loaded,
+            'replayed': replayed,
+        }
+        log.info("Replayed {replayed} operation log records in {replay_seconds:.3f}s".format(**self.last_recovery))
+        return self.last_recovery
+
+    def load_snapshot(self):
+        """
+        Load the global state from the newest snapshot, if there is one. A snapshot which is
+        corrupt, or which is older than the start of the operation log, is passed over for
+        the next newest. A snapshot pickled whole by an older master is loaded when no
+        timestamped snapshot exists.
+
+        :rtype : int
+        :return: the sequence number of the last operation log record covered by the snapshot
+        """
+        snapshots = self.list_snapshots()
+        if snapshots:
+            base = OperationLog.base(config.oplog)
+            for path in reversed(snapshots):
+                try:
+                    if snapshot.read_sequence(path) < base:
+                        log.error("Snapshot {} is older than the operation log, which starts after record {}".format(
+                            path, base))
+                        continue
+                    start = time.time()
+                    sequence, self.gs = snapshot.load(path)
+                except (snapshot.SnapshotError, EnvironmentError) as e:
+                    log.error("Unable to load snapshot {}: {}".format(path, e))
+                    continue
+                log.info("Loaded snapshot {} in {:.3f}s".format(path, time.time() - start))
+                return sequence
+            raise snapshot.SnapshotError("None of the {} snapshots could be restored".format(len(snapshots)))
+
+        try:
+            if os.path.isfile(config.metasnapshot) and os.path.getsize(config.metasnapshot):
+                with open(config.metasnapshot, 'rb') as f:
+                    self.gs = pickle.load(f)
+                return 0
 
-            except pickle.UnpickleableError:
-                log.error("Unable to unpickle previously pickled global state. Creating new Global State instance.")
+        except pickle.UnpickleableError:
+            log.error("Unable to unpickle previously pickled global state. Creating new Global State instance.")
 
-            except Exception as e:
-                log.error("Unable to restore previous global state. Creating new Global State instance.\n{}".format(
-                    e.message))
-                raise e
-        else:
-            self.gs = GlobalState()
+        except Exception as e:
+            log.error("Unable to restore previous global state. Creating new Global State instance.\n{}".format(
+                e.message))
+            raise e
+
+        self.gs = GlobalState()
+        return 0
 
     def update_current_chunk(self):
         """
@@ -256,19 +561,89 @@ class Master(MasterServer):
         """
         Instantiate a new File object
 
-        :rtype : object
+        :rtype : bool
         :param file_name:
         """
-        self.gs.add_file(file_name)
+        return self.mutate(oplog.ADD_FILE, 'add_file', file_name)
 
-    def create_new_chunk(self):
+    def create_new_chunk(self, file_name):
         """
         On CREATE or APPEND, master will create a new metadata Chunk
-        Object to track the new chunk.
+        Object to track the new chunk, append it to the file and choose
+        its locations.
+
+        :rtype : Chunk
+        :param file_name:
+        """
+        chunk_handle = self.gs.allocate_chunk_handle(self.log_chunk_handle_lease)
+        self.gs.add_file_chunk(file_name, chunk_handle, [])
+        self.gs.set_chunk_locations(chunk_handle, self.choose_chunk_locations(chunk_handle))
+        return self.gs.get_chunk(chunk_handle)
+
+    def log_chunk_handle_lease(self, first, last):
+        """
+        Durably log the lease of a range of chunk handles, before any handle from the range
+        is used. Only the end of the range is logged, since ranges are leased in order.
+
+        :rtype : None
+        :param first: The first handle of the range
+        :param last: The last handle of the range
+        """
+        self.oplog.log(oplog.HANDLE_RANGE, [str(last)])
+
+    def mutate(self, record_type, name, *args):
+        """
+        Apply a mutation to the global state and log it. The mutation is applied and logged
+        under the lock of the file it names, so the log holds the mutations of each file in
+        the order they were applied. Waiting for the record to become durable happens outside
+        of the lock, which lets concurrent mutations share a flush of the log.
+
+        :rtype : object
+        :param record_type: The operation log record type of the mutation
+        :param name: The GlobalState method which applies the mutation
+        :param args: The string arguments of the mutation, the first of which is a file name
+        :return: the result of the GlobalState method
+        """
+        sequence = None
+        with self.gs.locked_for_write(args[0]):
+            result = getattr(self.gs, name)(*args)
+            if result:
+                sequence = self.oplog.append(record_type, args)
+
+        self.oplog.commit(sequence)
+        return result
+
+    def replay_operation(self, record_type, args):
+        """
+        Apply a record from the operation log to the global state
 
         :rtype : None
+        :param record_type:
+        :param args:
         """
-        self.gs.add_chunk(self.gs.get_next_chunk())
+        if record_type == oplog.ADD_FILE:
+            self.gs.add_file(args[0])
+        elif record_type == oplog.QUEUE_DELETE:
+            self.gs.queue_delete(args[0])
+        elif record_type == oplog.DEQUEUE_DELETE:
+            self.gs.dequeue_delete(args[0])
+        elif record_type == oplog.ADD_CHUNK:
+            self.gs.add_file_chunk(args[0], int(args[1]), args[2:])
+        elif record_type == oplog.UPDATE_OFFSET:
+            self.gs.update_chunk_offset(int(args[0]), int(args[1]))
+        elif record_type == oplog.HANDLE_RANGE:
+            self.gs.lease_chunk_handles(int(args[0]))
+        elif record_type == oplog.LOCATIONS:
+            self.gs.set_chunk_locations(int(args[0]), args[1:])
+        elif record_type == oplog.SNAPSHOT:
+            self.gs.snapshot(args[0], args[1])
+        elif record_type == oplog.SPLIT_CHUNK:
+            self.gs.split_chunk(args[0], int(args[1]), int(args[2]), args[3:])
+        elif record_type == oplog.BATCH:
+            for record in args:
+                self.replay_operation(*oplog.unpack_record(record))
+        else:
+            log.error("Unknown operation log record type {}".format(record_type))
 
     def link_chunk_to_file(self, chunk_handle, file_name):
         """
@@ -279,107 +654,565 @@ class Master(MasterServer):
         :param chunk_handle:
         :param file_name:
         """
-        self.gs.get_file(file_name).chunk_handles.append(chunk_handle)
+        f = self.gs.get_file(file_name)
+        self.gs.preserve_file(f)
+        f.chunk_handles.append(chunk_handle)
 
-    def append(self, file_name, append_size):
+    @property
+    def batch_operations(self):
         """
-        Retrieves metadata necessary for an append to occur
+        The GlobalState methods which carry out each message code allowed in a batch
 
-        :rtype : object
+        :rtype : dict
+        """
+        return {
+            self._m.CREATE: 'add_file',
+            self._m.DELETE: 'queue_delete',
+            self._m.UNDELETE: 'dequeue_delete',
+            self._m.LOOKUP: 'get_chunk_handles',
+        }
+
+    @property
+    def batch_records(self):
+        """
+        The operation log record types of the GlobalState methods which mutate state in a batch
+
+        :rtype : dict
+        """
+        return {
+            'add_file': oplog.ADD_FILE,
+            'queue_delete': oplog.QUEUE_DELETE,
+            'dequeue_delete': oplog.DEQUEUE_DELETE,
+        }
+
+    def batch(self, requests):
+        """
+        Carry out a batch of metadata requests. The batch is applied to the global state
+        holding the locks of every file it names, and logged as a single operation log record.
+
+        Each request is a list of string arguments led by the single character message
+        code of the request. Each reply is a list led by the single character status code,
+        followed by the chunk handles for a LOOKUP.
+
+        :rtype : list
+        :param requests:
+        :return: a reply for each request, in order
+        """
+        operations = []
+        for request in requests:
+            name = self.batch_operations.get(ord(request[0])) if request and request[0] else None
+            if name is None or len(request) != 2:
+                operations.append(None)
+            else:
+                operations.append((name, request[1:]))
+
+        sequence = None
+        file_names = [args[0] for _, args in filter(None, operations)]
+        with self.gs.locked_for_write(*file_names):
+            results = self.gs.apply_batch([operation for operation in operations if operation])
+            records = [oplog.pack_record(self.batch_records[name], args)
+                       for (name, args), result in zip(filter(None, operations), results)
+                       if result and name in self.batch_records]
+            if records:
+                sequence = self.oplog.append(oplog.BATCH, records)
+
+        self.oplog.commit(sequence)
+
+        results = iter(results)
+        replies = []
+        for operation in operations:
+            result = next(results) if operation else None
+            if isinstance(result, list):
+                replies.append([chr(self._m.SUCCESS)] + [str(chunk_handle) for chunk_handle in result])
+            else:
+                replies.append([chr(self._m.SUCCESS if result else self._m.FAILURE)])
+        return replies
+
+    def append(self, file_name, append_size):
+        """
+        Reserve space for a record append to a file. The offset is reserved in the file's
+        last chunk in a single atomic step, holding the file's lock only for reading, so
+        concurrent appends to a file do not wait on each other. The client then writes the
+        data at the offset on every replica. An append which does not fit pads the rest of
+        the chunk, as in GFS record append, and goes to a new chunk; only rolling over to a
+        new chunk holds the file's lock for writing, and the replicas of the old chunk are
+        padded once it is released. While the last chunk is leased to a primary, the append
+        is refused, and must go to the primary.
+
+        :rtype : tuple
         :param file_name:
         :param append_size:
+        :return: a two-tuple of the chunk to append to and the offset to append at, or None
+                 if there is no such file, the append is larger than a chunk, or the last
+                 chunk is leased
         """
-        try:
-            chunk = self.gs.get_chunk(self.gs.get_file(file_name).chunk_handles[-1])
-            chunk.update_offset(append_size)
-        except:
-            pass
-        finally:
-            self.global_state_snapshot()
+        if not 0 <= append_size <= config.chunk_size or not self.unshare(file_name):
+            return None
+
+        padded = None
+        with self.gs.lock.read(), self.gs.locked_for_read(file_name):
+            f = self.gs.get_file(file_name)
+            if f is None:
+                return None
+            reservation = self.reserve(f, append_size)
+
+        if reservation is None:
+            with self.gs.locked_for_write(file_name):
+                f = self.gs.get_file(file_name)
+                if f is None:
+                    return None
+
+                # Another append may have rolled over to a new chunk while the lock was free
+                reservation = self.reserve(f, append_size)
+                if reservation is None:
+                    last = self.gs.get_chunk(f.chunk_handles[-1]) if f.chunk_handles else None
+                    if last is not None and last.references > 1:
+                        # A snapshot has shared the chunk since it was split, and padding it would change the snapshot
+                        return None
+                    if last is not None and self.leases.outstanding(last.chunk_handle):
+                        # The chunk's primary orders its appends, so it is not closed under the primary
+                        return None
+                    padding = 0
+                    if last is not None:
+                        self.gs.preserve_chunk(last)
+                        padding = last.pad()
+                    if padding:
+                        self.oplog.append(oplog.UPDATE_OFFSET, [str(last.chunk_handle), str(padding)])
+                        padded = last
+
+                    chunk = self.create_new_chunk(file_name)
+                    self.oplog.append(oplog.ADD_CHUNK,
+                                      [file_name, str(chunk.chunk_handle)] + chunk.chunkserver_locations)
+                    reservation = self.reserve(f, append_size)
+
+        chunk, offset, sequence = reservation
+        self.oplog.commit(sequence)
+        if padded is not None:
+            self.pad_chunk(padded)
+        if len(chunk.chunkserver_locations) < config.replica_amount:
+            self.replicate_chunk(chunk.chunk_handle, blocking=True)
+        return chunk, offset
+
+    def pad_chunk(self, chunk):
+        """
+        Pad every replica of a chunk out to the chunk's length once it is closed. A replica
+        which cannot be padded is dropped, and the chunk is copied again from one which was.
 
-    def read(self):
+        :rtype : None
+        :param chunk:
         """
+        length = str(chunk.offset())
+        for host in list(chunk.chunkserver_locations):
+            reply = self.call_chunkserver(host, self._m.PAD, str(chunk.chunk_handle), length)
+            if reply is None or reply[0] != self._m.SUCCESS:
+                log.warn("Unable to pad chunk {} on {}".format(chunk.chunk_handle, host))
+                self.remove_replica(chunk.chunk_handle, host)
+                self.replicate_chunk(chunk.chunk_handle)
+
+    def reserve(self, f, append_size):
+        """
+        Reserve space for an append in the last chunk of a file and log the reservation.
+        A chunk leased to a primary is left to the primary, which orders its appends.
+        Must be called with the global lock held for reading and the file's lock held.
 
-        :rtype : object
+        :rtype : tuple
+        :param f: The File to append to
+        :param append_size:
+        :return: a three-tuple of the chunk, the offset reserved and the sequence number of
+                 the logged reservation, or None if the append does not fit
         """
-        try:
-            pass
-        except:
-            pass
-        finally:
-            self.global_state_snapshot()
+        chunk = self.gs.get_chunk(f.chunk_handles[-1]) if f.chunk_handles else None
+        if chunk is None or chunk.references > 1 or self.leases.outstanding(chunk.chunk_handle):
+            return None
+
+        self.gs.preserve_chunk(chunk)
+        offset = chunk.reserve(append_size)
+        if offset is None:
+            return None
+        return chunk, offset, self.oplog.append(oplog.UPDATE_OFFSET, [str(chunk.chunk_handle), str(append_size)])
 
-    def delete(self):
+    def lease(self, file_name, full_handle=None, length=None):
         """
+        Get the chunk which appends to a file go to, and the lease on it. Appends are sent
+        to the lease's primary, which orders them and chooses their offsets. When the
+        primary refuses an append because it does not fit, the client passes the chunk's
+        handle and final length, the length is recorded, and a new chunk is started.
 
-        :rtype : object
+        :rtype : tuple
+        :param file_name:
+        :param full_handle: The handle of the chunk the primary reported full
+        :param length: The length of the full chunk
+        :return: a two-tuple of the chunk and its lease, or None
         """
-        try:
-            pass
-        except:
-            pass
-        finally:
-            self.global_state_snapshot()
+        if not self.unshare(file_name):
+            return None
+
+        sequence = None
+        with self.gs.locked_for_write(file_name):
+            f = self.gs.get_file(file_name)
+            if f is None:
+                return None
+
+            chunk = self.gs.get_chunk(f.chunk_handles[-1]) if f.chunk_handles else None
+            if chunk is not None and chunk.chunk_handle == full_handle:
+                self.gs.preserve_chunk(chunk)
+                size = chunk.extend(length)
+                if size:
+                    sequence = self.oplog.append(oplog.UPDATE_OFFSET, [str(chunk.chunk_handle), str(size)])
+                chunk = None
+
+            if chunk is None:
+                chunk = self.create_new_chunk(file_name)
+                sequence = self.oplog.append(oplog.ADD_CHUNK,
+                                             [file_name, str(chunk.chunk_handle)] + chunk.chunkserver_locations)
+
+        self.oplog.commit(sequence)
+        lease = self.grant_lease(chunk)
+        if lease is not None and chunk.references > 1:
+            # A snapshot shared the chunk while it was being leased, after revoking the leases
+            # on its chunks; the client asks again, and the chunk is split first
+            self.revoke_lease(chunk.chunk_handle)
+            return None
+        if lease is not None and self.replication.is_copying(chunk.chunk_handle):
+            # Appends made during the copy would be missing from the new replica
+            self.revoke_lease(chunk.chunk_handle)
+            return None
+        return (chunk, lease) if lease is not None else None
+
+    def snapshot(self, source, target):
+        """
+        Snapshot a file, or the files beneath a directory, in to a new name. Only metadata is
+        copied, so a snapshot takes time in proportion to the number of chunks rather than
+        their size. The leases on the last chunks of the files are then revoked, so the next
+        append to each asks the master, which splits the chunk before it is written to.
+
+        :rtype : bool
+        :param source:
+        :param target: The name of the snapshot, which must not exist
+        """
+        sequence = None
+        with self.gs.locked_for_write(source, target):
+            files = self.gs.snapshot(source, target)
+            if files:
+                sequence = self.oplog.append(oplog.SNAPSHOT, [source, target])
+
+        self.oplog.commit(sequence)
+        for chunk_handle in set(f.chunk_handles[-1] for f in files if f.chunk_handles):
+            if self.leases.outstanding(chunk_handle):
+                self.revoke_lease(chunk_handle)
+        return bool(files)
+
+    def unshare(self, file_name):
+        """
+        Split the last chunk of a file if it is shared with a snapshot, before it is appended
+        to. As in GFS, each chunkserver which holds the chunk copies it locally under a new
+        handle, so no chunk data crosses the network, and the file takes the copy in place
+        of the chunk.
+
+        :rtype : bool
+        :param file_name:
+        :return: False if the chunk is shared and could not be split
+        """
+        f = self.gs.get_file(file_name)
+        chunk = self.gs.get_chunk(f.chunk_handles[-1]) if f is not None and f.chunk_handles else None
+        if chunk is None or chunk.references < 2:
+            return True
 
-    def undelete(self):
+        # Appends ordered by a primary would otherwise reach the copy of only one file
+        if not self.revoke_lease(chunk.chunk_handle):
+            return False
+
+        new_handle = self.gs.allocate_chunk_handle(self.log_chunk_handle_lease)
+        locations = [host for host in list(chunk.chunkserver_locations)
+                     if self.clone_chunk(host, chunk.chunk_handle, new_handle)]
+        if not locations:
+            log.error("Unable to copy chunk {} of file '{}'".format(chunk.chunk_handle, file_name))
+            return False
+
+        sequence = None
+        with self.gs.locked_for_write(file_name):
+            if self.gs.split_chunk(file_name, chunk.chunk_handle, new_handle, locations):
+                sequence = self.oplog.append(oplog.SPLIT_CHUNK,
+                                             [file_name, str(chunk.chunk_handle), str(new_handle)] + locations)
+
+        self.oplog.commit(sequence)
+        if sequence is None:
+            # Another append split the chunk first; the copy is left for garbage collection
+            log.warn("Copy {} of chunk {} is unused".format(new_handle, chunk.chunk_handle))
+        elif len(locations) < config.replica_amount:
+            self.replicate_chunk(new_handle)
+        return True
+
+    def clone_chunk(self, host, chunk_handle, new_handle):
         """
+        Ask a chunkserver to copy its replica of a chunk locally under a new handle
 
-        :rtype : object
+        :rtype : bool
+        :param host:
+        :param chunk_handle:
+        :param new_handle:
+        """
+        reply = self.call_chunkserver(host, self._m.CLONE, str(chunk_handle), str(new_handle))
+        if reply is None:
+            log.warn("Unable to copy chunk {} on {}".format(chunk_handle, host))
+            return False
+        return reply[0] == self._m.SUCCESS
+
+    def grant_lease(self, chunk):
+        """
+        Get the lease on a chunk, granting one if none is outstanding. A new primary is told
+        of its lease before the lease is handed out; if it cannot be reached, another
+        location is tried.
+
+        :rtype : Lease
+        :param chunk:
+        :return: the lease, or None if none could be granted
+        """
+        locations = list(chunk.chunkserver_locations)
+        while True:
+            lease, granted = self.leases.grant(chunk.chunk_handle, locations)
+            if not granted:
+                return lease
+
+            secondaries = [host for host in chunk.chunkserver_locations if host != lease.primary]
+            if self.send_lease(lease.primary, chunk.chunk_handle, lease.remaining(), secondaries) is not None:
+                return lease
+            self.leases.release(chunk.chunk_handle)
+            locations.remove(lease.primary)
+
+    def revoke_lease(self, chunk_handle):
+        """
+        Revoke the lease on a chunk. If the primary acknowledges the revocation, the length
+        of the chunk it reports is recorded and the chunk may be leased again at once;
+        otherwise only once the lease expires.
+
+        :rtype : bool
+        :param chunk_handle:
+        :return: True if no primary holds the chunk any longer
+        """
+        lease = self.leases.revoke(chunk_handle)
+        if lease is None:
+            return True
+        reply = self.send_lease(lease.primary, chunk_handle, 0)
+        if reply is not None:
+            if reply:
+                self.record_length(chunk_handle, int(reply[0]), lease.primary)
+            self.leases.release(chunk_handle)
+            return True
+        return not self.leases.outstanding(chunk_handle)
+
+    def record_length(self, chunk_handle, length, host=None):
+        """
+        Record the length of a leased chunk reported by its primary. The primary chooses the
+        offsets of the appends to the chunk, so only it knows the chunk's length; it reports
+        the length as it renews its leases and as it gives one up, so the chunk can be read
+        to its end once the lease lapses. Lengths are logged, and only move forward.
+
+        :rtype : bool
+        :param chunk_handle:
+        :param length:
+        :param host: The chunkserver reporting the length, which must hold the chunk
+        :return: True if the length moved forward
+        """
+        return bool(self.record_lengths([(chunk_handle, length)], host))
+
+    def record_lengths(self, lengths, host=None):
+        """
+        Record the lengths of several chunks reported together, as a primary renewing its
+        leases does. Every length is logged before any is waited on, so a report costs a
+        single flush of the log however many chunks it covers.
+
+        :rtype : list
+        :param lengths: Two-tuples of a chunk handle and the chunk's length
+        :param host: The chunkserver reporting the lengths, which must hold the chunks
+        :return: the handles of the chunks whose length moved forward
+        """
+        sequence = None
+        extended = []
+        for chunk_handle, length in lengths:
+            with self.gs.lock.read(), self.gs.chunk_locks.write(chunk_handle):
+                chunk = self.gs.chunk_map.get(chunk_handle)
+                if chunk is None or (host is not None and host not in chunk.chunkserver_locations):
+                    continue
+                self.gs.preserve_chunk(chunk)
+                size = chunk.extend(length)
+                if size:
+                    sequence = self.oplog.append(oplog.UPDATE_OFFSET, [str(chunk_handle), str(size)])
+                    extended.append(chunk_handle)
+
+        self.oplog.commit(sequence)
+        return extended
+
+    def send_lease(self, host, chunk_handle, duration, secondaries=()):
+        """
+        Tell a chunkserver it is the primary of a chunk for some seconds, or with a
+        duration of 0, that it no longer is
+
+        :rtype : list
+        :param host:
+        :param chunk_handle:
+        :param duration:
+        :param secondaries: The other chunkservers which hold the chunk
+        :return: the rest of the chunkserver's reply, which holds the length of the chunk
+                 when a lease is given up, or None if the chunkserver did not acknowledge it
+        """
+        reply = self.call_chunkserver(host, self._m.LEASE, str(chunk_handle), "{:.3f}".format(duration), *secondaries)
+        if reply is None:
+            log.warn("Unable to send the lease on chunk {} to {}".format(chunk_handle, host))
+            return None
+        return reply[1:] if reply[0] == self._m.SUCCESS else None
+
+    def call_chunkserver(self, host, sysmsg, *args):
+        """
+        Make a call to a chunkserver over a pooled connection. The call is made while a
+        request is served, so it gives up after config.master_rpc_timeout rather than the
+        longer client timeout.
+
+        :rtype : list
+        :param host:
+        :param sysmsg:
+        :param args:
+        :return: the chunkserver's reply, or None if it could not be reached
         """
         try:
-            pass
-        except:
-            pass
-        finally:
-            self.global_state_snapshot()
+            with self.pool.connection(host) as conn:
+                return conn.call(sysmsg, *args)
+        except (IOError, RuntimeError):
+            return None
 
-    def append_lock(self):
+    def read(self, file_name, chunk_index):
         """
-        Get a thread lock on a chunk to initiate a synchronous append on the chunk
+        Retrieves the metadata of a chunk of a file for a read to occur. A chunk short of
+        replicas is boosted in the re-replication queue, since a client is waiting on it.
 
-        :rtype : object
+        :rtype : Chunk
+        :param file_name:
+        :param chunk_index: The position of the chunk within the file
         """
-        pass
+        f = self.gs.get_file(file_name)
+        if f is None or not 0 <= chunk_index < len(f.chunk_handles):
+            return None
+        chunk = self.gs.get_chunk(f.chunk_handles[chunk_index])
+        if chunk is not None and len(chunk.chunkserver_locations) < config.replica_amount:
+            self.replicate_chunk(chunk.chunk_handle, blocking=True)
+        return chunk
+
+    def read_chunks(self, file_name, chunk_index, count):
+        """
+        Retrieves the metadata of a run of chunks of a file, so a client reading the file
+        sequentially need not ask for each chunk
 
-    def append_unlock(self):
+        :rtype : list
+        :param file_name:
+        :param chunk_index: The position of the first chunk within the file
+        :param count: The greatest number of chunks to retrieve
+        :return: the chunks, fewer than count at the end of the file, or None if there is no such file
         """
-        Remove the thread lock on a chunk to allow other threads append access to the chunk
+        f = self.gs.get_file(file_name)
+        if f is None:
+            return None
+        if chunk_index < 0:
+            return []
+
+        chunks = filter(None, [self.gs.get_chunk(chunk_handle)
+                               for chunk_handle in f.chunk_handles[chunk_index:chunk_index + count]])
+        if chunks and len(chunks[0].chunkserver_locations) < config.replica_amount:
+            self.replicate_chunk(chunks[0].chunk_handle, blocking=True)
+        return chunks
+
+    def list(self, directory, after=None, limit=None, recursive=False):
+        """
+        List a page of a directory. Only the page is built, so listing a large namespace
+        holds neither a lock nor a copy of the names between pages.
+
+        :rtype : tuple
+        :param directory:
+        :param after: The cursor returned with the previous page, or None for the first page
+        :param limit: The largest number of names in the page, at most config.list_page_max
+        :param recursive: List the paths of the files at any depth beneath the directory,
+                          rather than the names of its children
+        :return: a two-tuple of the names and the cursor of the next page, which is None
+                 after the last page, or None if there is no such directory
+        """
+        limit = min(limit or config.list_page_size, config.list_page_max)
+        if recursive:
+            if not self.gs.namespace.is_directory(directory):
+                return None
+            names = list(islice(self.gs.get_file_names(directory, after), limit))
+        else:
+            names = self.gs.list_directory(directory, after, limit)
+            if names is None:
+                return None
+        return names, names[-1] if len(names) == limit else None
 
-        :rtype : object
+    def chunk_length(self, chunk):
         """
-        pass
+        Get the length of a chunk to tell readers. The primary of a leased chunk knows its
+        length, so a leased chunk is read to its end.
 
-    def read_lock(self):
+        :rtype : int
+        :param chunk:
         """
-        Get a thread lock on a chink to initiate a synchronous read on the chunk
+        return -1 if self.leases.outstanding(chunk.chunk_handle) else chunk.offset()
 
-        :rtype : object
+    def delete(self, file_name):
         """
-        pass
+        Mark a file for deletion. The file is removed by the scrubber later on, and may be
+        undeleted until then.
 
-    def read_unlock(self):
+        :rtype : bool
+        :param file_name:
         """
-        Remove the thread lock on a chunk to allow other threads read access to the chunk
+        return self.mutate(oplog.QUEUE_DELETE, 'queue_delete', file_name)
 
-        :rtype : object
+    def undelete(self, file_name):
         """
-        pass
+        Remove the deletion mark from a file
 
-    def is_append_locked(self):
+        :rtype : bool
+        :param file_name:
         """
-        Check to see if a chunk has an active append lock
+        return self.mutate(oplog.DEQUEUE_DELETE, 'dequeue_delete', file_name)
 
-        :rtype : object
+    def add_replica(self, chunk_handle, host):
         """
-        pass
+        Record a new replica of a chunk
 
-    def is_read_locked(self):
+        :rtype : bool
+        :param chunk_handle:
+        :param host:
         """
-        Check to see if a chunk has an active read lock
+        return self.change_replicas('add_chunk_location', chunk_handle, host)
 
-        :rtype : object
+    def remove_replica(self, chunk_handle, host):
         """
-        pass
+        Forget a replica of a chunk
+
+        :rtype : bool
+        :param chunk_handle:
+        :param host:
+        """
+        return self.change_replicas('remove_chunk_location', chunk_handle, host)
+
+    def change_replicas(self, name, chunk_handle, host):
+        """
+        Change the locations of a chunk and log its new locations, under the chunk's lock so
+        the log holds the changes in the order they were applied
+
+        :rtype : bool
+        :param name: The GlobalState method which changes the locations
+        :param chunk_handle:
+        :param host:
+        """
+        sequence = None
+        with self.gs.lock.read(), self.gs.chunk_locks.write(chunk_handle):
+            result = getattr(self.gs, name)(chunk_handle, host)
+            if result:
+                sequence = self.oplog.append(oplog.LOCATIONS,
+                                             [str(chunk_handle)] + self.get_chunk_locations(chunk_handle))
+
+        self.oplog.commit(sequence)
+        return bool(result)
 
     def delete_chunk(self):
         """
@@ -406,7 +1239,7 @@ class Master(MasterServer):
         :rtype : list
         :param chunk_handle:
         """
-        return self.gs.chunk_map[chunk_handle].chunkserverLocations
+        return self.gs.chunk_map[chunk_handle].chunkserver_locations
 
     def number_of_replicas(self, chunk_handle):
         """
@@ -417,44 +1250,54 @@ class Master(MasterServer):
         """
         return len(self.get_chunk_locations(chunk_handle))
 
-    def choose_chunk_locations(self, chunk_handle):
+    def choose_chunk_locations(self, chunk_handle, count=None, exclude=()):
         """
-        Choose locations for a chunk to be stored. Currently there is no
-        load balancing in place to determine which chunkservers get chunks
+        Choose locations for the replicas a chunk is missing. The placement engine chooses
+        among the active hosts by their load, spreading the replicas over racks.
 
-        :rtype : object
+        :rtype : list
         :param chunk_handle:
+        :param count: The number of locations to choose, defaults to the number of replicas missing
+        :param exclude: Hosts not to choose, besides those the chunk already occupies
+        :return: the new locations, which do not include those the chunk already occupies
         """
-        # TODO: Implement load balancing
-
         current_locations = self.get_chunk_locations(chunk_handle)
-        num_of_locs = self.number_of_replicas(chunk_handle)
-        # In the case that an appropriate number of replicas exist,
+        num_of_locs = len(current_locations)
         if num_of_locs >= config.replica_amount:
-            return
-        else:
-            amnt_of_locs_needed = config.replica_amount - num_of_locs
-            active_hosts = self.gs.active_hosts
-            new_locations = []
+            return []
+        count = min(count or config.replica_amount, config.replica_amount - num_of_locs)
 
-            # Remove the locations the chunk already occupies
-            for host in current_locations:
-                active_hosts.remove(host)
+        # The active hosts list is replaced, never changed in place, when it is refreshed
+        active_hosts = self.gs.active_hosts
+        if active_hosts is not self._placement_hosts:
+            self.placement.sync_hosts(active_hosts)
+            self._placement_hosts = active_hosts
 
-            # Choose new locations for the chunk
-            for num in range(amnt_of_locs_needed):
-                loc = choice(active_hosts)
-                new_locations.append(loc)
-                active_hosts.remove(loc)
+        return self.placement.choose(count, exclude=list(current_locations) + list(exclude))
 
-            return new_locations
+    def replicate_chunk(self, chunk_handle, blocking=False):
+        """
+        Queue a chunk to be re-replicated if it is short of replicas
 
-    def replicate_chunk(self):
+        :rtype : bool
+        :param chunk_handle:
+        :param blocking: Whether a client is waiting on the chunk, which boosts its priority
         """
+        return self.replication.enqueue(chunk_handle, blocking)
 
-        :rtype : object
+    def copy_chunk(self, chunk_handle, source, target):
         """
-        pass
+        Ask a chunkserver to copy its replica of a chunk to another chunkserver. Copies go over
+        a pool of their own, as a copy moves a whole chunk and waits up to config.client_timeout
+        rather than the timeout of the calls made while a request is served.
+
+        :rtype : bool
+        :param chunk_handle:
+        :param source: The chunkserver holding a replica
+        :param target: The chunkserver to copy the replica to
+        """
+        with self.copy_pool.connection(source) as conn:
+            return conn.call(self._m.REPLICATE, str(chunk_handle), target)[0] == self._m.SUCCESS
 
     def sanitize(self):
         """
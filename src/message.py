@@ -31,20 +31,33 @@ THE SOFTWARE.
 
 class Message(object):
     """
-    Message codes for intra-system communications
+    Message codes for intra-system communications. Each code fits in the single
+    opcode byte of a frame header.
     """
     def __init__(self):
-        self.FAILURE = '0'
-        self.SUCCESS = '1'
-        self.READ = '2'
-        self.APPEND = '3'
-        self.DELETE = '4'
-        self.UNDELETE = '5'
-        self.SANITIZE = '6'
-        self.CREATE = '7'
-        self.OPEN = '8'
-        self.CLOSE = '9'
-        self.WRITE = '10'
-        self.CONTENTS = '11'
-        self.CHUNKSPACE = '12'
-        self.HEARTBEAT = '13'
+        self.FAILURE = 0
+        self.SUCCESS = 1
+        self.READ = 2
+        self.APPEND = 3
+        self.DELETE = 4
+        self.UNDELETE = 5
+        self.SANITIZE = 6
+        self.CREATE = 7
+        self.OPEN = 8
+        self.CLOSE = 9
+        self.WRITE = 10
+        self.CONTENTS = 11
+        self.CHUNKSPACE = 12
+        self.HEARTBEAT = 13
+        self.BUSY = 14
+        self.BATCH = 15
+        self.LOOKUP = 16
+        self.HELLO = 17
+        self.REPLICATE = 18
+        self.LEASE = 19
+        self.FULL = 20
+        self.RENEW = 21
+        self.LIST = 22
+        self.SNAPSHOT = 23
+        self.CLONE = 24
+        self.PAD = 25
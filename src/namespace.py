@@ -0,0 +1,300 @@
+"""
+The master's namespace as a tree of directories, as in GFS. File names are paths
+whose components are separated by '/'; each directory holds its files and
+subdirectories, so a directory is listed in time proportional to its children
+rather than to the number of files in the system. Directories are created
+implicitly by the files beneath them.
+
+The tree does no locking of its own. Callers lock paths with the locks returned
+by ancestors: an operation on a path holds the locks of the directories above it
+for reading, and the lock of the path itself for reading or writing. Since
+creating a file only reads its directory, files may be created concurrently in
+the same directory, while a file cannot be created beneath a directory which is
+being written.
+
+Directories are listed in pages. The first listing of a directory builds a sorted
+index of its names, which is then kept up to date as children are added and removed,
+so a page is found by bisecting the index rather than by sorting the directory again.
+A listing resumes after the last name of the previous page, so it tolerates children
+created or removed between pages, and holds no lock while the caller consumes it.
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import bisect
+import threading
+
+
+def components(path):
+    """
+    Split a path in to its non-empty components
+
+    :rtype : list
+    :param path:
+    """
+    return [name for name in path.split('/') if name]
+
+
+def ancestors(path):
+    """
+    Get the paths of the directories above a path, outermost first
+
+    :rtype : list
+    :param path:
+    """
+    return [path[:i] for i in range(1, len(path)) if path[i] == '/' and path[i - 1] != '/']
+
+
+def parent(path):
+    """
+    Get the path of the directory holding a path, or '' for the root
+
+    :rtype : str
+    :param path:
+    """
+    above = ancestors(path)
+    return above[-1] if above else ''
+
+
+class Directory(dict):
+    """
+    A directory of a namespace. Maps the names of its children to either a nested
+    directory or the entry stored for a file. A directory once listed also keeps a sorted
+    index of the names, which goes away with the directory.
+    """
+    __slots__ = ('index',)
+
+    def __init__(self):
+        super(Directory, self).__init__()
+        self.index = None
+
+
+class Namespace(object):
+    """
+    A tree of directories, rooted at a Directory
+    """
+
+    def __init__(self):
+        self.root = Directory()
+        self._index_lock = threading.Lock()
+
+    def _index(self, directory):
+        """
+        Get the sorted index of the names in a directory, building it on first use
+
+        :rtype : list
+        :param directory:
+        """
+        with self._index_lock:
+            if directory.index is None:
+                # keys() copies the names in one step, so a concurrent create cannot disturb the sort
+                directory.index = sorted(directory.keys())
+            return directory.index
+
+    def _index_add(self, directory, name):
+        """
+        Add a name to the index of a directory, if it has one. The name must already be
+        in the directory, so that an index built concurrently either holds it or is
+        built before it is added here.
+
+        :rtype : None
+        """
+        with self._index_lock:
+            index = directory.index
+            if index is not None:
+                i = bisect.bisect_left(index, name)
+                if i == len(index) or index[i] != name:
+                    index.insert(i, name)
+
+    def _index_remove(self, directory, name):
+        """
+        Remove a name from the index of a directory, if it has one
+
+        :rtype : None
+        """
+        with self._index_lock:
+            index = directory.index
+            if index is not None:
+                i = bisect.bisect_left(index, name)
+                if i < len(index) and index[i] == name:
+                    del index[i]
+
+    def _names(self, directory, after=None):
+        """
+        Iterate over the names in a directory in order, starting after a name. The index
+        is searched afresh for each name, so names added or removed while iterating are
+        seen or skipped without disturbing the iteration.
+
+        :rtype : generator
+        :param directory:
+        :param after: The name to start after, or None to start from the first name
+        """
+        index = self._index(directory)
+        while True:
+            with self._index_lock:
+                i = 0 if after is None else bisect.bisect_right(index, after)
+                if i >= len(index):
+                    return
+                after = index[i]
+            yield after
+
+    def _directory(self, names, create=False):
+        """
+        Get the directory at a list of path components
+
+        :rtype : Directory
+        :param names:
+        :param create: Create missing directories along the way
+        :return: the directory, or None if it does not exist or a file is in the way
+        """
+        directory = self.root
+        for name in names:
+            child = directory.get(name)
+            if child is None and create:
+                created = Directory()
+                child = directory.setdefault(name, created)
+                if child is created:
+                    self._index_add(directory, name)
+            if not isinstance(child, dict):
+                return None
+            directory = child
+        return directory
+
+    def add(self, path, entry):
+        """
+        Add a file to the tree, creating the directories above it
+
+        :rtype : bool
+        :param path:
+        :param entry: The object stored for the file
+        :return: True if the file was added, False if the path is already taken
+        """
+        names = components(path)
+        if not names:
+            return False
+
+        directory = self._directory(names[:-1], create=True)
+        if directory is None or directory.setdefault(names[-1], entry) is not entry:
+            return False
+        self._index_add(directory, names[-1])
+        return True
+
+    def remove(self, path):
+        """
+        Remove a file from the tree. The directories above it are kept.
+
+        :rtype : object
+        :param path:
+        :return: the entry stored for the file, or None if there is no such file
+        """
+        names = components(path)
+        directory = self._directory(names[:-1]) if names else None
+        if directory is None or isinstance(directory.get(names[-1], {}), dict):
+            return None
+        entry = directory.pop(names[-1])
+        self._index_remove(directory, names[-1])
+        return entry
+
+    def get(self, path):
+        """
+        Get the entry stored for a file
+
+        :rtype : object
+        :param path:
+        :return: the entry, or None if there is no such file
+        """
+        names = components(path)
+        directory = self._directory(names[:-1]) if names else None
+        entry = directory.get(names[-1]) if directory is not None else None
+        return None if isinstance(entry, dict) else entry
+
+    def is_directory(self, path):
+        """
+        Check whether a path is a directory
+
+        :rtype : bool
+        :param path:
+        """
+        return self._directory(components(path)) is not None
+
+    def list(self, path='', after=None, limit=None):
+        """
+        List the children of a directory in name order, a page at a time. The names of
+        subdirectories end with '/'.
+
+        :rtype : list
+        :param path:
+        :param after: The name to list after, as the last name of the previous page
+        :param limit: The largest number of names to list, or None for all of them
+        :return: the names of the children, or None if the directory does not exist
+        """
+        directory = self._directory(components(path))
+        if directory is None:
+            return None
+
+        index = self._index(directory)
+        with self._index_lock:
+            start = 0 if after is None else bisect.bisect_right(index, after.rstrip('/'))
+            names = index[start:] if limit is None else index[start:start + limit]
+        return [name + '/' if isinstance(directory.get(name), dict) else name for name in names]
+
+    def walk(self, path='', after=None):
+        """
+        Iterate over the files beneath a directory, at any depth, in path order
+
+        :rtype : generator
+        :param path:
+        :param after: The path of a file relative to the directory to resume after, as
+                      the last path of an earlier walk
+        :return: a generator of two-tuples of the path of each file, relative to the
+                 directory, and its entry
+        """
+        directory = self._directory(components(path))
+        if directory is None:
+            return iter(())
+        return self._walk(directory, '', components(after) if after else [])
+
+    def _walk(self, directory, prefix, after):
+        """
+        Iterate over the files beneath a directory node, in path order
+
+        :rtype : generator
+        :param directory:
+        :param prefix: The path of the directory, to prefix to the names of its files
+        :param after: The components of the path to resume after, relative to the directory
+        """
+        start = after[0] if after else None
+        if len(after) > 1:
+            child = directory.get(start)
+            if isinstance(child, dict):
+                for sub_path, entry in self._walk(child, prefix + start + '/', after[1:]):
+                    yield sub_path, entry
+
+        for name in self._names(directory, start):
+            child = directory.get(name)
+            if isinstance(child, dict):
+                for sub_path, entry in self._walk(child, prefix + name + '/', []):
+                    yield sub_path, entry
+            elif child is not None:
+                yield prefix + name, child
\ No newline at end of file
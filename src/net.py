@@ -27,56 +27,625 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 ###############################################################################
 """
+import os
 import socket
+import select
+import errno
+import collections
+import itertools
 import logging
 import struct
+import threading
+import time
+import Queue
+import zlib
+from contextlib import contextmanager
 
 import config
+from message import Message
 
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("net_logger")
 
 
+@contextmanager
+def corked(sock):
+    """
+    Hold back partial packets on a socket while several buffers are written to it, then
+    flush them. Does nothing where TCP_CORK is unavailable.
+
+    :param sock:
+    """
+    cork = getattr(socket, 'TCP_CORK', None)
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        cork = None
+    if cork is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, cork, 1)
+    try:
+        yield
+    finally:
+        if cork is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, cork, 0)
+
+
+def configure_socket(sock):
+    """
+    Disable Nagle's algorithm on a connected socket. Frames are written whole, so there
+    is nothing to gain from delaying small writes.
+
+    :rtype : object
+    :param sock:
+    """
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def coalesce(parts, limit):
+    """
+    Join runs of adjacent strings in a list of frame parts in to strings of up to limit
+    bytes, so that small replies queued together are written together. Any other parts,
+    such as file regions and partially sent buffers, are left as they are.
+
+    :rtype : list
+    :param parts:
+    :param limit:
+    """
+    coalesced = []
+    pending = []
+    pending_size = 0
+    for part in parts:
+        joinable = isinstance(part, str)
+        if not joinable or pending_size + len(part) > limit:
+            if pending:
+                coalesced.append("".join(pending) if len(pending) > 1 else pending[0])
+                pending, pending_size = [], 0
+            if not joinable or len(part) >= limit:
+                coalesced.append(part)
+                continue
+
+        pending.append(part)
+        pending_size += len(part)
+
+    if pending:
+        coalesced.append("".join(pending) if len(pending) > 1 else pending[0])
+    return coalesced
+
+
 class BaseServer(object):
     """
     A class to act as the base server for the ChunkServer and MasterServer classes.
     Contains methods for network send and recieve.
+
+    Every message travels as a single frame: a fixed size binary header carrying the
+    message code, flags, a request id and the payload length, followed by the payload.
+    The payload packs all of the arguments of the message, each prefixed with its
+    length. Connections are persistent, so a connection may carry any number of
+    requests. Replies carry the status code in place of the message code and echo
+    the id of the request they answer, which lets a client pipeline requests and
+    match the replies as they arrive.
+
+    A client may open a connection with a HELLO request listing the options it
+    supports. If both sides support zlib, APPEND requests and READ replies over the
+    connection are compressed whenever that pays off, which is marked by the
+    COMPRESSED flag in the frame header.
     """
+    COALESCE_SIZE = 2 ** 12
+    COMPRESSED = 0x01
+
     def __init__(self):
         self.struct = struct.Struct('!L')
+        self.header = struct.Struct('!BBLL')
+        self._m = Message()
 
-    def send(self, socket, data):
+    def send(self, socket, opcode, args=(), request_id=0, flags=0, compress=False):
         """
-        Send method which first sends the length of the data
+        Send a message and all of its arguments as a single frame. A frame made of a single
+        part goes out in one call. Otherwise the parts are written in turn without copying
+        them together, using sendmsg where it exists, or corking the socket so the parts
+        still leave in full packets.
 
         :rtype : object
         :param socket:
-        :param data:
+        :param opcode: The message code, or the status code of a reply
+        :param args: A sequence of string or FileRegion arguments
+        :param request_id: The id of the request, echoed by its reply
+        :param flags:
+        :param compress: Whether the payload may be compressed
         """
-        data_length = len(data)
-        socket.send(self.struct.pack(data_length))
+        parts = self.frame_parts(opcode, args, request_id, flags, compress)
+        if len(parts) == 1:
+            socket.sendall(parts[0])
+        elif hasattr(socket, 'sendmsg') and not any(isinstance(part, FileRegion) for part in parts):
+            self.sendmsg_all(socket, parts)
+        else:
+            with corked(socket):
+                for part in parts:
+                    if isinstance(part, FileRegion):
+                        part.send(socket)
+                    else:
+                        socket.sendall(part)
 
-        total_sent = 0
-        while total_sent < data_length:
-            sent = socket.send(data[total_sent:])
-            if not sent:
-                raise RuntimeError("Socket connection was broken.")
-            total_sent += sent
+    @staticmethod
+    def sendmsg_all(socket, parts):
+        """
+        Write a list of buffers with as few sendmsg calls as the socket allows
 
-    def recv(self, socket):
+        :rtype : None
+        :param socket:
+        :param parts:
+        """
+        views = [memoryview(part) for part in parts]
+        while views:
+            sent = socket.sendmsg(views)
+            while sent:
+                if sent < len(views[0]):
+                    views[0] = views[0][sent:]
+                    break
+                sent -= len(views.pop(0))
+
+    def frame_parts(self, opcode, args=(), request_id=0, flags=0, compress=False):
         """
-        Receive method which first gets the length of the file to receive
+        Pack a message and all of its arguments into a frame. The frame is returned as a
+        list of parts. The header, the argument lengths and small arguments are coalesced
+        in to strings. Arguments of at least COALESCE_SIZE bytes are left as parts of their
+        own, so they are never copied, and FileRegion arguments are left to be streamed
+        from their file when the frame is sent.
+
+        :rtype : list
+        :param opcode: The message code, or the status code of a reply
+        :param args: A sequence of string or FileRegion arguments
+        :param request_id: The id of the request, echoed by its reply
+        :param flags:
+        :param compress: Whether the payload may be compressed
+        """
+        payload = self.compress_payload(args) if compress else None
+        if payload is not None:
+            header = self.header.pack(opcode, flags | self.COMPRESSED, request_id, len(payload))
+            if len(payload) < self.COALESCE_SIZE:
+                return [header + payload]
+            return [header, payload]
+
+        payload_length = sum(self.struct.size + len(arg) for arg in args)
+        parts = []
+        pending = [self.header.pack(opcode, flags, request_id, payload_length)]
+        for arg in args:
+            pending.append(self.struct.pack(len(arg)))
+            if isinstance(arg, FileRegion) or len(arg) >= self.COALESCE_SIZE:
+                parts.append("".join(pending))
+                parts.append(arg)
+                pending = []
+            else:
+                pending.append(arg)
+
+        if pending:
+            parts.append("".join(pending))
+        return parts
+
+    def compress_payload(self, args):
+        """
+        Compress the packed arguments of a frame if that is worthwhile. Payloads smaller
+        than config.compression_threshold are left alone, as are payloads whose leading
+        bytes barely compress, which catches data that is already compressed without
+        spending the time to compress all of it. A FileRegion is compressed a block at a
+        time as it is read from its file, so only the compressed payload is held in memory,
+        and compressing stops as soon as the output outgrows the payload.
 
         :rtype : str
+        :param args: A sequence of string or FileRegion arguments
+        :return: the compressed payload, or None if the payload should be sent as it is
+        """
+        data_length = sum(len(arg) for arg in args)
+        if data_length < config.compression_threshold:
+            return None
+        payload_length = data_length + self.struct.size * len(args)
+
+        sample = []
+        remaining = config.compression_sample_size
+        for arg in args:
+            if remaining <= 0:
+                break
+            sample.append(arg.read(remaining) if isinstance(arg, FileRegion) else arg[:remaining])
+            remaining -= len(sample[-1])
+
+        sample = "".join(sample)
+        if len(zlib.compress(sample, 1)) > len(sample) * config.compression_min_ratio:
+            return None
+
+        compressor = zlib.compressobj(config.compression_level)
+        compressed, compressed_length = [], 0
+        for arg in args:
+            blocks = arg.blocks() if isinstance(arg, FileRegion) else (arg,)
+            for block in itertools.chain((self.struct.pack(len(arg)),), blocks):
+                compressed.append(compressor.compress(block))
+                compressed_length += len(compressed[-1])
+                if compressed_length >= payload_length:
+                    return None
+
+        compressed.append(compressor.flush())
+        if compressed_length + len(compressed[-1]) >= payload_length:
+            return None
+
+        for arg in args:
+            if isinstance(arg, FileRegion):
+                arg.close()
+        return "".join(compressed)
+
+    def decode_payload(self, flags, payload):
+        """
+        Unpack the arguments of a received frame, decompressing them first if needed. A
+        compressed payload is only expanded up to config.max_frame_size, and a frame
+        which would expand past that is refused.
+
+        :rtype : list
+        :param flags: The flags from the frame header
+        :param payload: A bytearray holding the payload
+        """
+        if flags & self.COMPRESSED:
+            decompressor = zlib.decompressobj()
+            expanded = decompressor.decompress(buffer(payload), config.max_frame_size + 1)
+            if len(expanded) > config.max_frame_size or decompressor.unconsumed_tail:
+                raise RuntimeError("Compressed frame is larger than {} bytes".format(config.max_frame_size))
+            payload = bytearray(expanded)
+        return self.unpack_args(payload)
+
+    def recv(self, socket):
+        """
+        Receive a single frame. The header is read in to a fixed size buffer and the
+        payload in to a buffer preallocated from the length given by the header, once the
+        length is checked against config.max_frame_size. Returns None if the peer closed
+        the connection between frames.
+
+        :rtype : tuple
         :param socket:
+        :return: a four-tuple of the message code, flags, request id and argument list
         """
-        data = ""
-        data_length = self.struct.unpack(socket.recv(4))[0]
-        while len(data) < data_length:
-            data += socket.recv(data_length - len(data))
+        header = bytearray(self.header.size)
+        if not self.recv_into(socket, memoryview(header)):
+            return None
 
-        return data
+        opcode, flags, request_id, payload_length = self.header.unpack_from(header)
+        self.check_frame_length(payload_length)
+
+        payload = bytearray(payload_length)
+        if payload_length and not self.recv_into(socket, memoryview(payload)):
+            raise RuntimeError("Socket connection was broken.")
+
+        return opcode, flags, request_id, self.decode_payload(flags, payload)
+
+    @staticmethod
+    def check_frame_length(payload_length):
+        """
+        Refuse a frame whose header gives a payload longer than config.max_frame_size,
+        before any room is made for the payload
+
+        :rtype : None
+        :param payload_length:
+        """
+        if payload_length > config.max_frame_size:
+            raise RuntimeError("Frame of {} bytes is larger than {} bytes".format(
+                payload_length, config.max_frame_size))
+
+    @staticmethod
+    def recv_into(socket, view):
+        """
+        Fill a buffer from the socket. Returns False if the peer closed the connection
+        before any of the bytes arrived.
+
+        :rtype : bool
+        :param socket:
+        :param view: A writable memoryview of the buffer to fill
+        """
+        total_received = 0
+        while total_received < len(view):
+            received = socket.recv_into(view[total_received:])
+            if not received:
+                if not total_received:
+                    return False
+                raise RuntimeError("Socket connection was broken.")
+            total_received += received
+
+        return True
+
+    def pack_args(self, args):
+        """
+        Pack a sequence of string arguments into a single length-prefixed payload
+
+        :rtype : str
+        :param args:
+        """
+        return "".join(self.struct.pack(len(arg)) + arg for arg in args)
+
+    def unpack_args(self, payload):
+        """
+        Unpack a payload created by pack_args back into a list of string arguments
+
+        :rtype : list
+        :param payload: A bytearray holding the packed arguments
+        """
+        view = memoryview(payload)
+        args = []
+        start = 0
+        while start < len(payload):
+            arg_length = self.struct.unpack_from(payload, start)[0]
+            start += self.struct.size
+            args.append(view[start:start + arg_length].tobytes())
+            start += arg_length
+
+        return args
+
+    def handle(self, sock, address):
+        """
+        Serve a newly accepted connection. Servers may override this to do their own
+        bookkeeping around serve_session.
+
+        :rtype : None
+        :param sock:
+        :param address:
+        """
+        self.serve_session(sock, address)
+
+    def serve_session(self, sock, address):
+        """
+        Serve requests over a persistent connection until the peer closes it. Each
+        request is passed to process, and its reply is tagged with the request id.
+
+        :rtype : None
+        :param sock:
+        :param address:
+        """
+        log.debug("Session opened with {}".format(address))
+        session = Session()
+        try:
+            while self.serve_frame(sock, session):
+                pass
+        except (socket.error, RuntimeError) as e:
+            log.warn("Session with {} ended unexpectedly: {}".format(address, e))
+        finally:
+            sock.close()
+            log.debug("Session closed with {}".format(address))
+
+    def serve_frame(self, sock, session):
+        """
+        Serve a single request received over a connection
+
+        :rtype : bool
+        :param sock:
+        :param session: The Session holding the options of the connection
+        :return: False if the peer closed the connection instead of sending a request
+        """
+        frame = self.recv(sock)
+        if frame is None:
+            return False
+
+        opcode, flags, request_id, args = frame
+        reply, compress = self.respond(session, opcode, args)
+        self.send(sock, reply[0], reply[1:], request_id, compress=compress)
+        return True
+
+    def respond(self, session, sysmsg, args):
+        """
+        Work out the reply to a request received over a connection. HELLO requests set the
+        options of the connection and are answered here. Every other request is passed to
+        process.
+
+        :rtype : tuple
+        :param session: The Session holding the options of the connection
+        :param sysmsg: The message code of the request
+        :param args: The arguments of the request
+        :return: a two-tuple of the reply and whether the reply may be compressed
+        """
+        if sysmsg == self._m.HELLO:
+            session.compress = config.compression and 'zlib' in args
+            return [self._m.SUCCESS] + (['zlib'] if session.compress else []), False
+
+        return self.process(sysmsg, args), session.compress and sysmsg == self._m.READ
+
+    def process(self, sysmsg, args):
+        """
+        Process a single request and return its status code followed by the reply
+        arguments. Servers override this method; a server which does not answers every
+        request as a message it does not recognize.
+
+        :rtype : list
+        :param sysmsg: The message code of the request
+        :param args: The arguments of the request
+        """
+        log.warn("Message not recognized")
+        return [self._m.FAILURE]
+
+
+class FileRegion(object):
+    """
+    A byte range of an open file which is sent as a frame argument straight from the file
+    to the socket. os.sendfile is used where it exists, so the data never passes through
+    Python memory. Otherwise the range is copied through a single reusable buffer.
+
+    The range is clamped to the size of the file when the region is created, so data
+    appended to the file afterwards does not change the length of the frame.
+    """
+    BLOCK_SIZE = 2 ** 16
+
+    def __init__(self, f, offset=0, size=-1):
+        available = max(0, os.fstat(f.fileno()).st_size - offset)
+        self.file = f
+        self.offset = offset
+        self.size = available if size < 0 else min(size, available)
+        self._buffer = None
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        """
+        Read the region, or its first size bytes, in to memory without consuming it
+
+        :rtype : str
+        :param size:
+        """
+        self.file.seek(self.offset)
+        return self.file.read(self.size if size < 0 else min(size, self.size))
+
+    def blocks(self):
+        """
+        Read the region in blocks of at most BLOCK_SIZE bytes without consuming it
+
+        :rtype : generator
+        """
+        offset, end = self.offset, self.offset + self.size
+        while offset < end:
+            self.file.seek(offset)
+            block = self.file.read(min(self.BLOCK_SIZE, end - offset))
+            if not block:
+                raise RuntimeError("File region ended before all of its bytes were read.")
+            offset += len(block)
+            yield block
+
+    def send(self, sock):
+        """
+        Send the whole region over a blocking socket, then close the file
+
+        :rtype : None
+        :param sock:
+        """
+        try:
+            while self.size:
+                self.send_some(sock)
+        finally:
+            self.close()
+
+    def send_some(self, sock):
+        """
+        Send as much of the region as the socket will take in a single call
+
+        :rtype : int
+        :param sock:
+        :return: the number of bytes sent
+        """
+        if hasattr(os, 'sendfile'):
+            sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.size)
+        else:
+            if self._buffer is None:
+                self._buffer = bytearray(min(self.size, self.BLOCK_SIZE))
+            self.file.seek(self.offset)
+            read = self.file.readinto(self._buffer)
+            sent = sock.send(memoryview(self._buffer)[:min(read, self.size)]) if read else 0
+
+        if not sent:
+            raise RuntimeError("File region ended before all of its bytes were sent.")
+
+        self.offset += sent
+        self.size -= sent
+        return sent
+
+    def close(self):
+        """
+        Close the file the region belongs to
+
+        :rtype : None
+        """
+        self.file.close()
+
+
+class Session(object):
+    """
+    The options negotiated for a connection by a HELLO request
+    """
+    __slots__ = ('compress',)
+
+    def __init__(self):
+        self.compress = False
+
+
+class Connection(BaseServer):
+    """
+    The client side of a connection. Requests may be pipelined from any number of threads:
+    submit sends a request and returns its id without waiting, and result waits for the
+    reply with that id, buffering any replies which arrive for other requests.
+
+    Call negotiate after connecting to agree on compression with the server.
+    """
+
+    def __init__(self, host, port=config.PORT, timeout=None):
+        super(Connection, self).__init__()
+        self.address = (host, port)
+        self.sock = configure_socket(socket.create_connection(self.address, timeout))
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._recv_lock = threading.Lock()
+        self._replies = {}
+        self.busy = self._m.BUSY
+        self.compress = False
+
+    def negotiate(self):
+        """
+        Agree on the options of the connection with the server. Compression is requested
+        if it is enabled in the configuration file.
+
+        :rtype : None
+        """
+        reply = self.call(self._m.HELLO, *(['zlib'] if config.compression else []))
+        self.compress = reply[0] == self._m.SUCCESS and 'zlib' in reply[1:]
+
+    def submit(self, sysmsg, *args):
+        """
+        Send a request without waiting for its reply
+
+        :rtype : int
+        :param sysmsg: The message code of the request
+        :param args: The arguments of the request
+        :return: the id of the request
+        """
+        with self._id_lock:
+            self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+            request_id = self._next_id
+
+        compress = self.compress and sysmsg == self._m.APPEND
+        with self._send_lock:
+            self.send(self.sock, sysmsg, args, request_id, compress=compress)
+        return request_id
+
+    def result(self, request_id):
+        """
+        Wait for the reply to a submitted request
+
+        :rtype : list
+        :param request_id:
+        :return: the status code of the reply followed by the reply arguments
+        """
+        while True:
+            with self._recv_lock:
+                if request_id in self._replies:
+                    return self._replies.pop(request_id)
+
+                frame = self.recv(self.sock)
+                if frame is None:
+                    raise RuntimeError("Socket connection was broken.")
+
+                status, flags, reply_id, args = frame
+                if status == self.busy and not reply_id:
+                    raise ServerBusyError("Server at {} is busy.".format(self.address))
+                self._replies[reply_id] = [status] + args
+
+    def call(self, sysmsg, *args):
+        """
+        Send a request and wait for its reply
+
+        :rtype : list
+        :param sysmsg: The message code of the request
+        :param args: The arguments of the request
+        """
+        return self.result(self.submit(sysmsg, *args))
+
+    def close(self):
+        """
+        Close the connection
+
+        :rtype : None
+        """
+        self.sock.close()
 
 
 class UDP(object):
@@ -124,6 +693,564 @@ class UDP(object):
         return data
 
 
+class ServerBusyError(RuntimeError):
+    """
+    Raised by a Connection when the server rejected it because its work queue was full
+    """
+
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads fed from a bounded queue. Work submitted while the
+    queue is full is refused rather than queued, so the thread count and the memory held
+    by waiting work both stay bounded under load.
+    """
+
+    def __init__(self, target, worker_count, queue_size):
+        self.target = target
+        self.queue = Queue.Queue(queue_size)
+        self.threads = set()
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        for _ in range(worker_count):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.add(t)
+
+    def submit(self, *args):
+        """
+        Queue work for the workers
+
+        :rtype : bool
+        :param args: The arguments to call the target with
+        :return: True if the work was queued, False if the queue was full
+        """
+        try:
+            self.queue.put_nowait(args)
+        except Queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+        with self._lock:
+            self.accepted += 1
+        return True
+
+    def work(self):
+        """
+        Take work from the queue forever
+
+        :rtype : None
+        """
+        while True:
+            args = self.queue.get()
+            with self._lock:
+                self.active += 1
+            try:
+                self.target(*args)
+            except Exception as e:
+                log.exception("Worker failed: {}".format(e))
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+    def stats(self):
+        """
+        Get the current load on the pool
+
+        :rtype : dict
+        """
+        with self._lock:
+            return {
+                'workers': len(self.threads),
+                'active_workers': self.active,
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+            }
+
+
+def readable(sock):
+    """
+    Check without waiting whether a socket has data to read, or has been closed by its peer
+
+    :rtype : bool
+    :param sock:
+    """
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLIN)
+    return bool(poller.poll(0))
+
+
+class ThreadedEngine(object):
+    """
+    Serves requests with a pool of config.worker_count handler threads, fed through a
+    queue holding at most config.worker_queue_size connections with requests waiting.
+    When the queue is full the connection is sent a BUSY status and closed.
+
+    A worker serves a connection only while requests are waiting on it. A newly accepted
+    connection is parked with a poller thread until its first request arrives, and once a
+    connection falls idle it is parked again, so neither a client which connects and sends
+    nothing nor an idle persistent connection holds a worker.
+    A request is read with a timeout of config.client_timeout seconds, so a client which
+    stalls part way through a frame cannot hold a worker either. Connections left idle
+    for config.server_idle_timeout seconds are closed.
+    """
+    SWEEP_INTERVAL = 1.0
+
+    def __init__(self, server):
+        self.server = server
+        self.pool = WorkerPool(self.serve, config.worker_count, config.worker_queue_size)
+        self.server.threads = self.pool.threads
+        if hasattr(select, 'epoll'):
+            self.poller, self._poll_timeout = select.epoll(), self.SWEEP_INTERVAL
+        else:
+            # poll takes its timeout in milliseconds rather than seconds
+            self.poller, self._poll_timeout = select.poll(), self.SWEEP_INTERVAL * 1000
+        self.parked = {}
+        self._parking = []
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = os.pipe()
+
+    def serve_forever(self):
+        """
+        Accept connections and park each one until its first request arrives
+
+        :rtype : None
+        """
+        t = threading.Thread(target=self.poll_forever)
+        t.daemon = True
+        t.start()
+
+        while True:
+            sock, addr = self.server.sock.accept()
+            configure_socket(sock)
+            sock.settimeout(config.client_timeout)
+            self.park(sock, addr, Session())
+
+    def dispatch(self, sock, address, session):
+        """
+        Pass a connection with a request waiting to the worker pool
+
+        :rtype : None
+        """
+        if not self.pool.submit(sock, address, session):
+            self.reject(sock, address)
+
+    def serve(self, sock, address, session):
+        """
+        Serve the requests waiting on a connection, then park it until the next one arrives
+
+        :rtype : None
+        :param sock:
+        :param address:
+        :param session: The Session holding the options of the connection
+        """
+        try:
+            while self.server.serve_frame(sock, session):
+                if not readable(sock):
+                    self.park(sock, address, session)
+                    return
+        except (socket.error, RuntimeError) as e:
+            log.warn("Session with {} ended unexpectedly: {}".format(address, e))
+        sock.close()
+
+    def park(self, sock, address, session):
+        """
+        Hand a connection with no request waiting to the poller thread
+
+        :rtype : None
+        """
+        with self._lock:
+            self._parking.append((sock, address, session))
+        os.write(self._wake_write, 'x')
+
+    def poll_forever(self):
+        """
+        Watch the parked connections, passing each to the pool when a request arrives on
+        it, and closing those left idle too long
+
+        :rtype : None
+        """
+        self.poller.register(self._wake_read, select.POLLIN)
+        swept = time.time()
+        while True:
+            try:
+                events = self.poller.poll(self._poll_timeout)
+            except (IOError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            now = time.time()
+            for fd, _ in events:
+                if fd == self._wake_read:
+                    os.read(self._wake_read, 4096)
+                    with self._lock:
+                        parking, self._parking = self._parking, []
+                    for sock, address, session in parking:
+                        self.parked[sock.fileno()] = (sock, address, session, now)
+                        self.poller.register(sock.fileno(), select.POLLIN)
+                    continue
+
+                entry = self.parked.pop(fd, None)
+                if entry is not None:
+                    self.poller.unregister(fd)
+                    self.dispatch(*entry[:3])
+
+            if now - swept >= self.SWEEP_INTERVAL:
+                swept = now
+                for fd, (sock, address, _, since) in self.parked.items():
+                    if now - since > config.server_idle_timeout:
+                        del self.parked[fd]
+                        self.poller.unregister(fd)
+                        sock.close()
+
+    def reject(self, sock, address):
+        """
+        Tell a client that the server is too busy to serve it, then close its connection
+
+        :rtype : None
+        :param sock:
+        :param address:
+        """
+        log.warn("Rejecting connection from {}, work queue is full".format(address))
+        try:
+            self.server.send(sock, Message().BUSY)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def stats(self):
+        """
+        Get the current load on the engine
+
+        :rtype : dict
+        """
+        stats = self.pool.stats()
+        stats['idle_connections'] = len(self.parked)
+        return stats
+
+
+class EventLoopEngine(object):
+    """
+    Serves every connection from a single thread using non-blocking sockets and epoll
+    (or poll where epoll is unavailable). A connection costs only its buffers, so
+    tens of thousands of idle or slow clients can be held open at once.
+
+    Requests are decoded from each connection's input buffer on the loop thread and
+    passed to the server's process method on a pool of config.worker_count threads, so a
+    request which blocks, on a disk flush or a call to another server, holds up neither
+    the loop nor the other connections. The requests of a connection are processed one
+    at a time, in the order they arrived. Each reply is handed back to the loop, queued on
+    its connection and written as the socket becomes writable. A request which finds the
+    work queue full is answered with a BUSY status.
+    """
+    READ_SIZE = 2 ** 16
+
+    def __init__(self, server):
+        self.server = server
+        self.connections = {}
+        self.poller = select.epoll() if hasattr(select, 'epoll') else select.poll()
+        self.read_buffer = bytearray(self.READ_SIZE)
+        self.pool = WorkerPool(self.serve, config.worker_count, config.worker_queue_size)
+        self.server.threads = self.pool.threads
+        self._m = Message()
+        self._done = []
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = os.pipe()
+
+    def serve_forever(self):
+        """
+        Run the event loop
+
+        :rtype : None
+        """
+        listener = self.server.sock
+        listener.setblocking(0)
+        self.poller.register(listener.fileno(), select.POLLIN)
+        self.poller.register(self._wake_read, select.POLLIN)
+
+        while True:
+            for fd, event in self.poll():
+                if fd == listener.fileno():
+                    self.accept(listener)
+                    continue
+                if fd == self._wake_read:
+                    self.finish()
+                    continue
+
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+
+                try:
+                    if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                        self.read(conn)
+                    if event & select.POLLOUT and conn.fd in self.connections:
+                        self.write(conn)
+                except (socket.error, RuntimeError) as e:
+                    log.warn("Connection with {} ended unexpectedly: {}".format(conn.address, e))
+                    self.close(conn)
+                except Exception as e:
+                    log.exception("Failed to serve connection with {}: {}".format(conn.address, e))
+                    self.close(conn)
+
+    def stats(self):
+        """
+        Get the current load on the engine
+
+        :rtype : dict
+        """
+        stats = self.pool.stats()
+        stats['connections'] = len(self.connections)
+        return stats
+
+    def poll(self):
+        """
+        Wait for socket events
+
+        :rtype : list
+        """
+        try:
+            return self.poller.poll()
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def accept(self, listener):
+        """
+        Accept every pending connection on the listening socket
+
+        :rtype : None
+        :param listener:
+        """
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            sock.setblocking(0)
+            configure_socket(sock)
+            conn = EventConnection(sock, addr)
+            self.connections[conn.fd] = conn
+            self.poller.register(conn.fd, select.POLLIN)
+
+    def read(self, conn):
+        """
+        Read whatever is available from a connection and queue each complete request
+
+        :rtype : None
+        :param conn:
+        """
+        try:
+            received = conn.sock.recv_into(self.read_buffer)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        if not received:
+            self.close(conn)
+            return
+
+        conn.inbuf += memoryview(self.read_buffer)[:received]
+
+        header = self.server.header
+        start = 0
+        while len(conn.inbuf) - start >= header.size:
+            opcode, flags, request_id, payload_length = header.unpack_from(conn.inbuf, start)
+            self.server.check_frame_length(payload_length)
+            end = start + header.size + payload_length
+            if len(conn.inbuf) < end:
+                break
+
+            args = self.server.decode_payload(flags, conn.inbuf[start + header.size:end])
+            start = end
+            conn.pending.append((opcode, request_id, args))
+
+        del conn.inbuf[:start]
+
+        self.dispatch(conn)
+        if conn.outbuf:
+            self.write(conn)
+
+    def dispatch(self, conn):
+        """
+        Pass the next request waiting on a connection to the worker pool, unless one is
+        already being processed. HELLO requests only set the options of the connection, so
+        they are answered on the loop thread.
+
+        :rtype : None
+        :param conn:
+        """
+        while conn.pending and not conn.busy:
+            opcode, request_id, args = conn.pending.popleft()
+            if opcode == self._m.HELLO:
+                reply, compress = self.server.respond(conn, opcode, args)
+                conn.outbuf.extend(self.server.frame_parts(reply[0], reply[1:], request_id, compress=compress))
+            elif self.pool.submit(conn, opcode, request_id, args):
+                conn.busy = True
+            else:
+                log.warn("Refusing a request from {}, work queue is full".format(conn.address))
+                conn.outbuf.extend(self.server.frame_parts(self._m.BUSY, (), request_id))
+
+    def serve(self, conn, opcode, request_id, args):
+        """
+        Process a request on a worker thread and hand its reply back to the loop
+
+        :rtype : None
+        :param conn:
+        :param opcode:
+        :param request_id:
+        :param args:
+        """
+        try:
+            reply, compress = self.server.respond(conn, opcode, args)
+            parts = self.server.frame_parts(reply[0], reply[1:], request_id, compress=compress)
+        except Exception as e:
+            log.exception("Failed to process a request from {}: {}".format(conn.address, e))
+            parts = self.server.frame_parts(self._m.FAILURE, (), request_id)
+
+        with self._lock:
+            self._done.append((conn, parts))
+            wake = len(self._done) == 1
+        if wake:
+            os.write(self._wake_write, 'x')
+
+    def finish(self):
+        """
+        Queue the replies the workers have handed back on their connections, and pass the
+        next request of each connection to the pool. Replies to connections which have
+        since been closed are dropped.
+
+        :rtype : None
+        """
+        os.read(self._wake_read, 4096)
+        with self._lock:
+            done, self._done = self._done, []
+
+        for conn, parts in done:
+            conn.busy = False
+            if self.connections.get(conn.fd) is not conn:
+                for data in parts:
+                    if isinstance(data, FileRegion):
+                        data.close()
+                continue
+
+            conn.outbuf.extend(parts)
+            self.dispatch(conn)
+            try:
+                self.write(conn)
+            except socket.error as e:
+                log.warn("Connection with {} ended unexpectedly: {}".format(conn.address, e))
+                self.close(conn)
+
+    def write(self, conn):
+        """
+        Write as much of the queued output as the connection will take, and only wait
+        for the connection to become writable while output remains queued
+
+        :rtype : None
+        :param conn:
+        """
+        if len(conn.outbuf) > 1:
+            conn.outbuf = coalesce(conn.outbuf, self.READ_SIZE)
+
+        while conn.outbuf:
+            data = conn.outbuf[0]
+            try:
+                if isinstance(data, FileRegion):
+                    data.send_some(conn.sock)
+                    if data.size:
+                        continue
+                    data.close()
+                    conn.outbuf.pop(0)
+                    continue
+
+                sent = conn.sock.send(data)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            if sent < len(data):
+                conn.outbuf[0] = buffer(data, sent)
+                break
+            conn.outbuf.pop(0)
+
+        events = select.POLLIN | select.POLLOUT if conn.outbuf else select.POLLIN
+        if events != conn.events:
+            self.poller.modify(conn.fd, events)
+            conn.events = events
+
+    def close(self, conn):
+        """
+        Close a connection and stop watching it
+
+        :rtype : None
+        :param conn:
+        """
+        self.connections.pop(conn.fd, None)
+        try:
+            self.poller.unregister(conn.fd)
+        except (IOError, KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+        for data in conn.outbuf:
+            if isinstance(data, FileRegion):
+                data.close()
+
+
+class EventConnection(Session):
+    """
+    The state kept by the EventLoopEngine for each connection
+    """
+    __slots__ = ('sock', 'fd', 'address', 'inbuf', 'outbuf', 'events', 'pending', 'busy')
+
+    def __init__(self, sock, address):
+        super(EventConnection, self).__init__()
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = []
+        self.events = select.POLLIN
+        self.pending = collections.deque()
+        self.busy = False
+
+
+ENGINES = {
+    'threaded': ThreadedEngine,
+    'eventloop': EventLoopEngine,
+}
+
+
+def get_engine(server):
+    """
+    Create the server engine named by config.server_engine for a server
+
+    :rtype : object
+    :param server:
+    """
+    try:
+        engine = ENGINES[config.server_engine]
+    except KeyError:
+        raise ValueError("Unknown server engine '{}'".format(config.server_engine))
+    return engine(server)
+
+
 class ChunkServer(BaseServer):
     """
     Base server class for chunkservers. Handles all networking logic that chunkservers use.
@@ -137,6 +1264,7 @@ class ChunkServer(BaseServer):
         self.port = config.PORT
         self.host = config.HOST
         self.sock = None
+        self.engine = None
         self.threads = set()
 
     def initialize_socket(self):
@@ -150,7 +1278,7 @@ class ChunkServer(BaseServer):
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sock.bind((self.host, self.port))
-            self.sock.listen(10)
+            self.sock.listen(config.listen_backlog)
         except socket.error, (value, message):
             if self.sock:
                 self.sock.close()
@@ -158,11 +1286,30 @@ class ChunkServer(BaseServer):
             print "Unable to open socket: " + message
             print "Error value: " + str(value)
 
+    def serve_forever(self):
+        """
+        Serve connections on the initialized socket with the engine chosen by
+        config.server_engine
+
+        :rtype : None
+        """
+        self.engine = get_engine(self)
+        self.engine.serve_forever()
+
+    def stats(self):
+        """
+        Get the current load on the server's engine
+
+        :rtype : dict
+        """
+        return self.engine.stats() if self.engine else {}
+
 
 class MasterServer(BaseServer):
     """
     Base server class for the Master class. Handles all networking logic that the Master class
-    uses. MasterServer is a multi-threaded TCP server.
+    uses. MasterServer is a multi-threaded or event-driven TCP server, depending on the engine
+    chosen in the configuration file.
     """
 
     def __init__(self):
@@ -170,6 +1317,7 @@ class MasterServer(BaseServer):
         self._port = config.PORT
         self._host = config.HOST
         self.sock = None
+        self.engine = None
         self.threads = set()
         log.info("INITIALIZED SERVER BASE")
 
@@ -184,10 +1332,28 @@ class MasterServer(BaseServer):
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sock.bind((self._host, self._port))
-            self.sock.listen(10)
+            self.sock.listen(config.listen_backlog)
         except socket.error, (value, message):
             if self.sock:
                 self.sock.close()
             # TODO: LOG and provide means for graceful failure
             print "Unable to open socket: " + message
-            print "Error value: " + str(value)
\ No newline at end of file
+            print "Error value: " + str(value)
+
+    def serve_forever(self):
+        """
+        Serve connections on the initialized socket with the engine chosen by
+        config.server_engine
+
+        :rtype : None
+        """
+        self.engine = get_engine(self)
+        self.engine.serve_forever()
+
+    def stats(self):
+        """
+        Get the current load on the server's engine
+
+        :rtype : dict
+        """
+        return self.engine.stats() if self.engine else {}
\ No newline at end of file
@@ -0,0 +1,408 @@
+"""
+The operation log is the master's durable record of metadata mutations. Every
+change to the global state is appended to the log as a small binary record, so
+the cost of persisting an operation is proportional to the operation rather than
+to the size of the namespace. On restart, the log is replayed on top of the most
+recent snapshot of the global state.
+
+Records are written by a single flusher thread using group commit: records
+appended by any number of handler threads are gathered for up to
+config.oplog_flush_interval seconds, then written and fsynced together. A handler
+waits for the flush which covers its record before replying to its client.
+
+Each record is laid out as:
+
+    [payload length: 4 bytes][crc32 of payload: 4 bytes][payload]
+
+where the payload is a single byte record type followed by the arguments of the
+operation, each prefixed with its 4 byte length.
+
+Records are numbered from 1 in the order they are appended. The log is kept in
+segments: when a checkpoint is taken, the file being appended to is sealed by
+renaming it after the number of its last record, and a new file is started with a
+CHECKPOINT record holding that number, so that numbering carries on across
+segments. Once a checkpoint is durable, the sealed segments it covers are deleted;
+no record is ever rewritten, so cutting the log never holds up a flush.
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+import logging
+
+import config
+
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("oplog_logger")
+
+
+# Record types
+ADD_FILE = 1
+QUEUE_DELETE = 2
+DEQUEUE_DELETE = 3
+ADD_CHUNK = 4
+UPDATE_OFFSET = 5
+BATCH = 6
+CHECKPOINT = 7
+HANDLE_RANGE = 8
+LOCATIONS = 9
+SNAPSHOT = 10
+SPLIT_CHUNK = 11
+
+
+_header = struct.Struct('!LL')
+_length = struct.Struct('!L')
+
+
+def pack_record(record_type, args):
+    """
+    Pack a record type and its string arguments in to a record payload
+
+    :rtype : str
+    :param record_type:
+    :param args:
+    """
+    return chr(record_type) + "".join(_length.pack(len(arg)) + arg for arg in args)
+
+
+def unpack_record(payload):
+    """
+    Unpack a record payload back in to its record type and arguments
+
+    :rtype : tuple
+    :param payload:
+    """
+    args = []
+    start = 1
+    while start < len(payload):
+        arg_length = _length.unpack_from(payload, start)[0]
+        start += _length.size
+        args.append(payload[start:start + arg_length])
+        start += arg_length
+
+    return ord(payload[0]), args
+
+
+class OperationLog(object):
+    """
+    An append-only log of metadata mutations with group commit
+    """
+
+    def __init__(self, path, flush_interval=None):
+        self.path = path
+        self.flush_interval = config.oplog_flush_interval if flush_interval is None else flush_interval
+
+        sequence = 0
+        for sequence, _, _ in self.scan(path):
+            pass
+
+        segments = self.segments(path)
+        self.file = open(path, 'ab')
+        if sequence and not self.file.tell():
+            # A crash while sealing a segment left no file to append to
+            self._start(sequence)
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._appended = sequence
+        self._durable = sequence
+        self._written = sequence
+        self._base = segments[-1][0] if segments else 0
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+        self._flusher = threading.Thread(target=self._flush_forever)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def append(self, record_type, args):
+        """
+        Queue a record to be written without waiting for it to become durable. Records are
+        written in the order in which they are appended.
+
+        :rtype : int
+        :param record_type:
+        :param args: The string arguments of the record
+        :return: the sequence number of the record, to be passed to commit
+        """
+        record = self.frame(pack_record(record_type, args))
+        with self._cond:
+            if self._closed:
+                raise IOError("Operation log is closed.")
+            self._pending.append(record)
+            self._appended += 1
+            self._cond.notify_all()
+            return self._appended
+
+    def commit(self, sequence):
+        """
+        Wait until the record with a sequence number, and every record before it, is durable
+
+        :rtype : None
+        :param sequence: A sequence number returned by append, or None to return at once
+        """
+        if sequence is None:
+            return
+
+        with self._cond:
+            while self._durable < sequence and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise IOError("Operation log could not be written: {}".format(self._error))
+
+    @property
+    def sequence(self):
+        """
+        The sequence number of the most recently appended record
+
+        :rtype : int
+        """
+        with self._cond:
+            return self._appended
+
+    def truncate(self, sequence):
+        """
+        Cut the records up to and including a sequence number from the log. The file being
+        appended to is sealed first, then every sealed segment whose records are all covered
+        is deleted. Records after the sequence number which share a segment with records
+        before it are kept until a later truncation.
+
+        :rtype : None
+        :param sequence: The sequence number of the last record covered by a checkpoint
+        """
+        self.commit(sequence)
+        self.rotate()
+
+        for last, segment in self.segments(self.path):
+            if last <= sequence:
+                os.remove(segment)
+
+    def rotate(self):
+        """
+        Seal the file being appended to as a segment, named after the number of its last
+        record, and start a new one. Only renaming the file and writing the first record of
+        the new one hold up the flusher. Nothing is done if no record was written since the
+        last rotation.
+
+        :rtype : None
+        """
+        with self._write_lock:
+            if self._written == self._base:
+                return
+
+            self.file.close()
+            os.rename(self.path, "{}.{}".format(self.path, self._written))
+            self.file = open(self.path, 'ab')
+            self._start(self._written)
+            self._base = self._written
+
+    def _start(self, sequence):
+        """
+        Begin a new file with the number of the last record before it
+
+        :rtype : None
+        :param sequence:
+        """
+        self.file.write(self.frame(pack_record(CHECKPOINT, [str(sequence)])))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def log(self, record_type, args):
+        """
+        Append a record and wait for it to become durable
+
+        :rtype : None
+        :param record_type:
+        :param args:
+        """
+        self.commit(self.append(record_type, args))
+
+    def close(self):
+        """
+        Write any pending records and close the log
+
+        :rtype : None
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        self.file.close()
+
+    def _flush_forever(self):
+        """
+        Write and fsync the pending records in batches until the log is closed
+
+        :rtype : None
+        """
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+
+            # Leave the batch open for a while so that concurrent records share the fsync
+            if self.flush_interval:
+                time.sleep(self.flush_interval)
+
+            with self._cond:
+                batch, self._pending = self._pending, []
+                sequence = self._appended
+
+            try:
+                with self._write_lock:
+                    self.file.write("".join(batch))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self._written = sequence
+            except (IOError, OSError) as e:
+                log.error("Unable to write to the operation log: {}".format(e))
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._durable = sequence
+                self._cond.notify_all()
+
+    @staticmethod
+    def frame(payload):
+        """
+        Prefix a record payload with its length and checksum
+
+        :rtype : str
+        :param payload:
+        """
+        return _header.pack(len(payload), zlib.crc32(payload) & 0xFFFFFFFF) + payload
+
+    @staticmethod
+    def segments(path):
+        """
+        Get the sealed segments of a log, oldest first
+
+        :rtype : list
+        :param path:
+        :return: two-tuples of the number of the last record in a segment and its path
+        """
+        directory, name = os.path.split(path)
+        directory = directory or os.curdir
+        if not os.path.isdir(directory):
+            return []
+
+        segments = []
+        for entry in os.listdir(directory):
+            suffix = entry[len(name) + 1:]
+            if entry.startswith(name + '.') and suffix.isdigit():
+                segments.append((int(suffix), os.path.join(directory, entry)))
+        return sorted(segments)
+
+    @staticmethod
+    def base(path):
+        """
+        Get the number of the last record cut from a log. The log holds every record after it.
+
+        :rtype : int
+        :param path:
+        """
+        for sequence, record_type, args in OperationLog.scan(path):
+            return sequence if record_type == CHECKPOINT else sequence - 1
+        return 0
+
+    @staticmethod
+    def replay(path, after=0):
+        """
+        Read the operations in a log in order
+
+        :rtype : generator
+        :param path:
+        :param after: Skip the records up to and including this sequence number, which are
+                      already covered by the checkpoint being replayed on to
+        :return: a generator of two-tuples of the record type and its arguments
+        """
+        for sequence, record_type, args in OperationLog.scan(path):
+            if sequence > after and record_type != CHECKPOINT:
+                yield record_type, args
+
+    @staticmethod
+    def scan(path):
+        """
+        Read the records of a log in order, from its sealed segments and then from the file
+        being appended to. Reading a file stops at the first incomplete or corrupt record,
+        which is what a crash in the middle of a write leaves behind. That record is cut from
+        the file, so that records appended later are not lost behind it.
+
+        :rtype : generator
+        :param path:
+        :return: a generator of three-tuples of the sequence number, record type and arguments
+        """
+        sequence = 0
+        for _, segment in OperationLog.segments(path) + [(None, path)]:
+            for sequence, record_type, args in OperationLog._scan_file(segment, sequence):
+                yield sequence, record_type, args
+
+    @staticmethod
+    def _scan_file(path, sequence):
+        """
+        Read the records of a single file of a log
+
+        :rtype : generator
+        :param path:
+        :param sequence: The number of the last record before the file
+        """
+        if not os.path.isfile(path):
+            return
+
+        with open(path, 'rb') as f:
+            while True:
+                end = f.tell()
+                header = f.read(_header.size)
+                if not header:
+                    return
+
+                payload = None
+                if len(header) == _header.size:
+                    payload_length, crc = _header.unpack(header)
+                    payload = f.read(payload_length)
+                    if len(payload) < payload_length or zlib.crc32(payload) & 0xFFFFFFFF != crc:
+                        payload = None
+
+                if payload is None:
+                    log.warn("Truncating incomplete or corrupt record at byte {} of {}".format(end, path))
+                    with open(path, 'r+b') as w:
+                        w.truncate(end)
+                    return
+
+                record_type, args = unpack_record(payload)
+                if record_type == CHECKPOINT:
+                    sequence = int(args[0])
+                else:
+                    sequence += 1
+                yield sequence, record_type, args
\ No newline at end of file
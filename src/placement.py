@@ -0,0 +1,291 @@
+"""
+Replica placement for new and re-replicated chunks. Each chunkserver is scored by
+how full it is, how many chunks were recently placed on it and how much I/O it has
+in flight, and the scores are kept in a heap, so the best hosts are found in
+O(log n) rather than by scanning or picking at random. Placing a chunk on a host
+raises its score, which keeps a newly added, empty chunkserver from taking every
+new chunk until it fills up.
+
+Replicas of a chunk are spread over as many racks (failure domains) as possible.
+A host's rack is read from config.racks, a file of "host rack" lines; a host that
+is not listed is its own rack.
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import heapq
+import math
+import os.path
+import threading
+import time
+
+import config
+
+
+class HostLoad(object):
+    """
+    The load on a chunkserver as last reported, along with the chunks recently placed on it
+    """
+    __slots__ = ('host', 'rack', 'capacity', 'used', 'inflight', 'recent', 'updated', 'version')
+
+    def __init__(self, host, rack):
+        self.host = host
+        self.rack = rack
+        self.capacity = None
+        self.used = 0
+        self.inflight = 0
+        self.recent = 0.0
+        self.updated = time.time()
+        self.version = 0
+
+    def decay(self, now):
+        """
+        Decay the count of recent placements, halving it every config.placement_half_life seconds
+
+        :rtype : None
+        :param now:
+        """
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.recent *= math.pow(0.5, elapsed / config.placement_half_life)
+            self.updated = now
+
+    def score(self):
+        """
+        Score the host for placement. Lower is better.
+
+        :rtype : float
+        """
+        utilization = float(self.used) / self.capacity if self.capacity else 0.0
+        if self.capacity is not None and self.capacity - self.used < config.chunk_size:
+            return float('inf')
+        return (utilization + config.placement_recent_weight * self.recent +
+                config.placement_inflight_weight * self.inflight)
+
+
+class PlacementEngine(object):
+    """
+    Chooses chunkservers for replicas. The heap holds a (score, version, host) entry for
+    every host, and an entry is replaced rather than updated when the host's score changes;
+    entries whose version is out of date are dropped as they reach the top. Recent
+    placements decay with time while entries sit in the heap, so every host is decayed and
+    scored again each config.placement_rescore_interval seconds.
+    """
+
+    def __init__(self, racks=None):
+        """
+        :param racks: A dict of host to rack, defaults to the contents of config.racks
+        """
+        self.racks = self.read_racks() if racks is None else racks
+        self.loads = {}
+        self.rack_hosts = {}
+        self.heap = []
+        self.rescored = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def read_racks():
+        """
+        Read the rack of each host from config.racks
+
+        :rtype : dict
+        """
+        racks = {}
+        if os.path.isfile(config.racks):
+            with open(config.racks, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 2:
+                        racks[fields[0]] = fields[1]
+        return racks
+
+    def _push(self, load):
+        """
+        Replace a host's heap entry with one for its current score. Must be called with
+        the lock held.
+
+        :rtype : None
+        """
+        load.version += 1
+        heapq.heappush(self.heap, (load.score(), load.version, load.host))
+
+        # Stale entries are only dropped as they reach the top, so rebuild the heap when
+        # they come to outnumber the live ones
+        if len(self.heap) > 4 * len(self.loads) + 64:
+            self._rebuild()
+
+    def _rebuild(self):
+        """
+        Rebuild the heap from the current score of every host. Must be called with the lock held.
+
+        :rtype : None
+        """
+        self.heap = [(load.score(), load.version, load.host) for load in self.loads.itervalues()]
+        heapq.heapify(self.heap)
+
+    def _rescore(self, now):
+        """
+        Decay the recent placements of every host and rebuild the heap, so that hosts whose
+        placements have decayed are not passed over for their stale scores. Must be called
+        with the lock held.
+
+        :rtype : None
+        """
+        for load in self.loads.itervalues():
+            load.decay(now)
+        self._rebuild()
+        self.rescored = now
+
+    def _add(self, host):
+        """
+        Start choosing a host. Must be called with the lock held.
+
+        :rtype : HostLoad
+        """
+        load = self.loads[host] = HostLoad(host, self.racks.get(host, host))
+        self.rack_hosts[load.rack] = self.rack_hosts.get(load.rack, 0) + 1
+        self._push(load)
+        return load
+
+    def _remove(self, host):
+        """
+        Stop choosing a host. Must be called with the lock held.
+
+        :rtype : None
+        """
+        load = self.loads.pop(host, None)
+        if load is not None:
+            self.rack_hosts[load.rack] -= 1
+            if not self.rack_hosts[load.rack]:
+                del self.rack_hosts[load.rack]
+
+    def _push_all(self, loads):
+        """
+        Replace the heap entries of several hosts. Must be called with the lock held.
+
+        :rtype : None
+        """
+        for load in loads:
+            self._push(load)
+        del loads[:]
+
+    def sync_hosts(self, hosts):
+        """
+        Make the set of hosts chosen from match a list of active hosts, keeping the load of
+        hosts which remain
+
+        :rtype : None
+        :param hosts:
+        """
+        with self._lock:
+            hosts = set(hosts)
+            for host in set(self.loads) - hosts:
+                self._remove(host)
+            for host in hosts - set(self.loads):
+                self._add(host)
+
+    def update_host(self, host, capacity=None, used=None, inflight=None):
+        """
+        Record the load a chunkserver reports
+
+        :rtype : None
+        :param host:
+        :param capacity: The bytes the host can store
+        :param used: The bytes the host stores
+        :param inflight: The number of reads and writes in progress on the host
+        """
+        with self._lock:
+            load = self.loads.get(host) or self._add(host)
+            if capacity is not None:
+                load.capacity = capacity
+            if used is not None:
+                load.used = used
+            if inflight is not None:
+                load.inflight = inflight
+            load.decay(time.time())
+            self._push(load)
+
+    def remove_host(self, host):
+        """
+        Stop choosing a host
+
+        :rtype : None
+        :param host:
+        """
+        with self._lock:
+            self._remove(host)
+
+    def choose(self, count, exclude=()):
+        """
+        Choose hosts for new replicas of a chunk. Hosts on racks which hold none of the
+        chunk's replicas are preferred; hosts on a rack already used are only chosen when
+        there are too few racks. Each chosen host counts the placement against its score.
+
+        :rtype : list
+        :param count: The number of hosts to choose
+        :param exclude: The hosts which already hold a replica of the chunk
+        :return: the chosen hosts, fewer than count if too few hosts are available
+        """
+        with self._lock:
+            now = time.time()
+            if now - self.rescored >= config.placement_rescore_interval:
+                self._rescore(now)
+
+            exclude = set(exclude)
+            used_racks = set(self.racks.get(host, host) for host in exclude)
+            chosen, passed, skipped = [], [], []
+
+            # While spreading, hosts on racks which already hold a replica are passed over
+            spread = bool(set(self.rack_hosts) - used_racks)
+            while len(chosen) < count:
+                if not self.heap:
+                    if not spread:
+                        break
+                    # Too few racks have a host to spare, so fall back to the hosts passed over
+                    spread = False
+                    self._push_all(passed)
+                    continue
+
+                score, version, host = heapq.heappop(self.heap)
+                load = self.loads.get(host)
+                if load is None or load.version != version:
+                    continue
+                if host in exclude or score == float('inf'):
+                    skipped.append(load)
+                elif spread and load.rack in used_racks:
+                    passed.append(load)
+                else:
+                    chosen.append(load)
+                    used_racks.add(load.rack)
+                    if spread and not set(self.rack_hosts) - used_racks:
+                        # Every rack holds a replica, and the hosts passed over score best
+                        spread = False
+                        self._push_all(passed)
+
+            for load in chosen:
+                load.decay(now)
+                load.recent += 1
+            self._push_all(chosen + skipped + passed)
+
+            return [load.host for load in chosen]
\ No newline at end of file
@@ -0,0 +1,335 @@
+"""
+Re-replication of chunks which have fewer replicas than config.replica_amount, as
+after the loss of a chunkserver. Chunks wait in a priority queue ordered by the number
+of replicas they have left, so a chunk down to its last replica is copied before one
+which has lost a single replica, and a chunk a client is waiting on is boosted ahead
+of the others.
+
+A chunk is copied by asking a chunkserver which holds a replica to send it to a target
+chosen by the placement engine. Copies are limited in number and in bytes per second,
+both across the system and per chunkserver (as the source or the target), so
+recovering from the loss of a node does not saturate the traffic of clients.
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import heapq
+import threading
+import time
+import logging
+
+import config
+from net import WorkerPool
+
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("replication_logger")
+
+
+class TokenBucket(object):
+    """
+    Limits a rate of bytes. The bucket holds at most a second's worth of bytes. A copy
+    may start while any are left and may overdraw the bucket, so a chunk larger than the
+    bucket is delayed rather than starved. A rate of None or 0 is unlimited.
+    """
+    __slots__ = ('rate', 'tokens', 'updated')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate or 0)
+        self.updated = time.time()
+
+    def ready(self, now):
+        """
+        Refill the bucket for the time passed, and check whether any bytes are left
+
+        :rtype : bool
+        :param now:
+        """
+        if not self.rate:
+            return True
+        self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens > 0
+
+    def consume(self, size):
+        """
+        Take bytes from the bucket
+
+        :rtype : None
+        :param size:
+        """
+        if self.rate:
+            self.tokens -= size
+
+
+class ReplicationScheduler(object):
+    """
+    Queues under-replicated chunks and starts copies of them within the configured limits.
+    The heap holds a (priority, chunk handle) entry for every queued chunk, lower first;
+    when a chunk is queued again with a more urgent priority a new entry is pushed, and
+    entries which no longer match the chunk's priority are dropped as they reach the top.
+    """
+
+    def __init__(self, master):
+        """
+        :param master: The master whose global state, placement engine and chunkservers are used
+        """
+        self.master = master
+        self.heap = []
+        self.pending = {}
+        self.copying = set()
+        self.inflight = {}
+        self.bandwidth = TokenBucket(config.replication_bandwidth)
+        self.host_bandwidth = {}
+        self.copied = 0
+        self.failed = 0
+        self.pool = None
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def priority(replicas, blocking=False):
+        """
+        Get the priority of a chunk in the queue. Lower is more urgent.
+
+        :rtype : float
+        :param replicas: The number of replicas the chunk has left
+        :param blocking: Whether a client is waiting on the chunk
+        """
+        return replicas - config.replication_blocking_boost if blocking else replicas
+
+    def start(self):
+        """
+        Start the workers which copy chunks and the thread which schedules them
+
+        :rtype : None
+        """
+        self.pool = WorkerPool(self.copy, config.replication_max_inflight, config.replication_max_inflight)
+        scheduler = threading.Thread(target=self.schedule_forever)
+        scheduler.daemon = True
+        scheduler.start()
+
+    def schedule_forever(self):
+        """
+        Schedule copies whenever a chunk is queued or a copy finishes, and every
+        config.replication_interval seconds for the chunks left waiting on a limit
+
+        :rtype : None
+        """
+        while True:
+            with self._cond:
+                self._cond.wait(config.replication_interval)
+            try:
+                self.schedule()
+            except Exception:
+                log.exception("Unable to schedule re-replication")
+
+    def enqueue(self, chunk_handle, blocking=False):
+        """
+        Queue a chunk to be re-replicated if it has fewer replicas than config.replica_amount
+
+        :rtype : bool
+        :param chunk_handle:
+        :param blocking: Whether a client is waiting on the chunk, which boosts its priority
+        :return: True if the chunk is queued
+        """
+        if self._queue(chunk_handle, blocking):
+            with self._cond:
+                self._cond.notify()
+            return True
+        return False
+
+    def _queue(self, chunk_handle, blocking=False):
+        """
+        Queue a chunk without waking the scheduler
+
+        :rtype : bool
+        """
+        chunk = self.master.gs.get_chunk(chunk_handle)
+        if chunk is None or len(chunk.chunkserver_locations) >= config.replica_amount:
+            return False
+
+        priority = self.priority(len(chunk.chunkserver_locations), blocking)
+        with self._cond:
+            current = self.pending.get(chunk_handle)
+            if current is None or priority < current:
+                self.pending[chunk_handle] = priority
+                heapq.heappush(self.heap, (priority, chunk_handle))
+        return True
+
+    def _bucket(self, host):
+        """
+        Get the bandwidth limit of a chunkserver. Must be called with the lock held.
+
+        :rtype : TokenBucket
+        """
+        bucket = self.host_bandwidth.get(host)
+        if bucket is None:
+            bucket = self.host_bandwidth[host] = TokenBucket(config.replication_host_bandwidth)
+        return bucket
+
+    def _host_ready(self, host, now):
+        """
+        Check whether a chunkserver may take part in another copy. Must be called with the lock held.
+
+        :rtype : bool
+        """
+        return (self.inflight.get(host, 0) < config.replication_host_max_inflight and
+                self._bucket(host).ready(now))
+
+    def schedule(self):
+        """
+        Start copies of the most urgent chunks, as many as the limits allow. Chunks which
+        cannot be copied yet, for want of a source or a target within its limits, stay queued,
+        as do chunks with an outstanding lease, whose primary may be appending to them.
+
+        :rtype : int
+        :return: the number of copies started
+        """
+        jobs, deferred = [], []
+        with self._cond:
+            now = time.time()
+            while (self.heap and len(self.copying) < config.replication_max_inflight and
+                    self.bandwidth.ready(now)):
+                priority, chunk_handle = heapq.heappop(self.heap)
+                if self.pending.get(chunk_handle) != priority:
+                    continue
+                if chunk_handle in self.copying or self.master.leases.outstanding(chunk_handle):
+                    deferred.append((priority, chunk_handle))
+                    continue
+
+                chunk = self.master.gs.get_chunk(chunk_handle)
+                locations = chunk.chunkserver_locations if chunk is not None else []
+                if chunk is None or len(locations) >= config.replica_amount:
+                    del self.pending[chunk_handle]
+                    continue
+                if not locations:
+                    log.error("Chunk {} has no replica left to copy".format(chunk_handle))
+                    del self.pending[chunk_handle]
+                    continue
+
+                sources = [host for host in locations if self._host_ready(host, now)]
+                targets = []
+                if sources:
+                    busy = [host for host in self.host_bandwidth if not self._host_ready(host, now)]
+                    targets = self.master.choose_chunk_locations(chunk_handle, 1, exclude=busy)
+                if not targets:
+                    deferred.append((priority, chunk_handle))
+                    continue
+
+                source = min(sources, key=lambda host: self.inflight.get(host, 0))
+                target = targets[0]
+                size = chunk.offset()
+                del self.pending[chunk_handle]
+                self.copying.add(chunk_handle)
+                self.bandwidth.consume(size)
+                for host in (source, target):
+                    self.inflight[host] = self.inflight.get(host, 0) + 1
+                    self._bucket(host).consume(size)
+                jobs.append((chunk_handle, source, target))
+
+            for entry in deferred:
+                heapq.heappush(self.heap, entry)
+
+        for job in jobs:
+            if self.pool is None:
+                self.copy(*job)
+            elif not self.pool.submit(*job):
+                self.finish(job[0], job[1], job[2], False)
+        return len(jobs)
+
+    def is_copying(self, chunk_handle):
+        """
+        Check whether a chunk is being copied. A chunk is marked as copying under the same
+        lock in which it is checked for a lease, so a lease granted before this returns
+        False is seen by the scheduler.
+
+        :rtype : bool
+        :param chunk_handle:
+        """
+        with self._cond:
+            return chunk_handle in self.copying
+
+    def copy(self, chunk_handle, source, target):
+        """
+        Copy a replica of a chunk from one chunkserver to another
+
+        :rtype : None
+        :param chunk_handle:
+        :param source:
+        :param target:
+        """
+        copied = False
+        try:
+            copied = self.master.copy_chunk(chunk_handle, source, target)
+        except Exception:
+            log.exception("Unable to copy chunk {} from {} to {}".format(chunk_handle, source, target))
+        self.finish(chunk_handle, source, target, copied)
+
+    def finish(self, chunk_handle, source, target, copied):
+        """
+        Record the end of a copy. A chunk which is still short of replicas is queued again;
+        after a failed copy it waits for the next periodic schedule, so an unreachable
+        chunkserver is not retried in a tight loop.
+
+        :rtype : None
+        :param chunk_handle:
+        :param source:
+        :param target:
+        :param copied: Whether the copy succeeded
+        """
+        if copied:
+            self.master.add_replica(chunk_handle, target)
+
+        with self._cond:
+            self.copying.discard(chunk_handle)
+            for host in (source, target):
+                count = self.inflight.get(host, 0) - 1
+                if count > 0:
+                    self.inflight[host] = count
+                else:
+                    self.inflight.pop(host, None)
+            if copied:
+                self.copied += 1
+            else:
+                self.failed += 1
+                log.warn("Copy of chunk {} from {} to {} failed".format(chunk_handle, source, target))
+
+        if copied:
+            self.enqueue(chunk_handle)
+        else:
+            self._queue(chunk_handle)
+
+    def stats(self):
+        """
+        Get the progress of re-replication
+
+        :rtype : dict
+        """
+        with self._cond:
+            return {
+                'queued': len(self.pending),
+                'copying': len(self.copying),
+                'copied': self.copied,
+                'failed': self.failed,
+            }
\ No newline at end of file
@@ -91,7 +91,7 @@ class Scrubber(object):
 
         try:
             # TODO: need to impelement override methods of send/recv to account for sys messages
-            socket.send(self.m.SANITIZE)
+            socket.send(chr(self.m.SANITIZE))
 
             state = socket.recv(1024)
             return state
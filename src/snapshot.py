@@ -0,0 +1,296 @@
+"""
+A compact, versioned binary format for snapshots of the master's global state.
+Unlike a pickle of the GlobalState object, a snapshot holds only the persistent
+metadata, with chunkserver locations stored as indexes in to a table of hosts.
+Snapshots are loaded from a read-only memory map of the file, and files and chunks
+are decoded one at a time as the global state is rebuilt, so loading never holds a
+second copy of the namespace in memory.
+
+A snapshot is laid out as, with all integers in network byte order:
+
+    header:     magic 'DFSS', version (2 bytes), oplog sequence number (8 bytes),
+                chunk handle counter (8 bytes)
+    hosts:      count (4 bytes), then each host as [length: 2 bytes][host]
+    files:      count (8 bytes), then each file as [name length: 2 bytes][name]
+                [chunk count: 4 bytes][chunk handles: 8 bytes each]
+    chunks:     count (8 bytes), then each chunk as [handle: 8 bytes][offset: 4 bytes]
+                [location count: 1 byte][host indexes: 2 bytes each]
+    to delete:  count (4 bytes), then each file name as [length: 2 bytes][name]
+    trailer:    crc32 of everything before it (4 bytes)
+
+###############################################################################
+The MIT License (MIT)
+
+Copyright (c) 2014 Erick Daniszewski
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+###############################################################################
+"""
+import gc
+import mmap
+import struct
+import zlib
+
+from globalstate import GlobalState
+
+
+MAGIC = 'DFSS'
+VERSION = 1
+
+_header = struct.Struct('!4sHQQ')
+_count = struct.Struct('!L')
+_long_count = struct.Struct('!Q')
+_string = struct.Struct('!H')
+_chunk = struct.Struct('!QLB')
+_crc = struct.Struct('!L')
+_arrays = {}
+_BLOCK = 256
+
+
+class SnapshotError(ValueError):
+    """
+    Raised when a snapshot is not in a format this version can read, or is corrupt
+    """
+
+
+def _array(typecode, count):
+    """
+    Get the struct for an array of at most _BLOCK integers, caching it by type and length.
+    Longer arrays are packed in blocks of _BLOCK, so the cache holds at most _BLOCK + 1
+    structs for each type.
+
+    :rtype : struct.Struct
+    :param typecode:
+    :param count:
+    """
+    try:
+        return _arrays[typecode, count]
+    except KeyError:
+        if count > _BLOCK:
+            raise ValueError("Arrays of more than {} integers are packed in blocks.".format(_BLOCK))
+        s = _arrays[typecode, count] = struct.Struct('!{}{}'.format(count, typecode))
+        return s
+
+
+def _pack_array(typecode, values):
+    """
+    Pack an array of integers of any length
+
+    :rtype : str
+    :param typecode:
+    :param values:
+    """
+    count = len(values)
+    if count <= _BLOCK:
+        return _array(typecode, count).pack(*values)
+
+    tail = count - count % _BLOCK
+    block = _array(typecode, _BLOCK)
+    parts = [block.pack(*values[i:i + _BLOCK]) for i in xrange(0, tail, _BLOCK)]
+    parts.append(_array(typecode, count - tail).pack(*values[tail:]))
+    return "".join(parts)
+
+
+class _Writer(object):
+    """
+    Buffers the writes to a snapshot file and keeps a running checksum of them
+    """
+    BUFFER_SIZE = 2 ** 16
+
+    def __init__(self, f):
+        self.f = f
+        self.crc = 0
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.BUFFER_SIZE:
+            self.flush()
+
+    def string(self, s):
+        self.write(_string.pack(len(s)) + s)
+
+    def flush(self):
+        data = "".join(self.parts)
+        self.crc = zlib.crc32(data, self.crc)
+        self.f.write(data)
+        self.parts = []
+        self.size = 0
+
+
+class _Reader(object):
+    """
+    Decodes the fields of a snapshot in order from a buffer
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.position = 0
+
+    def unpack(self, s):
+        values = s.unpack_from(self.buf, self.position)
+        self.position += s.size
+        return values
+
+    def string(self):
+        length = self.unpack(_string)[0]
+        self.position += length
+        return self.buf[self.position - length:self.position]
+
+    def array(self, typecode, count):
+        if count <= _BLOCK:
+            return self.unpack(_array(typecode, count))
+
+        values = []
+        block = _array(typecode, _BLOCK)
+        for _ in xrange(count // _BLOCK):
+            values.extend(self.unpack(block))
+        values.extend(self.unpack(_array(typecode, count % _BLOCK)))
+        return values
+
+
+def dump(f, sequence, view):
+    """
+    Write a snapshot of a global state to a file
+
+    :rtype : None
+    :param f: A file opened for writing in binary mode
+    :param sequence: The sequence number of the last operation log record covered by the snapshot
+    :param view: A view of the global state returned by GlobalState.checkpoint_view
+    """
+    hosts = {}
+    for _, _, chunkserver_locations in view['chunks']:
+        for host in chunkserver_locations:
+            hosts.setdefault(host, len(hosts))
+
+    w = _Writer(f)
+    w.write(_header.pack(MAGIC, VERSION, sequence, view['chunk_handle']))
+
+    w.write(_count.pack(len(hosts)))
+    for host in sorted(hosts, key=hosts.get):
+        w.string(host)
+
+    w.write(_long_count.pack(len(view['files'])))
+    for file_name, chunk_handles in view['files']:
+        w.string(file_name)
+        w.write(_count.pack(len(chunk_handles)) + _pack_array('Q', chunk_handles))
+
+    w.write(_long_count.pack(len(view['chunks'])))
+    for chunk_handle, offset, chunkserver_locations in view['chunks']:
+        w.write(_chunk.pack(chunk_handle, offset, len(chunkserver_locations)) +
+                _array('H', len(chunkserver_locations)).pack(*[hosts[h] for h in chunkserver_locations]))
+
+    w.write(_count.pack(len(view['to_delete'])))
+    for file_name in view['to_delete']:
+        w.string(file_name)
+
+    w.flush()
+    f.write(_crc.pack(w.crc & 0xFFFFFFFF))
+
+
+def read_sequence(path):
+    """
+    Read the sequence number of the last operation log record covered by a snapshot from
+    its header, without loading or checking the rest of it
+
+    :rtype : int
+    :param path:
+    """
+    with open(path, 'rb') as f:
+        header = f.read(_header.size)
+    if len(header) < _header.size or header[:len(MAGIC)] != MAGIC:
+        raise SnapshotError("{} is not a snapshot.".format(path))
+    return _header.unpack(header)[2]
+
+
+def load(path):
+    """
+    Load the global state from a snapshot file
+
+    :rtype : tuple
+    :param path:
+    :return: a two-tuple of the sequence number of the last operation log record covered
+             by the snapshot and the GlobalState
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError) as e:
+            raise SnapshotError("Unable to map snapshot {}: {}".format(path, e))
+
+    try:
+        if len(buf) < _header.size + _crc.size or buf[:len(MAGIC)] != MAGIC:
+            raise SnapshotError("{} is not a snapshot.".format(path))
+
+        end = len(buf) - _crc.size
+        if zlib.crc32(buffer(buf, 0, end)) & 0xFFFFFFFF != _crc.unpack_from(buf, end)[0]:
+            raise SnapshotError("Snapshot {} is corrupt.".format(path))
+
+        r = _Reader(buf)
+        _, version, sequence, chunk_handle = r.unpack(_header)
+        if version != VERSION:
+            raise SnapshotError("Snapshot {} has unsupported version {}.".format(path, version))
+
+        hosts = [r.string() for _ in xrange(r.unpack(_count)[0])]
+
+        def files():
+            for _ in xrange(r.unpack(_long_count)[0]):
+                file_name = r.string()
+                handle_count = r.unpack(_count)[0]
+                yield file_name, r.array('Q', handle_count)
+
+        def chunks():
+            # This is the bulk of a snapshot, so the position is kept in a local
+            count = r.unpack(_long_count)[0]
+            unpack_chunk, chunk_size = _chunk.unpack_from, _chunk.size
+            position = r.position
+            for _ in xrange(count):
+                handle, offset, location_count = unpack_chunk(buf, position)
+                indexes = _array('H', location_count)
+                yield handle, offset, [hosts[i] for i in indexes.unpack_from(buf, position + chunk_size)]
+                position += chunk_size + indexes.size
+            r.position = position
+
+        def to_delete():
+            for _ in xrange(r.unpack(_count)[0]):
+                yield r.string()
+
+        # The sections are decoded lazily, in the order from_checkpoint consumes them,
+        # which is the order they are laid out in. None of the objects built form reference
+        # cycles, so the cycle collector is paused rather than left to rescan the growing
+        # state every few hundred allocations.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            gs = GlobalState.from_checkpoint({
+                'chunk_handle': chunk_handle,
+                'files': files(),
+                'chunks': chunks(),
+                'to_delete': to_delete(),
+            })
+        except struct.error as e:
+            raise SnapshotError("Snapshot {} is malformed: {}".format(path, e))
+        finally:
+            if collecting:
+                gc.enable()
+        return sequence, gs
+    finally:
+        buf.close()
\ No newline at end of file
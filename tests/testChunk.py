@@ -3,8 +3,12 @@ Created on Aug 14, 2014
 
 @author: erickdaniszewski
 """
+import cPickle as pickle
 import unittest
 
+from src import config
+from src.chunk import Chunk
+
 
 class Test(unittest.TestCase):
 
@@ -17,6 +21,43 @@ class Test(unittest.TestCase):
     def testName(self):
         pass
 
+    def testSlots(self):
+        chunk = Chunk(7, ["10.0.0.1"], 10)
+        self.assertFalse(hasattr(chunk, '__dict__'))
+        self.assertIs(chunk.lock, Chunk(7 + config.lock_stripes).lock)
+        chunk.update_offset(5)
+        self.assertEqual(15, chunk.offset())
+
+    def testReserve(self):
+        chunk = Chunk(7)
+        self.assertEqual(0, chunk.reserve(config.chunk_size - 10))
+        self.assertIsNone(chunk.reserve(11))
+        self.assertEqual(config.chunk_size - 10, chunk.reserve(10))
+        self.assertIsNone(chunk.reserve(1))
+
+        chunk = Chunk(8, offset=4)
+        self.assertEqual(config.chunk_size - 4, chunk.pad())
+        self.assertEqual(0, chunk.pad())
+        self.assertIsNone(chunk.reserve(1))
+
+    def testReferences(self):
+        chunk = Chunk(7)
+        self.assertEqual(1, chunk.reference())
+        self.assertEqual(2, chunk.reference())
+        self.assertEqual(1, chunk.dereference())
+
+        # The count is rebuilt from the files on load rather than pickled
+        self.assertEqual(0, pickle.loads(pickle.dumps(chunk)).references)
+
+    def testPickle(self):
+        chunk = pickle.loads(pickle.dumps(Chunk(7, ["10.0.0.1"], 10)))
+        self.assertEqual((7, ["10.0.0.1"], 10), (chunk.chunk_handle, chunk.chunkserver_locations, chunk.offset()))
+
+        # State pickled before chunks had slots
+        chunk = Chunk.__new__(Chunk)
+        chunk.__setstate__({'chunk_handle': 3, 'chunkserver_locations': [], '_offset': 4})
+        self.assertEqual(4, chunk.offset())
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -3,20 +3,89 @@ Created on Aug 13, 2014
 
 @author: erickdaniszewski
 """
+import os
+import shutil
+import tempfile
 import unittest
 
+from src import config
+from src.chunkserver import Chunkserver
+from src.message import Message
+
 
 class Test(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.tmp = tempfile.mkdtemp()
+        self.chunkstore = config.chunkstore
+        config.chunkstore = self.tmp + os.sep
+        self.m = Message()
+        self.chunkserver = Chunkserver(run=True)
+        self.forwarded = []
+        self.chunkserver.forward_write = lambda *args: self.forwarded.append(args) or args[0] != "down"
 
     def tearDown(self):
-        pass
+        self.chunkserver.pool.close()
+        config.chunkstore = self.chunkstore
+        shutil.rmtree(self.tmp)
 
     def testName(self):
         pass
 
+    def read(self, chunk_handle):
+        with open(config.chunkstore + chunk_handle, 'rb') as f:
+            return f.read()
+
+    def test_record_append(self):
+        self.assertEqual([self.m.SUCCESS], self.chunkserver.process(self.m.LEASE, ["1", "60", "b", "c"]))
+        self.assertEqual([self.m.SUCCESS, "0"], self.chunkserver.process(self.m.APPEND, ["1", "abc"]))
+        self.assertEqual([self.m.SUCCESS, "3"], self.chunkserver.process(self.m.APPEND, ["1", "de"]))
+        self.assertEqual("abcde", self.read("1"))
+        self.assertEqual([("b", "1", 0, "abc"), ("c", "1", 0, "abc"), ("b", "1", 3, "de"), ("c", "1", 3, "de")],
+                         self.forwarded)
+
+        # An append which does not fit is refused with the chunk's length
+        self.assertEqual([self.m.FULL, "5"],
+                         self.chunkserver.process(self.m.APPEND, ["1", "x" * (config.chunk_size - 4)]))
+        self.assertEqual("abcde", self.read("1"))
+
+        # A primary giving up its lease reports the length of the chunk, and without a
+        # lease in force, it refuses appends
+        self.assertEqual([self.m.SUCCESS, "5"], self.chunkserver.process(self.m.LEASE, ["1", "0"]))
+        self.assertEqual({}, self.chunkserver.leases)
+        self.chunkserver.process(self.m.LEASE, ["2", str(config.lease_margin / 2.0)])
+        self.assertEqual([self.m.FAILURE], self.chunkserver.process(self.m.APPEND, ["2", "abc"]))
+
+    def test_failed_forward(self):
+        self.chunkserver.process(self.m.LEASE, ["1", "60", "down"])
+        self.assertEqual([self.m.FAILURE], self.chunkserver.process(self.m.APPEND, ["1", "abc"]))
+
+    def test_write(self):
+        self.assertEqual([self.m.SUCCESS], self.chunkserver.process(self.m.WRITE, ["1", "3", "def"]))
+        self.assertEqual([self.m.SUCCESS], self.chunkserver.process(self.m.WRITE, ["1", "0", "abc"]))
+        self.assertEqual("abcdef", self.read("1"))
+        self.assertEqual(["1"], self.chunkserver.get_contents())
+
+    def test_pad(self):
+        self.chunkserver.process(self.m.WRITE, ["1", "0", "abc"])
+        self.assertEqual([self.m.SUCCESS], self.chunkserver.process(self.m.PAD, ["1", "6"]))
+        self.assertEqual("abc\0\0\0", self.read("1"))
+        self.assertEqual([self.m.SUCCESS], self.chunkserver.process(self.m.PAD, ["1", "2"]))
+        self.assertEqual("abc\0\0\0", self.read("1"))
+
+        # Appends are only taken by the primary of a chunk
+        self.assertEqual([self.m.FAILURE], self.chunkserver.process(self.m.APPEND, ["1", "de"]))
+        self.assertEqual("abc\0\0\0", self.read("1"))
+
+    def test_clone(self):
+        self.chunkserver.process(self.m.WRITE, ["1", "0", "abc"])
+        self.assertEqual([self.m.SUCCESS], self.chunkserver.process(self.m.CLONE, ["1", "2"]))
+        self.chunkserver.process(self.m.WRITE, ["2", "3", "de"])
+        self.assertEqual("abc", self.read("1"))
+        self.assertEqual("abcde", self.read("2"))
+        self.assertEqual(["1", "2"], sorted(self.chunkserver.get_contents()))
+        self.assertEqual([self.m.FAILURE], self.chunkserver.process(self.m.CLONE, ["3", "4"]))
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -3,20 +3,229 @@ Created on Aug 13, 2014
 
 @author: erickdaniszewski
 """
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 
+from src import config
+from src.client import Client, ConnectionPool, MetadataCache
+from src.master import Master
+from src.message import Message
+from src.net import BaseServer, Connection
+
+
+class EchoServer(BaseServer):
+
+    def __init__(self):
+        super(EchoServer, self).__init__()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.sessions = []
+
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error:
+                return
+            self.sessions.append(sock)
+            t = threading.Thread(target=self.serve_session, args=(sock, addr))
+            t.daemon = True
+            t.start()
+
+    def process(self, sysmsg, args):
+        return [sysmsg] + args
+
+
+class Descriptor(object):
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+class MasterStub(EchoServer):
+
+    def __init__(self, master):
+        super(MasterStub, self).__init__()
+        self.master = master
+        self.requests = []
+
+    def process(self, sysmsg, args):
+        self.requests.append([sysmsg] + args)
+        return self.master.process(sysmsg, args)
+
 
 class Test(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.server = EchoServer()
+        self.pool = ConnectionPool(max_per_host=2, idle_timeout=60, timeout=5)
 
     def tearDown(self):
-        pass
+        self.pool.close()
+        self.server.sock.close()
 
     def testName(self):
         pass
 
+    def test_connections_are_reused(self):
+        with self.pool.connection('127.0.0.1', self.server.port) as conn:
+            self.assertEqual([1, "a"], conn.call(1, "a"))
+            first = conn
+        with self.pool.connection('127.0.0.1', self.server.port) as conn:
+            self.assertIs(first, conn)
+        self.assertEqual(1, len(self.server.sessions))
+
+    def test_max_connections_per_host(self):
+        first = self.pool.acquire('127.0.0.1', self.server.port)
+        second = self.pool.acquire('127.0.0.1', self.server.port)
+        acquired = []
+
+        t = threading.Thread(target=lambda: acquired.append(self.pool.acquire('127.0.0.1', self.server.port)))
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        self.assertEqual([], acquired)
+
+        self.pool.release(second)
+        t.join(5)
+        self.assertEqual([second], acquired)
+        self.pool.release(first)
+        self.pool.release(second)
+
+    def test_idle_and_unhealthy_connections_are_replaced(self):
+        conn = self.pool.acquire('127.0.0.1', self.server.port)
+        conn.call(1)
+        self.pool.release(conn)
+        self.server.sessions[0].shutdown(socket.SHUT_RDWR)
+        replacement = self.pool.acquire('127.0.0.1', self.server.port)
+        self.assertIsNot(conn, replacement)
+        self.assertEqual([1], replacement.call(1))
+
+        self.pool.idle_timeout = -1
+        self.pool.release(replacement)
+        self.pool.evict_idle()
+        self.assertEqual(0, self.pool._open[('127.0.0.1', self.server.port)])
+
+    def test_health_check_of_high_descriptors(self):
+        # select cannot watch descriptors past FD_SETSIZE, which a busy client reaches
+        conn = self.pool.acquire('127.0.0.1', self.server.port)
+        fd = 1500
+        os.dup2(conn.sock.fileno(), fd)
+        try:
+            high = Connection.__new__(Connection)
+            high.sock = Descriptor(fd)
+            self.assertTrue(ConnectionPool.is_healthy(high))
+        finally:
+            os.close(fd)
+            self.pool.release(conn)
+
+    def test_metadata_cache(self):
+        cache = MetadataCache(size=3, ttl=10)
+        for i in range(3):
+            cache.put("f", i, ("handle", "0", []), now=0)
+        self.assertEqual(("handle", "0", []), cache.get("f", 0, now=5))
+
+        # The least recently used entry is evicted
+        cache.put("g", 0, ("other", "0", []), now=0)
+        self.assertIsNone(cache.get("f", 1, now=5))
+        self.assertIsNotNone(cache.get("f", 0, now=5))
+        self.assertEqual(3, len(cache))
+
+        # Entries expire, and a file's entries may be dropped at once
+        self.assertIsNone(cache.get("g", 0, now=10))
+        cache.invalidate("f")
+        self.assertEqual(0, len(cache))
+        self.assertEqual({}, cache.files)
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+    def test_sequential_read_prefetches(self):
+        tmp = tempfile.mkdtemp()
+        saved = config.metasnapshot, config.oplog
+        config.metasnapshot = os.path.join(tmp, "meta.snapshot")
+        config.oplog = os.path.join(tmp, "OPLOG.log")
+        master = Master(run=True)
+        server = MasterStub(master)
+        try:
+            m = Message()
+            master.gs.active_hosts = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+            master.call_chunkserver = lambda *args: [m.SUCCESS]
+            master.create_new_file("f")
+            for _ in range(20):
+                master.append("f", config.chunk_size)
+
+            client = Client(master_port=server.port, pool=self.pool)
+            reads = []
+            failing = set()
+
+            def read_chunk(chunk_handle, length, locations):
+                reads.append(chunk_handle)
+                return None if chunk_handle in failing else chunk_handle + ","
+            client.read_chunk = read_chunk
+
+            expected = "".join("{},".format(chunk_handle) for chunk_handle in master.gs.get_chunk_handles("f"))
+            self.assertEqual(expected, client.read("f"))
+            lookups = [request[2] for request in server.requests if request[0] == m.READ]
+            self.assertEqual(["0", "8", "16", "19", "20"], lookups)
+            self.assertIsNone(client.cache.get("f", 19))
+
+            # The last chunk is not cached even when it ends a full reply
+            master.create_new_file("g")
+            for _ in range(config.client_prefetch_chunks):
+                master.append("g", config.chunk_size)
+            client.read("g")
+            self.assertIsNotNone(client.cache.get("g", config.client_prefetch_chunks - 2))
+            self.assertIsNone(client.cache.get("g", config.client_prefetch_chunks - 1))
+
+            # A cached chunk which cannot be read is looked up again
+            del server.requests[:]
+            failing.add("1")
+            self.assertIsNone(client.read("f"))
+            self.assertEqual([[m.READ, "f", "0", str(config.client_prefetch_chunks + 1)]], server.requests)
+            failing.clear()
+            self.assertEqual(expected, client.read("f"))
+        finally:
+            master.oplog.close()
+            server.sock.close()
+            config.metasnapshot, config.oplog = saved
+            shutil.rmtree(tmp)
+
+    def test_list_pages(self):
+        tmp = tempfile.mkdtemp()
+        saved = config.metasnapshot, config.oplog
+        config.metasnapshot = os.path.join(tmp, "meta.snapshot")
+        config.oplog = os.path.join(tmp, "OPLOG.log")
+        master = Master(run=True)
+        server = MasterStub(master)
+        try:
+            m = Message()
+            for i in range(5):
+                master.create_new_file("/d/{}".format(i))
+            master.create_new_file("/d/sub/x")
+
+            client = Client(master_port=server.port, pool=self.pool)
+            self.assertEqual(["0", "1", "2", "3", "4", "sub/"], list(client.list("/d", page_size=2)))
+            self.assertEqual(["", "1", "3", "sub/"], [request[2] for request in server.requests])
+            self.assertEqual(["/d/3", "/d/4", "/d/sub/x"], list(client.list("/d", True))[3:])
+            self.assertEqual([], list(client.list("/missing")))
+        finally:
+            master.oplog.close()
+            server.sock.close()
+            config.metasnapshot, config.oplog = saved
+            shutil.rmtree(tmp)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -3,6 +3,7 @@ Created on Aug 14, 2014
 
 @author: erickdaniszewski
 """
+import cPickle as pickle
 import unittest
 
 from src.file import File
@@ -30,6 +31,16 @@ class Test(unittest.TestCase):
         self.assertTrue(self.f.check_password(12345))
         self.assertFalse(self.f.check_password(54321))
 
+    def testChunkHandles(self):
+        self.assertFalse(hasattr(self.f, '__dict__'))
+        self.f.chunk_handles.append(2 ** 40)
+        self.assertEqual([2 ** 40], list(self.f.chunk_handles))
+        self.assertEqual("/a/b", File("/a/b/c").namespace)
+
+        f = pickle.loads(pickle.dumps(self.f))
+        self.assertEqual(list(self.f.chunk_handles), list(f.chunk_handles))
+        self.assertEqual("test_file", f.file_name)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
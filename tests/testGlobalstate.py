@@ -3,7 +3,9 @@ Created on Aug 14, 2014
 
 @author: erickdaniszewski
 """
+import threading
 import unittest
+from src import config
 from src.globalstate import GlobalState
 from src.file import File
 from src.chunk import Chunk
@@ -22,6 +24,34 @@ class Test(unittest.TestCase):
         self.assertEqual(0, self.gs._chunk_handle, "initial chunk handle")
         self.assertEqual(1, self.gs.get_next_chunk, "incremented chunk handle")
 
+    def testAllocateChunkHandles(self):
+        leases = []
+        handles = []
+
+        def allocate():
+            for _ in range(300):
+                handles.append(self.gs.allocate_chunk_handle(lambda first, last: leases.append((first, last))))
+
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(2400, len(set(handles)))
+        # Each thread leases whole ranges, and each lease is reported once
+        ranges = sorted(leases)
+        self.assertEqual(len(ranges), len(set(ranges)))
+        self.assertEqual(config.chunk_handle_range, ranges[0][1] - ranges[0][0] + 1)
+        self.assertTrue(all(any(first <= h <= last for first, last in ranges) for h in handles))
+        self.assertEqual(ranges[-1][1], self.gs.get_current_chunk)
+
+    def testChunkHandlesAre64Bit(self):
+        self.gs.lease_chunk_handles(2 ** 64 - 3)
+        self.assertEqual(2 ** 64 - 2, self.gs.get_next_chunk)
+        self.assertEqual(2 ** 64 - 1, self.gs.get_next_chunk)
+        self.assertRaises(OverflowError, lambda: self.gs.get_next_chunk)
+
     def testAddFile(self):
         self.assertEqual(0, len(self.gs.file_map), "check that filemap is initially empty")
         self.assertTrue(self.gs.add_file(self.fileName), "check for proper return code")
@@ -51,7 +81,7 @@ class Test(unittest.TestCase):
         self.gs.add_file(self.fileName + "2")
         self.gs.add_file(self.fileName + "3")
         
-        files = self.gs.get_files()
+        files = list(self.gs.get_files())
         
         self.assertEqual(3, len(files))
         
@@ -63,7 +93,7 @@ class Test(unittest.TestCase):
         self.gs.add_file(self.fileName + "2")
         self.gs.add_file(self.fileName + "3")
         
-        names = self.gs.get_file_names()
+        names = list(self.gs.get_file_names())
         
         self.assertEqual(3, len(names))
         
@@ -80,7 +110,7 @@ class Test(unittest.TestCase):
         self.gs.clean_file_map(self.fileName + "2")
         
         self.assertEqual(2, len(self.gs.file_map))
-        names = self.gs.get_file_names()
+        names = list(self.gs.get_file_names())
         self.assertNotIn(self.fileName + "2", names)
 
     def testAddChunk(self):
@@ -100,7 +130,7 @@ class Test(unittest.TestCase):
         self.gs.add_chunk(2)
         self.gs.add_chunk(3)
         
-        chunks = self.gs.get_chunks()
+        chunks = list(self.gs.get_chunks())
         
         self.assertEqual(3, len(chunks))
         
@@ -112,7 +142,7 @@ class Test(unittest.TestCase):
         self.gs.add_chunk(2)
         self.gs.add_chunk(3)
         
-        chunkHandles = self.gs.get_chunk_ids()
+        chunkHandles = list(self.gs.get_chunk_ids())
         
         self.assertEqual(3, len(chunkHandles))
         
@@ -129,9 +159,189 @@ class Test(unittest.TestCase):
         self.gs.clean_chunk_map(2)
         
         self.assertEqual(2, len(self.gs.chunk_map))
-        chunkHandles = self.gs.get_chunk_ids()
+        chunkHandles = list(self.gs.get_chunk_ids())
         self.assertNotIn(2, chunkHandles)
 
+    def testApplyBatch(self):
+        self.gs.add_file(self.fileName)
+        self.gs.get_file(self.fileName).chunk_handles.extend([4, 5])
+
+        results = self.gs.apply_batch([('add_file', (self.fileName,)), ('add_file', (self.fileName + "1",)),
+                                       ('get_chunk_handles', (self.fileName,)), ('queue_delete', (self.fileName,))])
+
+        self.assertEqual([0, 1, [4, 5], 1], results)
+        self.assertIn(self.fileName, self.gs.to_delete)
+
+    def testConcurrentAddFile(self):
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(self.gs.add_file("file{}".format(i % 10))))
+                   for i in range(50)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(10, sum(results))
+        self.assertEqual(10, len(self.gs.file_map))
+
+    def testCheckpointWaitsForMutations(self):
+        self.gs.add_file(self.fileName)
+        views = []
+        with self.gs.lock.read(), self.gs.file_locks.write(self.fileName):
+            checkpoint = threading.Thread(target=lambda: views.append(self.gs.checkpoint_view()))
+            checkpoint.start()
+            checkpoint.join(0.1)
+            self.assertTrue(checkpoint.is_alive())
+            self.gs.queue_delete(self.fileName)
+        checkpoint.join()
+        self.assertEqual([self.fileName], views[0]['to_delete'])
+
+    def testCheckpointCopiesFrozenState(self):
+        self.gs.add_file(self.fileName)
+        self.gs.add_file_chunk(self.fileName, 1, ["a", "b"])
+        self.gs.update_chunk_offset(1, 10)
+        with self.gs.lock.write():
+            frozen = self.gs.freeze()
+
+        # Changes made once the state is frozen are left out of the copy
+        self.gs.update_chunk_offset(1, 5)
+        self.gs.add_chunk_location(1, "c")
+        self.gs.add_file_chunk(self.fileName, 2, ["c"])
+        self.gs.add_file("other")
+        self.gs.queue_delete(self.fileName)
+        view = self.gs.checkpoint_view(frozen)
+        self.assertEqual([(self.fileName, [1])], [(name, list(handles)) for name, handles in view['files']])
+        self.assertEqual([(1, 10, ["a", "b"])], view['chunks'])
+        self.assertEqual([], view['to_delete'])
+
+        # Nothing is kept once the copy is done
+        self.assertIsNone(self.gs._frozen)
+        self.assertEqual(15, self.gs.get_chunk(1).offset())
+        self.assertEqual(2, len(self.gs.checkpoint_view()['chunks']))
+
+    def testHostIndex(self):
+        self.gs.add_file(self.fileName)
+        self.gs.add_file_chunk(self.fileName, 1, ["a", "b"])
+        self.gs.add_file_chunk(self.fileName, 2, ["b", "c"])
+        self.assertEqual(set([1, 2]), self.gs.get_host_chunks("b"))
+        self.assertEqual(set(), self.gs.get_host_chunks("missing"))
+
+        self.assertEqual(1, self.gs.add_chunk_location(1, "c"))
+        self.assertEqual(0, self.gs.add_chunk_location(1, "c"))
+        self.assertEqual(1, self.gs.remove_chunk_location(2, "b"))
+        self.assertEqual(0, self.gs.remove_chunk_location(99, "b"))
+        self.assertEqual(set([1]), self.gs.get_host_chunks("b"))
+        self.assertEqual(set([1, 2]), self.gs.get_host_chunks("c"))
+
+        self.gs.set_chunk_locations(1, ["d"])
+        self.assertEqual(set(), self.gs.get_host_chunks("a"))
+        self.assertEqual(set([1]), self.gs.get_host_chunks("d"))
+
+        self.gs.clean_file_map(self.fileName)
+        self.assertEqual(set(), self.gs.get_host_chunks("c"))
+        self.assertEqual(set(), self.gs.get_host_chunks("d"))
+
+        # The index is rebuilt when a checkpoint is loaded
+        self.gs.add_file("other")
+        self.gs.add_file_chunk("other", 3, ["a", "b"])
+        gs = GlobalState.from_checkpoint(self.gs.checkpoint_view())
+        self.assertEqual(set([3]), gs.get_host_chunks("a"))
+
+    def testListDirectory(self):
+        for name in ["/logs/a", "/logs/b", "/logs/old/c", "/data/d"]:
+            self.assertEqual(1, self.gs.add_file(name))
+        self.assertEqual(0, self.gs.add_file("/logs/a/x"))
+        self.assertEqual(0, self.gs.add_file("/logs"))
+
+        self.assertEqual(["a", "b", "old/"], self.gs.list_directory("/logs"))
+        self.assertEqual(["data/", "logs/"], self.gs.list_directory("/"))
+        self.assertIsNone(self.gs.list_directory("/missing"))
+        self.assertEqual(["/logs/a", "/logs/b", "/logs/old/c"], list(self.gs.get_file_names("/logs")))
+        self.assertEqual("/logs/old", self.gs.get_file("/logs/old/c").namespace)
+
+        self.gs.clean_file_map("/logs/a")
+        self.assertEqual(["b", "old/"], self.gs.list_directory("/logs"))
+
+    def testPagedListing(self):
+        for i in range(10):
+            self.gs.add_file("/dir/{:02}".format(i))
+        self.gs.add_file("/dir/sub/x")
+
+        self.assertEqual(["00", "01", "02"], self.gs.list_directory("/dir", limit=3))
+        self.assertEqual(["03", "04", "05"], self.gs.list_directory("/dir", "02", 3))
+        self.assertEqual(["09", "sub/"], self.gs.list_directory("/dir", "08", 3))
+
+        # A listing resumes after its cursor, whatever was created or deleted in between
+        names = self.gs.get_file_names("/dir")
+        self.assertEqual(["/dir/00", "/dir/01"], [next(names), next(names)])
+        self.gs.clean_file_map("/dir/02")
+        self.gs.add_file("/dir/015")
+        self.assertEqual(["/dir/015", "/dir/03"], [next(names), next(names)])
+        self.assertEqual(["/dir/08", "/dir/09", "/dir/sub/x"], list(self.gs.get_file_names("/dir", "/dir/07")))
+        self.assertEqual(["/dir/sub/x"], list(self.gs.get_file_names(after="/dir/09")))
+        self.assertEqual(["/dir/sub/x"], [f.file_name for f in self.gs.get_files("/dir/sub")])
+
+    def testSnapshot(self):
+        for name in ["/data/a", "/data/b", "/other"]:
+            self.gs.add_file(name)
+        self.gs.add_file_chunk("/data/a", 1, ["x"])
+        self.gs.add_file_chunk("/data/a", 2, ["x"])
+        self.gs.add_file_chunk("/data/b", 3, ["y"])
+
+        self.assertEqual(["/snap/a", "/snap/b"], [f.file_name for f in self.gs.snapshot("/data", "/snap")])
+        self.assertEqual([1, 2], self.gs.get_chunk_handles("/snap/a"))
+        self.assertEqual([2, 2, 2], [self.gs.get_chunk(handle).references for handle in (1, 2, 3)])
+        self.assertEqual(["/one"], [f.file_name for f in self.gs.snapshot("/data/b", "/one")])
+        self.assertEqual(3, self.gs.get_chunk(3).references)
+
+        self.assertEqual([], self.gs.snapshot("/missing", "/new"))
+        self.assertEqual([], self.gs.snapshot("/data", "/other"))
+        self.assertEqual([], self.gs.snapshot("/data/a", "/snap"))
+        self.assertEqual([], self.gs.snapshot("/data/a", "/other/a"))
+
+        # The counts are rebuilt on load
+        gs = GlobalState.from_checkpoint(self.gs.checkpoint_view())
+        self.assertEqual([2, 2, 3], [gs.get_chunk(handle).references for handle in (1, 2, 3)])
+
+        # A chunk outlives the files which shared it until the last of them is removed
+        self.gs.clean_file_map("/data/b")
+        self.gs.clean_file_map("/one")
+        self.assertEqual(1, self.gs.get_chunk(3).references)
+        self.gs.clean_file_map("/snap/b")
+        self.assertNotIn(3, self.gs.chunk_map)
+        self.assertEqual(set(), self.gs.get_host_chunks("y"))
+
+    def testSplitChunk(self):
+        self.gs.add_file("a")
+        self.gs.add_file_chunk("a", 1, ["x"])
+        self.gs.add_file_chunk("a", 2, ["x", "y"])
+        self.gs.update_chunk_offset(2, 10)
+        self.gs.snapshot("a", "b")
+
+        self.assertEqual(0, self.gs.split_chunk("a", 1, 5, ["x"]))
+        self.assertEqual(1, self.gs.split_chunk("a", 2, 5, ["x"]))
+        self.assertEqual([1, 5], self.gs.get_chunk_handles("a"))
+        self.assertEqual([1, 2], self.gs.get_chunk_handles("b"))
+        self.assertEqual((10, 1, ["x"]), (self.gs.get_chunk(5).offset(), self.gs.get_chunk(5).references,
+                                          self.gs.get_chunk(5).chunkserver_locations))
+        self.assertEqual(1, self.gs.get_chunk(2).references)
+        self.assertEqual(set([1, 2, 5]), self.gs.get_host_chunks("x"))
+        self.assertEqual(0, self.gs.split_chunk("a", 2, 6, ["x"]))
+        self.assertEqual(5, self.gs.get_current_chunk)
+
+    def testConcurrentCreatesInDirectory(self):
+        # Creating a file only reads its directory, so other creates there go ahead while one is in progress
+        held = self.gs.file_locks.stripe("/dir/held")
+        names = [name for name in ("/dir/{}".format(i) for i in range(40))
+                 if self.gs.file_locks.stripe(name) is not held][:20]
+        with self.gs.locked_for_write("/dir/held"):
+            threads = [threading.Thread(target=self.gs.add_file, args=(name,)) for name in names]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(5)
+            self.assertEqual(20, len(self.gs.list_directory("/dir")))
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Tests for the master's lease table
+"""
+import unittest
+
+from src.lease import LeaseTable
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.table = LeaseTable(duration=60)
+
+    def tearDown(self):
+        pass
+
+    def testName(self):
+        pass
+
+    def test_grant(self):
+        lease, granted = self.table.grant(1, ["a", "b"], now=0)
+        self.assertTrue(granted)
+        self.assertEqual((1, "a", 60), (lease.chunk_handle, lease.primary, lease.expires))
+        self.assertEqual((lease, False), self.table.grant(1, ["a", "b"], now=30))
+        self.assertIs(lease, self.table.get(1, now=59))
+        self.assertIsNone(self.table.get(1, now=60))
+        self.assertEqual((None, False), self.table.grant(2, [], now=0))
+
+        # Primaries are spread over the chunkservers
+        self.assertEqual("b", self.table.grant(3, ["a", "b"], now=0)[0].primary)
+
+        # An expired lease is replaced
+        lease, granted = self.table.grant(1, ["b", "c"], now=61)
+        self.assertTrue(granted)
+        self.assertEqual("c", lease.primary)
+        self.assertEqual({"b": set([3]), "c": set([1])}, self.table.host_leases)
+
+    def test_renew(self):
+        self.table.grant(1, ["a"], now=0)
+        self.table.grant(2, ["a"], now=0)
+        self.table.grant(3, ["b"], now=0)
+        self.assertEqual([1], self.table.renew("a", [1, 3, 4], now=50))
+        self.assertEqual(110, self.table.get(1, now=50).expires)
+        self.assertEqual([], self.table.renew("a", [2], now=70))
+
+    def test_revoke(self):
+        self.table.grant(1, ["a", "b"], now=0)
+        self.table.grant(2, ["a"], now=0)
+        self.assertEqual(2, self.table.revoke_host("a"))
+        self.assertIsNone(self.table.get(1, now=1))
+        self.assertEqual([], self.table.renew("a", [1, 2], now=1))
+
+        # No other primary is granted the chunk until the revoked lease expires
+        self.assertTrue(self.table.outstanding(1, now=1))
+        self.assertEqual((None, False), self.table.grant(1, ["b"], now=1))
+        self.assertEqual("b", self.table.grant(1, ["b"], now=60)[0].primary)
+
+        self.table.revoke(2)
+        self.table.release(2)
+        self.assertFalse(self.table.outstanding(2, now=1))
+        self.assertTrue(self.table.grant(2, ["a"], now=1)[1])
+
+    def test_expire(self):
+        self.table.grant(1, ["a"], now=0)
+        self.table.grant(2, ["a"], now=30)
+        self.assertEqual(1, self.table.expire(now=60))
+        self.assertEqual([2], list(self.table.leases))
+        self.assertEqual({"a": set([2])}, self.table.host_leases)
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+Tests for the reader-writer and striped locks
+"""
+import threading
+import time
+import unittest
+
+from src.locks import RWLock, StripedLocks
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = RWLock()
+
+    def testName(self):
+        pass
+
+    def run_thread(self, target):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        t.join(0.1)
+        return t
+
+    def test_readers_share(self):
+        with self.lock.read():
+            t = self.run_thread(lambda: self.lock.read().__enter__())
+            self.assertFalse(t.is_alive())
+
+    def test_writer_excludes(self):
+        events = []
+
+        def write():
+            with self.lock.write():
+                events.append('write')
+
+        with self.lock.read():
+            t = self.run_thread(write)
+            self.assertTrue(t.is_alive())
+            events.append('read')
+        t.join()
+        self.assertEqual(['read', 'write'], events)
+
+        with self.lock.write():
+            t = self.run_thread(lambda: self.lock.read().__enter__())
+            self.assertTrue(t.is_alive())
+        t.join()
+
+    def test_waiting_writer_blocks_new_readers(self):
+        with self.lock.read():
+            writer = self.run_thread(lambda: self.lock.write().__enter__())
+            reader = self.run_thread(lambda: self.lock.read().__enter__())
+            self.assertTrue(writer.is_alive())
+            self.assertTrue(reader.is_alive())
+
+            # A thread already reading may read again without waiting for the writer
+            with self.lock.read():
+                pass
+
+    def test_reentrant(self):
+        with self.lock.write():
+            with self.lock.write():
+                with self.lock.read():
+                    pass
+        with self.lock.read():
+            self.assertRaises(RuntimeError, self.lock.acquire_write)
+
+        # The lock is free again
+        self.assertFalse(self.run_thread(lambda: self.lock.write().__enter__()).is_alive())
+
+    def test_striped(self):
+        stripes = StripedLocks(4)
+        self.assertIs(stripes.stripe(1), stripes.stripe(5))
+        self.assertIsNot(stripes.stripe(1), stripes.stripe(2))
+
+        with stripes.write(1, 5, 2):
+            # Keys on other stripes are not blocked
+            self.assertFalse(self.run_thread(lambda: stripes.write(3).__enter__()).is_alive())
+            t = self.run_thread(lambda: stripes.read(5).__enter__())
+            self.assertTrue(t.is_alive())
+        t.join()
+
+    def test_striped_no_deadlock(self):
+        stripes = StripedLocks(8)
+        counter = [0]
+
+        def work(keys):
+            for _ in range(200):
+                with stripes.write(*keys):
+                    counter[0] += 1
+
+        threads = [threading.Thread(target=work, args=(keys,)) for keys in [(1, 2, 3), (3, 2, 1), (2, 7), (7, 1)]]
+        for t in threads:
+            t.start()
+        start = time.time()
+        for t in threads:
+            t.join(10)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(800, counter[0])
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
\ No newline at end of file
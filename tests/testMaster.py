@@ -3,20 +3,499 @@ Created on Aug 13, 2014
 
 @author: erickdaniszewski
 """
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
+from src import config
+from src.chunkserver import Chunkserver
+from src.master import Master
+from src.oplog import OperationLog
+from src.snapshot import SnapshotError
+from src.message import Message
+
+
+class Replier(object):
+    """
+    A pooled connection which answers every call with the same reply
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = []
+
+    def call(self, *args):
+        self.calls.append(args)
+        return self.reply
+
 
 class Test(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.tmp = tempfile.mkdtemp()
+        self.metasnapshot = config.metasnapshot
+        config.metasnapshot = os.path.join(self.tmp, "meta.snapshot")
+        self.oplog = config.oplog
+        config.oplog = os.path.join(self.tmp, "OPLOG.log")
+
+        self.m = Message()
+        self.master = Master(run=True)
+        self.master.gs.active_hosts = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"]
+        self.called = []
+        self.master.call_chunkserver = lambda host, *args: self.called.append((host,) + args) or [self.m.SUCCESS]
 
     def tearDown(self):
-        pass
+        self.master.oplog.close()
+        config.metasnapshot = self.metasnapshot
+        config.oplog = self.oplog
+        shutil.rmtree(self.tmp)
 
     def testName(self):
         pass
 
+    def test_create_and_delete(self):
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.CREATE, ["f"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.CREATE, ["f"]))
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.DELETE, ["f"]))
+        self.assertIn("f", self.master.gs.to_delete)
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.UNDELETE, ["f"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.DELETE, ["missing"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.CREATE, []))
+
+    def test_append_and_read(self):
+        self.master.process(self.m.CREATE, ["f"])
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.READ, ["f", "0"]))
+
+        first = self.master.process(self.m.APPEND, ["f", str(config.chunk_size - 10)])
+        self.assertEqual([self.m.SUCCESS, "1", "0"], first[:3])
+        self.assertEqual(config.replica_amount, len(set(first[3:])))
+
+        # The second append does not fit in the first chunk, so the rest of the first chunk
+        # is padded and a new chunk is created
+        second = self.master.process(self.m.APPEND, ["f", "20"])
+        self.assertEqual([self.m.SUCCESS, "2", "0"], second[:3])
+
+        self.assertEqual([self.m.SUCCESS, "1", str(config.chunk_size)] + first[3:],
+                         self.master.process(self.m.READ, ["f", "0"]))
+        self.assertEqual([self.m.SUCCESS, "2", "20"] + second[3:], self.master.process(self.m.READ, ["f", "1"]))
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.READ, ["f", "2"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.READ, ["missing", "0"]))
+        self.assertEqual(4, len(self.master.gs.active_hosts))
+
+        # Every replica of the first chunk is padded, and a replica which cannot be is dropped
+        self.assertEqual(sorted((host, self.m.PAD, "1", str(config.chunk_size)) for host in first[3:]),
+                         sorted(self.called))
+        self.master.call_chunkserver = lambda host, *args: None if host == second[3] else [self.m.SUCCESS]
+        self.master.process(self.m.APPEND, ["f", str(config.chunk_size)])
+        self.assertEqual(sorted(second[4:]), sorted(self.master.get_chunk_locations(2)))
+
+    def test_append_at_reserved_offset(self):
+        chunkstore = config.chunkstore
+        config.chunkstore = os.path.join(self.tmp, "chunks") + os.sep
+        os.mkdir(config.chunkstore)
+        chunkserver = Chunkserver(run=True)
+        try:
+            self.master.call_chunkserver = lambda host, sysmsg, *args: chunkserver.process(sysmsg, list(args))
+            self.master.process(self.m.CREATE, ["f"])
+            records = ["hello", "abcd"]
+            replies = [self.master.process(self.m.APPEND, ["f", str(len(record))]) for record in records]
+
+            # The records are written at their reserved offsets, whatever order they arrive in
+            for reply, record in reversed(zip(replies, records)):
+                for host in reply[3:]:
+                    self.assertEqual([self.m.SUCCESS], chunkserver.process(self.m.WRITE, [reply[1], reply[2], record]))
+            for reply, record in zip(replies, records):
+                region = chunkserver.read_chunk(reply[1], int(reply[2]), len(record))
+                self.assertEqual(record, region.read())
+                region.close()
+
+            # Rolling over to a new chunk pads the replicas of the old one to the full chunk
+            self.assertEqual("2", self.master.process(self.m.APPEND, ["f", str(config.chunk_size - 5)])[1])
+            with open(config.chunkstore + "1", 'rb') as f:
+                self.assertEqual("helloabcd" + "\0" * (config.chunk_size - 9), f.read())
+        finally:
+            chunkserver.pool.close()
+            config.chunkstore = chunkstore
+
+    def test_concurrent_appends(self):
+        self.master.process(self.m.CREATE, ["log"])
+        record_size = 100
+        offsets = []
+
+        def produce():
+            for _ in range(30):
+                chunk, offset = self.master.append("log", record_size)
+                offsets.append((chunk.chunk_handle, offset))
+
+        threads = [threading.Thread(target=produce) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Every record has a region of its own, and no chunk overflows
+        self.assertEqual(240, len(set(offsets)))
+        per_chunk = config.chunk_size // record_size
+        chunk_handles = list(self.master.gs.get_chunk_handles("log"))
+        self.assertEqual(-(-240 // per_chunk), len(chunk_handles))
+        for chunk_handle in chunk_handles:
+            regions = sorted(offset for handle, offset in offsets if handle == chunk_handle)
+            self.assertEqual(range(0, len(regions) * record_size, record_size), regions)
+        for chunk_handle in chunk_handles[:-1]:
+            self.assertEqual(config.chunk_size, self.master.gs.get_chunk(chunk_handle).offset())
+
+        self.assertIsNone(self.master.append("log", config.chunk_size + 1))
+        self.assertIsNone(self.master.append("missing", 1))
+
+    def test_read_prefetch(self):
+        self.master.process(self.m.CREATE, ["f"])
+        for _ in range(3):
+            self.master.process(self.m.APPEND, ["f", str(config.chunk_size)])
+
+        reply = self.master.process(self.m.READ, ["f", "1", "8"])
+        self.assertEqual(self.m.SUCCESS, reply[0])
+        chunks = [self.master.unpack_args(bytearray(item)) for item in reply[1:]]
+        self.assertEqual([["2", str(config.chunk_size)], ["3", str(config.chunk_size)]],
+                         [chunk[:2] for chunk in chunks])
+        self.assertEqual(self.master.get_chunk_locations(2), chunks[0][2:])
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.READ, ["f", "3", "8"]))
+        self.assertEqual(1, len(self.master.process(self.m.READ, ["f", "0", "1"])) - 1)
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.READ, ["missing", "0", "8"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.READ, ["f"]))
+
+    def test_list(self):
+        for name in ["/d/a", "/d/b", "/d/c", "/d/e/f"]:
+            self.master.process(self.m.CREATE, [name])
+
+        self.assertEqual([self.m.SUCCESS, "b", "a", "b"], self.master.process(self.m.LIST, ["/d", "", "2"]))
+        self.assertEqual([self.m.SUCCESS, "e/", "c", "e/"], self.master.process(self.m.LIST, ["/d", "b", "2"]))
+        self.assertEqual([self.m.SUCCESS, ""], self.master.process(self.m.LIST, ["/d", "e/", "2"]))
+        self.assertEqual([self.m.SUCCESS, "", "/d/c", "/d/e/f"],
+                         self.master.process(self.m.LIST, ["/d", "/d/b", "3", "1"]))
+        self.assertEqual([self.m.SUCCESS, "", "a", "b", "c", "e/"], self.master.process(self.m.LIST, ["/d"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.LIST, ["/missing"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.LIST, ["/d", "", "x"]))
+
+        # A page is never larger than config.list_page_max
+        saved = config.list_page_max
+        config.list_page_max = 1
+        try:
+            self.assertEqual([self.m.SUCCESS, "a", "a"], self.master.process(self.m.LIST, ["/d", "", "100"]))
+        finally:
+            config.list_page_max = saved
+
+    def test_batch(self):
+        self.master.process(self.m.CREATE, ["existing"])
+        self.master.process(self.m.APPEND, ["existing", "10"])
+
+        requests = [[chr(self.m.CREATE), "a"], [chr(self.m.CREATE), "existing"], [chr(self.m.LOOKUP), "existing"],
+                    [chr(self.m.LOOKUP), "a"], [chr(self.m.DELETE), "a"], [chr(self.m.READ), "a"],
+                    [chr(self.m.UNDELETE), "a"], [chr(self.m.LOOKUP), "missing"]]
+        reply = self.master.process(self.m.BATCH, [self.master.pack_args(request) for request in requests])
+
+        self.assertEqual(self.m.SUCCESS, reply[0])
+        replies = [self.master.unpack_args(bytearray(item)) for item in reply[1:]]
+        self.assertEqual([[chr(self.m.SUCCESS)], [chr(self.m.FAILURE)], [chr(self.m.SUCCESS), "1"],
+                          [chr(self.m.SUCCESS)], [chr(self.m.SUCCESS)], [chr(self.m.FAILURE)],
+                          [chr(self.m.SUCCESS)], [chr(self.m.FAILURE)]], replies)
+        self.assertEqual(set(), self.master.gs.to_delete)
+
+    def test_restore_state_replays_oplog(self):
+        self.master.process(self.m.CREATE, ["f"])
+        self.master.process(self.m.CREATE, ["g"])
+        first = self.master.process(self.m.APPEND, ["f", str(config.chunk_size - 10)])
+        self.master.process(self.m.APPEND, ["f", "20"])
+        self.master.process(self.m.DELETE, ["g"])
+        self.master.process(self.m.BATCH, [self.master.pack_args([chr(self.m.CREATE), "h"]),
+                                           self.master.pack_args([chr(self.m.DELETE), "missing"])])
+        self.master.oplog.close()
+
+        restored = Master(run=True)
+        restored.restore_state()
+        try:
+            self.assertEqual(set(["f", "g", "h"]), set(restored.gs.get_file_names()))
+            self.assertEqual(set(["g"]), restored.gs.to_delete)
+            self.assertEqual([1, 2], list(restored.gs.get_chunk_handles("f")))
+            self.assertEqual(first[3:], restored.gs.get_chunk(1).chunkserver_locations)
+            self.assertEqual(config.chunk_size, restored.gs.get_chunk(1).offset())
+            self.assertEqual(20, restored.gs.get_chunk(2).offset())
+            # Handles are leased in ranges, and the rest of the leased range is never reused
+            self.assertEqual(config.chunk_handle_range + 1, restored.gs.get_next_chunk)
+        finally:
+            restored.oplog.close()
+
+    def test_checkpoint(self):
+        retain = config.checkpoint_retain
+        config.checkpoint_retain = 2
+        try:
+            self.master.process(self.m.CREATE, ["f"])
+            self.master.process(self.m.APPEND, ["f", "10"])
+            for _ in range(3):
+                checkpoint = self.master.global_state_snapshot()
+            self.assertEqual(2, len(self.master.list_snapshots()))
+            self.assertEqual(self.master.list_snapshots()[-1], checkpoint['path'])
+            self.assertEqual(os.path.getsize(checkpoint['path']), checkpoint['size'])
+            self.assertEqual(4, checkpoint['sequence'])
+
+            # The records covered by the checkpoint are cut from the log
+            self.assertEqual([], list(OperationLog.replay(config.oplog)))
+
+            self.master.process(self.m.CREATE, ["g"])
+            self.master.process(self.m.APPEND, ["f", "20"])
+            self.master.oplog.close()
+            self.assertEqual(2, len(list(OperationLog.replay(config.oplog))))
+        finally:
+            config.checkpoint_retain = retain
+
+        restored = Master(run=True)
+        restored.restore_state()
+        try:
+            self.assertEqual(set(["f", "g"]), set(restored.gs.get_file_names()))
+            self.assertEqual(30, restored.gs.get_chunk(1).offset())
+            self.assertEqual(6, restored.oplog.sequence)
+        finally:
+            restored.oplog.close()
+
+    @staticmethod
+    def corrupt(path):
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(chr(ord(byte) ^ 0xFF))
+
+    def test_checkpoint_fallback(self):
+        retain = config.checkpoint_retain
+        config.checkpoint_retain = 2
+        try:
+            self.master.process(self.m.CREATE, ["f"])
+            self.master.global_state_snapshot()
+            self.master.process(self.m.APPEND, ["f", "10"])
+            self.master.process(self.m.CREATE, ["g"])
+            self.master.global_state_snapshot()
+            self.master.process(self.m.CREATE, ["h"])
+            self.master.oplog.close()
+        finally:
+            config.checkpoint_retain = retain
+
+        # The log reaches back to the oldest snapshot, so a corrupt newest snapshot is passed over
+        oldest, newest = self.master.list_snapshots()
+        self.corrupt(newest)
+        restored = Master(run=True)
+        try:
+            restored.restore_state()
+            self.assertEqual(set(["f", "g", "h"]), set(restored.gs.get_file_names()))
+            self.assertEqual(10, restored.gs.get_chunk(1).offset())
+        finally:
+            restored.oplog.close()
+
+        self.corrupt(oldest)
+        restored = Master(run=True)
+        try:
+            self.assertRaises(SnapshotError, restored.restore_state)
+        finally:
+            restored.oplog.close()
+
+    def test_lease(self):
+        sent = []
+        self.master.send_lease = lambda host, *args: sent.append((host,) + args) or (None if host == "10.0.0.1" else [])
+        self.master.process(self.m.CREATE, ["f"])
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.LEASE, ["missing"]))
+
+        reply = self.master.process(self.m.LEASE, ["f"])
+        self.assertEqual([self.m.SUCCESS, "1"], reply[:2])
+        primary, secondaries = reply[2], reply[4:]
+        locations = self.master.get_chunk_locations(1)
+        self.assertEqual(set(locations), set([primary] + secondaries))
+        self.assertLessEqual(float(reply[3]), config.lease_duration)
+
+        # A primary which cannot be told of its lease is passed over
+        if "10.0.0.1" in locations:
+            self.assertEqual("10.0.0.1", sent[0][0])
+            self.assertNotEqual("10.0.0.1", primary)
+        self.assertEqual(primary, sent[-1][0])
+        self.assertEqual(secondaries, list(sent[-1][3]))
+
+        # The lease is reused until the primary reports the chunk full, when the chunk's
+        # length is recorded and the next chunk is leased
+        count = len(sent)
+        self.assertEqual(reply[:3], self.master.process(self.m.LEASE, ["f"])[:3])
+        self.assertEqual(count, len(sent))
+        self.assertEqual([self.m.SUCCESS, "1", "-1"], self.master.process(self.m.READ, ["f", "0"])[:3])
+        self.assertEqual([self.m.SUCCESS, "2"], self.master.process(self.m.LEASE, ["f", "1", "1000"])[:2])
+        self.assertEqual(1000, self.master.gs.get_chunk(1).offset())
+        self.assertEqual([self.m.SUCCESS, "2"], self.master.process(self.m.LEASE, ["f", "1", "1000"])[:2])
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.LEASE, ["f", "1"]))
+
+        # Appends through the master are refused while the chunk is leased, and the chunk is left open
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.APPEND, ["f", "10"]))
+        self.assertEqual([2], self.master.gs.get_chunk_handles("f")[1:])
+        self.assertEqual(0, self.master.gs.get_chunk(2).offset())
+
+        self.assertEqual([self.m.SUCCESS, "1"], self.master.process(self.m.RENEW, [primary, "1", "900", "1", "7", "0", "1"]))
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.RENEW, ["10.0.0.9", "1", "2000", "1"]))
+        self.assertEqual(1000, self.master.gs.get_chunk(1).offset())
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.RENEW, [primary, "1"]))
+
+        # A revoked lease is released once the primary acknowledges it
+        self.assertTrue(self.master.revoke_lease(1))
+        self.assertEqual((primary, 1, 0), sent[-1])
+        self.assertEqual([self.m.SUCCESS, "1", "1000"], self.master.process(self.m.READ, ["f", "0"])[:3])
+
+    def test_renew_commits_once(self):
+        for name in ("f", "g", "h"):
+            self.master.process(self.m.CREATE, [name])
+            self.master.process(self.m.APPEND, [name, "10"])
+        host = self.master.get_chunk_locations(1)[0]
+        for chunk_handle in (2, 3):
+            self.master.gs.get_chunk(chunk_handle).chunkserver_locations = [host]
+
+        commits = []
+        commit = self.master.oplog.commit
+        self.master.oplog.commit = lambda sequence: commits.append(sequence) or commit(sequence)
+        self.master.process(self.m.RENEW, [host, "1", "100", "0", "2", "200", "0", "3", "300", "0", "9", "10", "0"])
+        self.assertEqual(1, len(commits))
+        self.assertEqual([100, 200, 300], [self.master.gs.get_chunk(i).offset() for i in (1, 2, 3)])
+
+        # The lengths survive a restart
+        self.master.oplog.close()
+        restored = Master(run=True)
+        restored.restore_state()
+        try:
+            self.assertEqual([100, 200, 300], [restored.gs.get_chunk(i).offset() for i in (1, 2, 3)])
+        finally:
+            restored.oplog.close()
+
+    def test_lease_lapse(self):
+        chunkstore = config.chunkstore
+        config.chunkstore = os.path.join(self.tmp, "chunks") + os.sep
+        os.mkdir(config.chunkstore)
+        chunkserver = Chunkserver(run=True)
+        try:
+            chunkserver.forward_write = lambda *args: True
+            chunkserver.call_master = lambda sysmsg, *args: self.master.process(sysmsg, list(args))
+            self.master.send_lease = lambda host, chunk_handle, duration, secondaries=(): chunkserver.process(
+                self.m.LEASE, [str(chunk_handle), "{:.3f}".format(duration)] + list(secondaries))[1:]
+            self.master.process(self.m.CREATE, ["f"])
+            reply = self.master.process(self.m.LEASE, ["f"])
+            chunk_handle, chunkserver.host = reply[1], reply[2]
+
+            chunkserver.process(self.m.APPEND, [chunk_handle, "abc"])
+            chunkserver.process(self.m.APPEND, [chunk_handle, "de"])
+            self.assertEqual("-1", self.master.process(self.m.READ, ["f", "0"])[2])
+            self.assertEqual([chunk_handle], chunkserver.renew_leases())
+            self.assertEqual(5, self.master.gs.get_chunk(1).offset())
+            chunkserver.process(self.m.APPEND, [chunk_handle, "fg"])
+
+            # Once the lease lapses, the primary reports the final length of the chunk
+            chunkserver.leases[chunk_handle] = (time.time() - 1, [])
+            self.master.leases.expire(time.time() + config.lease_duration + 1)
+            self.assertEqual([], chunkserver.renew_leases())
+            self.assertEqual(set(), chunkserver.lapsed)
+            length = int(self.master.process(self.m.READ, ["f", "0"])[2])
+            with open(config.chunkstore + chunk_handle, 'rb') as f:
+                self.assertEqual("abcdefg", f.read(length))
+
+            # A primary giving up its lease reports the length too
+            self.master.process(self.m.LEASE, ["f"])
+            chunkserver.process(self.m.APPEND, [chunk_handle, "h"])
+            self.assertTrue(self.master.revoke_lease(1))
+            self.assertEqual([self.m.SUCCESS, chunk_handle, "8"], self.master.process(self.m.READ, ["f", "0"])[:3])
+            self.master.oplog.close()
+
+            restored = Master(run=True)
+            restored.restore_state()
+            try:
+                self.assertEqual(8, restored.gs.get_chunk(1).offset())
+            finally:
+                restored.oplog.close()
+        finally:
+            chunkserver.pool.close()
+            config.chunkstore = chunkstore
+
+    def test_copy_chunk(self):
+        # Copies reuse pooled connections to the source rather than opening one each
+        conn = Replier([self.m.SUCCESS])
+        released = []
+        self.master.copy_pool.acquire = lambda host, port: conn
+        self.master.copy_pool.release = lambda c, healthy=True: released.append((c, healthy))
+        self.assertTrue(self.master.copy_chunk(5, "10.0.0.1", "10.0.0.2"))
+        self.assertTrue(self.master.copy_chunk(6, "10.0.0.1", "10.0.0.3"))
+        self.assertEqual([(self.m.REPLICATE, "5", "10.0.0.2"), (self.m.REPLICATE, "6", "10.0.0.3")], conn.calls)
+        self.assertEqual([(conn, True)] * 2, released)
+
+        conn.reply = [self.m.FAILURE]
+        self.assertFalse(self.master.copy_chunk(5, "10.0.0.1", "10.0.0.2"))
+
+    def test_unresponsive_chunkserver(self):
+        # A chunkserver which accepts a connection but never answers is given up on quickly
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        del self.master.call_chunkserver
+        connection = self.master.pool.connection
+        self.master.pool.connection = lambda host: connection(host, listener.getsockname()[1])
+        self.master.pool.timeout = 0.2
+        try:
+            start = time.time()
+            self.assertEqual(None, self.master.send_lease("127.0.0.1", 1, 0))
+            self.assertFalse(self.master.clone_chunk("127.0.0.1", 1, 2))
+            self.assertLess(time.time() - start, 2)
+        finally:
+            self.master.pool.close()
+            listener.close()
+
+    def test_snapshot(self):
+        sent, cloned = [], []
+        self.master.send_lease = lambda host, *args: sent.append((host,) + args) or []
+        self.master.process(self.m.CREATE, ["/d/f"])
+        self.master.process(self.m.APPEND, ["/d/f", "10"])
+        self.master.process(self.m.LEASE, ["/d/f"])
+        primary = sent[-1][0]
+        locations = list(self.master.get_chunk_locations(1))
+        self.master.clone_chunk = lambda host, *args: cloned.append((host,) + args) or host != locations[0]
+
+        # Only metadata is copied, and the lease on the shared chunk is revoked
+        self.assertEqual([self.m.SUCCESS], self.master.process(self.m.SNAPSHOT, ["/d", "/s"]))
+        self.assertEqual([1], self.master.gs.get_chunk_handles("/s/f"))
+        self.assertEqual(2, self.master.gs.get_chunk(1).references)
+        self.assertEqual((primary, 1, 0), sent[-1])
+        self.assertEqual([], cloned)
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.SNAPSHOT, ["/d", "/s"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.SNAPSHOT, ["/missing", "/t"]))
+
+        # The first append to either file splits the chunk, copying it on its chunkservers
+        reply = self.master.process(self.m.APPEND, ["/s/f", "5"])
+        self.assertEqual([self.m.SUCCESS, "2", "10"], reply[:3])
+        self.assertEqual(sorted((host, 1, 2) for host in locations), sorted(cloned))
+        self.assertEqual(sorted(locations[1:]), sorted(reply[3:]))
+        self.assertEqual([1], self.master.gs.get_chunk_handles("/d/f"))
+        self.assertEqual([1, 1], [self.master.gs.get_chunk(handle).references for handle in (1, 2)])
+        self.assertEqual([self.m.SUCCESS, "1", "10"], self.master.process(self.m.APPEND, ["/d/f", "5"])[:3])
+        self.assertEqual(len(locations), len(cloned))
+
+        # A chunk which cannot be copied anywhere is not appended to
+        self.master.process(self.m.SNAPSHOT, ["/d/f", "/t"])
+        self.master.clone_chunk = lambda *args: False
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.APPEND, ["/t", "5"]))
+        self.assertEqual([self.m.FAILURE], self.master.process(self.m.LEASE, ["/t"]))
+        self.assertEqual(15, self.master.gs.get_chunk(1).offset())
+        self.master.oplog.close()
+
+        restored = Master(run=True)
+        restored.restore_state()
+        try:
+            self.assertEqual([[1], [2], [1]], [restored.gs.get_chunk_handles(name) for name in ("/d/f", "/s/f", "/t")])
+            self.assertEqual([2, 1], [restored.gs.get_chunk(handle).references for handle in (1, 2)])
+            self.assertEqual(sorted(locations[1:]), sorted(restored.gs.get_chunk(2).chunkserver_locations))
+            self.assertEqual(15, restored.gs.get_chunk(2).offset())
+        finally:
+            restored.oplog.close()
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
-    unittest.main()
\ No newline at end of file
+    unittest.main()
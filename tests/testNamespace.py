@@ -0,0 +1,85 @@
+"""
+Tests for the namespace tree
+"""
+import unittest
+
+from src.namespace import Namespace, ancestors, components, parent
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.ns = Namespace()
+        for path in ["/a/b/c", "/a/b/d", "/a/e", "f"]:
+            self.assertTrue(self.ns.add(path, path.upper()))
+
+    def testName(self):
+        pass
+
+    def test_paths(self):
+        self.assertEqual(["a", "b", "c"], components("/a//b/c/"))
+        self.assertEqual(["/a", "/a/b"], ancestors("/a/b/c"))
+        self.assertEqual(["a"], ancestors("a/b"))
+        self.assertEqual([], ancestors("f"))
+        self.assertEqual("/a/b", parent("/a/b/c"))
+        self.assertEqual("", parent("f"))
+
+    def test_add_and_get(self):
+        self.assertEqual("/A/B/C", self.ns.get("/a/b/c"))
+        self.assertIsNone(self.ns.get("/a/b"))
+        self.assertIsNone(self.ns.get("/missing/c"))
+        self.assertIsNone(self.ns.get(""))
+
+        self.assertFalse(self.ns.add("/a/b/c", "again"))
+        self.assertFalse(self.ns.add("/a/b", "over a directory"))
+        self.assertFalse(self.ns.add("/a/b/c/g", "beneath a file"))
+        self.assertFalse(self.ns.add("/", "root"))
+        self.assertTrue(self.ns.is_directory("/a/b"))
+        self.assertFalse(self.ns.is_directory("/a/b/c"))
+
+    def test_list(self):
+        self.assertEqual(["a/", "f"], self.ns.list())
+        self.assertEqual(["b/", "e"], self.ns.list("/a"))
+        self.assertEqual(["c", "d"], self.ns.list("/a/b/"))
+        self.assertIsNone(self.ns.list("/a/e"))
+        self.assertIsNone(self.ns.list("/missing"))
+
+    def test_walk(self):
+        self.assertEqual([("b/c", "/A/B/C"), ("b/d", "/A/B/D"), ("e", "/A/E")], list(self.ns.walk("/a")))
+        self.assertEqual(["a/b/c", "a/b/d", "a/e", "f"], [path for path, _ in self.ns.walk()])
+        self.assertEqual([], list(self.ns.walk("/missing")))
+
+    def test_list_pages(self):
+        self.assertEqual(["a/"], self.ns.list(limit=1))
+        self.assertEqual(["f"], self.ns.list(after="a/", limit=1))
+        self.assertEqual([], self.ns.list(after="f"))
+        self.assertEqual(["e"], self.ns.list("/a", "b"))
+
+        # The index built by a listing follows later changes
+        self.ns.add("/a/c", "/A/C")
+        self.ns.add("/a/d/g", "/A/D/G")
+        self.ns.remove("/a/e")
+        self.assertEqual(["b/", "c", "d/"], self.ns.list("/a"))
+
+        # Each directory keeps its own index, which a new tree does not share
+        self.assertEqual(["b", "c", "d"], self.ns._directory(["a"]).index)
+        self.assertIsNone(self.ns._directory(["a", "d"]).index)
+        other = Namespace()
+        other.add("/a/z", "/A/Z")
+        self.assertEqual(["z"], other.list("/a"))
+
+    def test_walk_after(self):
+        self.assertEqual(["a/b/d", "a/e", "f"], [path for path, _ in self.ns.walk(after="a/b/c")])
+        self.assertEqual(["f"], [path for path, _ in self.ns.walk(after="a")])
+        self.assertEqual(["e"], [path for path, _ in self.ns.walk("/a", "b/d")])
+        self.assertEqual([], list(self.ns.walk(after="f")))
+
+    def test_remove(self):
+        self.assertEqual("/A/B/C", self.ns.remove("/a/b/c"))
+        self.assertIsNone(self.ns.remove("/a/b/c"))
+        self.assertIsNone(self.ns.remove("/a/b"))
+        self.assertEqual(["d"], self.ns.list("/a/b"))
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
\ No newline at end of file
@@ -3,20 +3,363 @@ Created on Aug 13, 2014
 
 @author: erickdaniszewski
 """
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
+from src import config
+from src.net import BaseServer, Connection, MasterServer, EventLoopEngine, ThreadedEngine, WorkerPool, FileRegion, \
+    coalesce
+
+
+class EchoServer(BaseServer):
+
+    def process(self, sysmsg, args):
+        return [sysmsg] + args
+
+
+class EchoMaster(MasterServer):
+
+    def __init__(self):
+        super(EchoMaster, self).__init__()
+        self._port = 0
+
+    def process(self, sysmsg, args):
+        if sysmsg == 20:
+            f = tempfile.TemporaryFile()
+            f.write(args[0])
+            f.flush()
+            return [1, FileRegion(f, int(args[1]), int(args[2]))]
+        return [sysmsg] + args
+
+
+class BlockingMaster(EchoMaster):
+
+    def __init__(self):
+        super(BlockingMaster, self).__init__()
+        self.release = threading.Event()
+        self.order = []
+
+    def process(self, sysmsg, args):
+        if sysmsg == 30:
+            self.release.wait()
+        self.order.append(sysmsg)
+        return super(BlockingMaster, self).process(sysmsg, args)
+
 
 class Test(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.server = EchoServer()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+
+        t = threading.Thread(target=self.accept_session)
+        t.daemon = True
+        t.start()
 
     def tearDown(self):
-        pass
+        self.listener.close()
+
+    def accept_session(self):
+        try:
+            sock, addr = self.listener.accept()
+        except socket.error:
+            return
+        self.server.serve_session(sock, addr)
 
     def testName(self):
         pass
 
+    def test_pack_args(self):
+        args = ["", "a", "abc" * 100]
+        self.assertEqual(args, self.server.unpack_args(bytearray(self.server.pack_args(args))))
+
+    def test_base_process(self):
+        server = BaseServer()
+        self.assertEqual([server._m.FAILURE], server.process(3, ["a"]))
+
+    def test_frame_parts(self):
+        large = "L" * BaseServer.COALESCE_SIZE
+        args = ["a", large, "b", "c"]
+        parts = self.server.frame_parts(3, args, 9)
+        self.assertEqual(3, len(parts))
+        self.assertIs(large, parts[1])
+
+        payload = self.server.pack_args(args)
+        self.assertEqual(self.server.header.pack(3, 0, 9, len(payload)) + payload, "".join(parts))
+
+    def test_coalesce(self):
+        f = tempfile.TemporaryFile()
+        region = FileRegion(f)
+        self.assertEqual(["abc", region, "de", "fghij", "k"],
+                         coalesce(["a", "bc", region, "d", "e", "fghij", "k"], 5))
+
+    def test_recv_fragmented_frame(self):
+        left, right = socket.socketpair()
+        try:
+            frame = self.server.header.pack(3, 0, 42, 9) + self.server.pack_args(["abcde"])
+            for byte in frame:
+                left.send(byte)
+            self.assertEqual((3, 0, 42, ["abcde"]), self.server.recv(right))
+            left.close()
+            self.assertIsNone(self.server.recv(right))
+        finally:
+            right.close()
+
+    def test_compression(self):
+        left, right = socket.socketpair()
+        try:
+            text = "the quick brown fox jumps over the lazy dog " * 1000
+            parts = self.server.frame_parts(3, ["1", text], 5, compress=True)
+            self.assertTrue(self.server.header.unpack_from("".join(parts))[1] & BaseServer.COMPRESSED)
+            self.assertLess(len("".join(parts)), len(text))
+
+            self.server.send(left, 3, ["1", text], 5, compress=True)
+            self.assertEqual((3, BaseServer.COMPRESSED, 5, ["1", text]), self.server.recv(right))
+
+            # Incompressible and small payloads are sent as they are
+            noise = os.urandom(2 ** 16)
+            self.server.send(left, 3, [noise], compress=True)
+            self.assertEqual((3, 0, 0, [noise]), self.server.recv(right))
+            self.server.send(left, 3, ["a" * 10], compress=True)
+            self.assertEqual((3, 0, 0, ["a" * 10]), self.server.recv(right))
+
+            # Regions of files are compressed a block at a time, unless they barely compress
+            large = text * 4
+            f = tempfile.TemporaryFile()
+            f.write(large + noise)
+            f.flush()
+            region = FileRegion(f, 0, len(large))
+            self.assertEqual(len(large) / FileRegion.BLOCK_SIZE + 1, len(list(region.blocks())))
+            self.server.send(left, 3, ["1", region], compress=True)
+            self.assertEqual((3, BaseServer.COMPRESSED, 0, ["1", large]), self.server.recv(right))
+            self.assertTrue(f.closed)
+
+            f = tempfile.TemporaryFile()
+            f.write(large + noise)
+            f.flush()
+            self.server.send(left, 3, [FileRegion(f, len(large), len(noise))], compress=True)
+            self.assertEqual((3, 0, 0, [noise]), self.server.recv(right))
+
+            # A compressed frame which expands past the limit is refused
+            max_frame_size = config.max_frame_size
+            config.max_frame_size = len(text)
+            try:
+                self.server.send(left, 3, ["1", text], compress=True)
+                self.assertRaises(RuntimeError, self.server.recv, right)
+            finally:
+                config.max_frame_size = max_frame_size
+        finally:
+            left.close()
+            right.close()
+
+    def test_negotiated_compression(self):
+        conn = Connection(*self.listener.getsockname())
+        try:
+            conn.negotiate()
+            self.assertTrue(conn.compress)
+            text = "abc" * 10000
+            self.assertEqual([3, text], conn.call(3, text))
+        finally:
+            conn.close()
+
+    def test_pipelined_session(self):
+        conn = Connection(*self.listener.getsockname())
+        try:
+            request_ids = [conn.submit(2, str(i), "x" * i) for i in range(10)]
+            # Collect the replies in the reverse order to which the requests were sent
+            for i, request_id in reversed(list(enumerate(request_ids))):
+                self.assertEqual([2, str(i), "x" * i], conn.result(request_id))
+            self.assertEqual([7, "file"], conn.call(7, "file"))
+            self.assertEqual([7], conn.call(7))
+        finally:
+            conn.close()
+
+    def test_event_loop_engine(self):
+        server = EchoMaster()
+        server.initialize_socket()
+        t = threading.Thread(target=EventLoopEngine(server).serve_forever)
+        t.daemon = True
+        t.start()
+
+        conns = [Connection(*server.sock.getsockname()) for _ in range(5)]
+        try:
+            large = "y" * (2 ** 20)
+            request_ids = [(conn, conn.submit(3, large), conn.submit(2, str(i))) for i, conn in enumerate(conns)]
+            for i, (conn, large_id, small_id) in enumerate(request_ids):
+                self.assertEqual([2, str(i)], conn.result(small_id))
+                self.assertEqual([3, large], conn.result(large_id))
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def test_event_loop_blocking_process(self):
+        # A request which blocks in process holds up neither the loop nor other connections
+        server = BlockingMaster()
+        server.initialize_socket()
+        engine = EventLoopEngine(server)
+        t = threading.Thread(target=engine.serve_forever)
+        t.daemon = True
+        t.start()
+
+        blocked, other = Connection(*server.sock.getsockname()), Connection(*server.sock.getsockname())
+        try:
+            blocked.negotiate()
+            first, second = blocked.submit(30, "a"), blocked.submit(2, "b")
+            self.assertEqual([2, "c"], other.call(2, "c"))
+            self.assertEqual([2], server.order)
+
+            # The requests of a connection are processed in the order they arrived
+            server.release.set()
+            self.assertEqual([2, "b"], blocked.result(second))
+            self.assertEqual([30, "a"], blocked.result(first))
+            self.assertEqual([2, 30, 2], server.order)
+            self.assertEqual(2, engine.stats()['connections'])
+        finally:
+            server.release.set()
+            blocked.close()
+            other.close()
+
+    def test_file_region(self):
+        left, right = socket.socketpair()
+        try:
+            f = tempfile.TemporaryFile()
+            f.write("0123456789" * 10000)
+            f.flush()
+            self.server.send(left, 1, ["a", FileRegion(f, 5, 70000), "b"], 7)
+            self.assertEqual((1, 0, 7, ["a", ("0123456789" * 10000)[5:70005], "b"]), self.server.recv(right))
+            self.assertTrue(f.closed)
+
+            f = tempfile.TemporaryFile()
+            f.write("0123456789")
+            f.flush()
+            self.server.send(left, 1, [FileRegion(f, 8, 100)])
+            self.assertEqual((1, 0, 0, ["89"]), self.server.recv(right))
+        finally:
+            left.close()
+            right.close()
+
+    def test_event_loop_file_region(self):
+        server = EchoMaster()
+        server.initialize_socket()
+        t = threading.Thread(target=EventLoopEngine(server).serve_forever)
+        t.daemon = True
+        t.start()
+
+        conn = Connection(*server.sock.getsockname())
+        try:
+            data = "z" * (2 ** 20) + "end"
+            self.assertEqual([1, data[10:]], conn.call(20, data, "10", "-1"))
+        finally:
+            conn.close()
+
+    def test_oversized_frame(self):
+        # A header claiming more than config.max_frame_size is refused before the payload arrives
+        header = self.server.header.pack(3, 0, 1, config.max_frame_size + 1)
+        left, right = socket.socketpair()
+        try:
+            left.sendall(header)
+            self.assertRaises(RuntimeError, self.server.recv, right)
+        finally:
+            left.close()
+            right.close()
+
+        server = EchoMaster()
+        server.initialize_socket()
+        t = threading.Thread(target=EventLoopEngine(server).serve_forever)
+        t.daemon = True
+        t.start()
+
+        sock = socket.create_connection(server.sock.getsockname(), timeout=5)
+        try:
+            sock.sendall(header + "x" * 100)
+            self.assertEqual("", sock.recv(1))
+        finally:
+            sock.close()
+
+    def start_threaded(self, worker_count):
+        saved = config.worker_count
+        config.worker_count = worker_count
+        try:
+            server = EchoMaster()
+            server.initialize_socket()
+            engine = ThreadedEngine(server)
+        finally:
+            config.worker_count = saved
+        t = threading.Thread(target=engine.serve_forever)
+        t.daemon = True
+        t.start()
+        return server, engine
+
+    def test_threaded_engine_idle_connections(self):
+        # Idle persistent connections hold no worker, so they cannot starve other clients
+        server, engine = self.start_threaded(2)
+        conns = [Connection(*server.sock.getsockname(), timeout=5) for _ in range(4)]
+        try:
+            for i, conn in enumerate(conns):
+                self.assertEqual([2, str(i)], conn.call(2, str(i)))
+            for i, conn in enumerate(conns):
+                self.assertEqual([3, str(i)], conn.call(3, str(i)))
+            self.assertEqual(0, engine.stats()['rejected'])
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def test_threaded_engine_silent_connections(self):
+        # A client which connects and sends nothing holds no worker
+        server, engine = self.start_threaded(1)
+        silent = socket.create_connection(server.sock.getsockname(), timeout=5)
+        conn = Connection(*server.sock.getsockname(), timeout=5)
+        try:
+            start = time.time()
+            self.assertEqual([2, "a"], conn.call(2, "a"))
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(0, engine.stats()['rejected'])
+        finally:
+            silent.close()
+            conn.close()
+
+    def test_threaded_engine_closes_idle_connections(self):
+        server, engine = self.start_threaded(1)
+        saved = config.server_idle_timeout
+        config.server_idle_timeout = 0
+        conn = Connection(*server.sock.getsockname(), timeout=5)
+        try:
+            self.assertEqual([2, "a"], conn.call(2, "a"))
+            deadline = time.time() + 5
+            while time.time() < deadline and conn.sock.recv(1) != "":
+                pass
+            self.assertEqual(0, engine.stats()['idle_connections'])
+        finally:
+            config.server_idle_timeout = saved
+            conn.close()
+
+    def test_worker_pool_rejects_when_full(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def target():
+            started.set()
+            release.wait()
+
+        pool = WorkerPool(target, 1, 1)
+        self.assertTrue(pool.submit())
+        started.wait(5)
+        self.assertTrue(pool.submit())
+        self.assertFalse(pool.submit())
+
+        stats = pool.stats()
+        self.assertEqual(1, stats['active_workers'])
+        self.assertEqual(1, stats['queue_depth'])
+        self.assertEqual(2, stats['accepted'])
+        self.assertEqual(1, stats['rejected'])
+        release.set()
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
-    unittest.main()
\ No newline at end of file
+    unittest.main()
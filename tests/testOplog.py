@@ -0,0 +1,129 @@
+"""
+Tests for the write-ahead operation log
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from src import oplog
+from src.oplog import OperationLog
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "OPLOG.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testName(self):
+        pass
+
+    def test_pack_record(self):
+        record = oplog.pack_record(oplog.ADD_CHUNK, ["f", "12", "", "10.0.0.1"])
+        self.assertEqual((oplog.ADD_CHUNK, ["f", "12", "", "10.0.0.1"]), oplog.unpack_record(record))
+        self.assertEqual((oplog.ADD_FILE, []), oplog.unpack_record(oplog.pack_record(oplog.ADD_FILE, [])))
+
+    def test_append_commit_replay(self):
+        log = OperationLog(self.path)
+        log.log(oplog.ADD_FILE, ["f"])
+        sequence = log.append(oplog.UPDATE_OFFSET, ["1", "20"])
+        log.commit(sequence)
+        log.commit(None)
+        log.close()
+
+        self.assertEqual([(oplog.ADD_FILE, ["f"]), (oplog.UPDATE_OFFSET, ["1", "20"])],
+                         list(OperationLog.replay(self.path)))
+        self.assertEqual([], list(OperationLog.replay(os.path.join(self.tmp, "missing"))))
+
+    def test_group_commit(self):
+        log = OperationLog(self.path, flush_interval=0.05)
+        threads = [threading.Thread(target=log.log, args=(oplog.ADD_FILE, [str(i)])) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        log.close()
+
+        records = list(OperationLog.replay(self.path))
+        self.assertEqual(set(str(i) for i in range(20)), set(args[0] for _, args in records))
+
+    def test_truncated_tail(self):
+        log = OperationLog(self.path)
+        log.log(oplog.ADD_FILE, ["f"])
+        log.log(oplog.ADD_FILE, ["g"])
+        log.close()
+
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 1)
+
+        self.assertEqual([(oplog.ADD_FILE, ["f"])], list(OperationLog.replay(self.path)))
+        self.assertLess(os.path.getsize(self.path), size - 1)
+
+        # Records appended after the truncation are read back
+        log = OperationLog(self.path)
+        log.log(oplog.ADD_FILE, ["h"])
+        log.close()
+        self.assertEqual([(oplog.ADD_FILE, ["f"]), (oplog.ADD_FILE, ["h"])], list(OperationLog.replay(self.path)))
+
+    def test_truncate(self):
+        log = OperationLog(self.path)
+        for name in ["f", "g", "h"]:
+            log.log(oplog.ADD_FILE, [name])
+        log.truncate(2)
+        log.log(oplog.ADD_FILE, ["i"])
+        self.assertEqual(4, log.sequence)
+
+        # Only whole segments are cut, and h shares a segment with the records before it
+        self.assertEqual([(oplog.ADD_FILE, ["h"]), (oplog.ADD_FILE, ["i"])],
+                         list(OperationLog.replay(self.path, after=2)))
+        self.assertEqual(0, OperationLog.base(self.path))
+        log.truncate(3)
+        log.close()
+
+        self.assertEqual([(oplog.ADD_FILE, ["i"])], list(OperationLog.replay(self.path)))
+        self.assertEqual([(oplog.ADD_FILE, ["i"])], list(OperationLog.replay(self.path, after=3)))
+        self.assertEqual([4], [last for last, _ in OperationLog.segments(self.path)])
+
+        log = OperationLog(self.path)
+        self.assertEqual(4, log.sequence)
+        log.close()
+
+    def test_rotate(self):
+        log = OperationLog(self.path)
+        log.log(oplog.ADD_FILE, ["f"])
+        log.rotate()
+        log.rotate()
+        log.log(oplog.ADD_FILE, ["g"])
+        log.close()
+        self.assertEqual([1], [last for last, _ in OperationLog.segments(self.path)])
+        self.assertEqual([(oplog.ADD_FILE, ["f"]), (oplog.ADD_FILE, ["g"])], list(OperationLog.replay(self.path)))
+
+        # A crash after sealing a segment leaves no file to append to, and numbering carries on
+        os.remove(self.path)
+        log = OperationLog(self.path)
+        self.assertEqual(1, log.sequence)
+        log.log(oplog.ADD_FILE, ["h"])
+        log.close()
+        os.remove(self.path + ".1")
+        self.assertEqual(1, OperationLog.base(self.path))
+        self.assertEqual([(oplog.ADD_FILE, ["h"])], list(OperationLog.replay(self.path)))
+
+    def test_base(self):
+        self.assertEqual(0, OperationLog.base(self.path))
+        log = OperationLog(self.path)
+        log.log(oplog.ADD_FILE, ["f"])
+        self.assertEqual(0, OperationLog.base(self.path))
+        log.log(oplog.ADD_FILE, ["g"])
+        log.truncate(2)
+        log.close()
+        self.assertEqual(2, OperationLog.base(self.path))
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
\ No newline at end of file
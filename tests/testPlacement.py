@@ -0,0 +1,93 @@
+"""
+Tests for the replica placement engine
+"""
+import unittest
+from collections import Counter
+
+from src import config
+from src.placement import PlacementEngine
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.hosts = ["10.0.0.{}".format(i) for i in range(6)]
+        self.racks = dict((host, "rack{}".format(i % 3)) for i, host in enumerate(self.hosts))
+        self.engine = PlacementEngine(racks=self.racks)
+        self.engine.sync_hosts(self.hosts)
+
+    def testName(self):
+        pass
+
+    def test_spreads_over_racks(self):
+        for _ in range(50):
+            chosen = self.engine.choose(3)
+            self.assertEqual(3, len(set(chosen)))
+            self.assertEqual(3, len(set(self.racks[host] for host in chosen)))
+
+    def test_exclude(self):
+        chosen = self.engine.choose(2, exclude=["10.0.0.0"])
+        self.assertNotIn("10.0.0.0", chosen)
+        self.assertNotIn("rack0", [self.racks[host] for host in chosen])
+
+        # With fewer racks than replicas, racks are shared rather than replicas dropped
+        self.assertEqual(5, len(self.engine.choose(5, exclude=["10.0.0.0"])))
+        self.assertEqual(6, len(self.engine.choose(10)))
+
+    def test_balances_placements(self):
+        counts = Counter()
+        for _ in range(600):
+            counts.update(self.engine.choose(3))
+        self.assertEqual(6, len(counts))
+        self.assertLessEqual(max(counts.values()) - min(counts.values()), 2)
+
+    def test_new_host_is_not_a_hotspot(self):
+        for host in self.hosts:
+            self.engine.update_host(host, capacity=100 * config.chunk_size, used=60 * config.chunk_size)
+        self.engine.sync_hosts(self.hosts + ["10.0.0.9"])
+        self.engine.update_host("10.0.0.9", capacity=100 * config.chunk_size, used=0)
+
+        counts = Counter()
+        for _ in range(300):
+            counts.update(self.engine.choose(1))
+
+        # The empty host is favoured, but does not take every chunk
+        self.assertEqual(counts.most_common(1)[0][0], "10.0.0.9")
+        self.assertLess(counts["10.0.0.9"], 150)
+        self.assertEqual(7, len(counts))
+
+    def test_placements_spread_after_decay(self):
+        for _ in range(60):
+            self.engine.choose(1)
+
+        # Long after those placements, a new host joins, and the old hosts' placements have decayed
+        for load in self.engine.loads.values():
+            load.updated -= 20 * config.placement_half_life
+        self.engine.rescored -= 20 * config.placement_half_life
+        self.engine.sync_hosts(self.hosts + ["10.0.0.9"])
+
+        # Every host takes a turn, rather than the new host taking a run of placements
+        counts = Counter()
+        for _ in range(14):
+            counts.update(self.engine.choose(1))
+        self.assertEqual(7, len(counts))
+        self.assertLessEqual(max(counts.values()), 3)
+
+    def test_load(self):
+        for host in self.hosts:
+            self.engine.update_host(host, capacity=100 * config.chunk_size, used=10 * config.chunk_size)
+        self.engine.update_host("10.0.0.1", inflight=1000)
+        self.engine.update_host("10.0.0.2", used=100 * config.chunk_size)
+        self.assertEqual(set(self.hosts) - set(["10.0.0.1", "10.0.0.2"]), set(self.engine.choose(4)))
+        self.assertNotIn("10.0.0.2", self.engine.choose(6))
+
+    def test_hosts_removed(self):
+        self.engine.sync_hosts(self.hosts[:2])
+        self.assertEqual(set(self.hosts[:2]), set(self.engine.choose(3)))
+        self.engine.remove_host(self.hosts[0])
+        self.assertEqual([self.hosts[1]], self.engine.choose(3))
+        self.assertLess(len(self.engine.heap), 4 * len(self.engine.loads) + 64)
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""
+Tests for the re-replication scheduler
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from src import config
+from src.master import Master
+from src.oplog import OperationLog
+from src.replication import TokenBucket
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(config, name)) for name in (
+            'metasnapshot', 'oplog', 'replication_max_inflight', 'replication_host_max_inflight',
+            'replication_bandwidth', 'replication_host_bandwidth'))
+        config.metasnapshot = os.path.join(self.tmp, "meta.snapshot")
+        config.oplog = os.path.join(self.tmp, "OPLOG.log")
+
+        self.master = Master(run=True)
+        self.master.gs.active_hosts = ["10.0.0.{}".format(i) for i in range(6)]
+        self.copies = []
+        self.master.copy_chunk = self.copy_chunk
+        self.scheduler = self.master.replication
+
+    def tearDown(self):
+        self.master.oplog.close()
+        for name, value in self.saved.items():
+            setattr(config, name, value)
+        shutil.rmtree(self.tmp)
+
+    def copy_chunk(self, chunk_handle, source, target):
+        self.copies.append((chunk_handle, source, target))
+        return True
+
+    def add_chunk(self, file_name, locations):
+        self.master.create_new_file(file_name)
+        chunk, _ = self.master.append(file_name, 1)
+        for host in list(chunk.chunkserver_locations):
+            self.master.remove_replica(chunk.chunk_handle, host)
+        for host in locations:
+            self.master.add_replica(chunk.chunk_handle, host)
+        return chunk.chunk_handle
+
+    def testName(self):
+        pass
+
+    def test_fewest_replicas_first(self):
+        config.replication_max_inflight = 1
+        two = self.add_chunk("two", ["10.0.0.0", "10.0.0.1"])
+        one = self.add_chunk("one", ["10.0.0.2"])
+        full = self.add_chunk("full", ["10.0.0.3", "10.0.0.4", "10.0.0.5"])
+
+        self.assertTrue(self.master.replicate_chunk(two))
+        self.assertTrue(self.master.replicate_chunk(one))
+        self.assertFalse(self.master.replicate_chunk(full))
+
+        self.assertEqual(1, self.scheduler.schedule())
+        self.assertEqual(one, self.copies[-1][0])
+        self.assertEqual("10.0.0.2", self.copies[-1][1])
+        self.assertEqual(2, self.master.number_of_replicas(one))
+
+        # Both chunks now have two replicas left, and they are copied in handle order
+        self.scheduler.schedule()
+        self.assertEqual(two, self.copies[-1][0])
+        while self.scheduler.schedule():
+            pass
+        self.assertEqual(config.replica_amount, self.master.number_of_replicas(one))
+        self.assertEqual(config.replica_amount, self.master.number_of_replicas(two))
+        self.assertEqual({'queued': 0, 'copying': 0, 'copied': 3, 'failed': 0}, self.scheduler.stats())
+
+    def test_blocking_chunks_are_boosted(self):
+        config.replication_max_inflight = 1
+        one = self.add_chunk("one", ["10.0.0.0"])
+        two = self.add_chunk("two", ["10.0.0.1", "10.0.0.2"])
+        blocking = self.add_chunk("blocking", ["10.0.0.3", "10.0.0.4"])
+        self.master.replicate_chunk(two)
+        self.master.replicate_chunk(one)
+
+        # A client reading a chunk boosts it ahead of chunks with as many replicas
+        self.master.read("blocking", 0)
+        self.scheduler.schedule()
+        self.assertEqual(one, self.copies[-1][0])
+        self.scheduler.schedule()
+        self.assertEqual(blocking, self.copies[-1][0])
+        self.scheduler.schedule()
+        self.assertEqual(one, self.copies[-1][0])
+        self.scheduler.schedule()
+        self.assertEqual(two, self.copies[-1][0])
+
+    def test_concurrency_limits(self):
+        config.replication_max_inflight = 3
+        config.replication_host_max_inflight = 1
+        for i in range(4):
+            self.master.replicate_chunk(self.add_chunk("a{}".format(i), ["10.0.0.0", "10.0.0.1"]))
+
+        # Each host takes part in one copy at a time, as the source or the target
+        jobs = []
+        self.scheduler.pool = type('Pool', (object,), {'submit': lambda pool, *job: jobs.append(job) or True})()
+        self.assertEqual(2, self.scheduler.schedule())
+        hosts = [host for _, source, target in jobs for host in (source, target)]
+        self.assertEqual(4, len(set(hosts)))
+        self.assertEqual(set(["10.0.0.0", "10.0.0.1"]), set(source for _, source, _ in jobs))
+        self.assertEqual(2, self.scheduler.stats()['queued'])
+        self.assertEqual(0, self.scheduler.schedule())
+
+        # The global limit holds back a copy even when hosts are free
+        config.replication_max_inflight = 1
+        self.scheduler.copy(*jobs[0])
+        self.assertEqual(0, self.scheduler.schedule())
+        config.replication_max_inflight = 3
+        self.assertEqual(1, self.scheduler.schedule())
+        self.assertEqual(2, len(self.scheduler.copying))
+
+    def test_bandwidth_limit(self):
+        self.scheduler.bandwidth = TokenBucket(100)
+        for i in range(3):
+            chunk_handle = self.add_chunk("f{}".format(i), ["10.0.0.{}".format(i)])
+            self.master.gs.update_chunk_offset(chunk_handle, 60)
+            self.master.replicate_chunk(chunk_handle)
+
+        # The second copy overdraws the bucket, which holds the third back
+        self.scheduler.pool = type('Pool', (object,), {'submit': lambda pool, *job: True})()
+        self.assertEqual(2, self.scheduler.schedule())
+        self.assertEqual(0, self.scheduler.schedule())
+
+        bucket = TokenBucket(100)
+        bucket.consume(150)
+        self.assertFalse(bucket.ready(bucket.updated + 0.4))
+        self.assertTrue(bucket.ready(bucket.updated + 0.2))
+        self.assertTrue(TokenBucket(None).ready(0))
+
+    def test_failed_copy_is_requeued(self):
+        chunk_handle = self.add_chunk("f", ["10.0.0.0", "10.0.0.1"])
+        self.master.copy_chunk = lambda *args: False
+        self.master.replicate_chunk(chunk_handle)
+        self.assertEqual(1, self.scheduler.schedule())
+        self.assertEqual({'queued': 1, 'copying': 0, 'copied': 0, 'failed': 1}, self.scheduler.stats())
+        self.assertEqual({}, self.scheduler.inflight)
+
+    def test_leased_chunk_is_deferred(self):
+        chunk_handle = self.add_chunk("f", ["10.0.0.0", "10.0.0.1"])
+        self.master.leases.grant(chunk_handle, ["10.0.0.0", "10.0.0.1"])
+        self.master.replicate_chunk(chunk_handle)
+        self.assertEqual(0, self.scheduler.schedule())
+        self.assertEqual({'queued': 1, 'copying': 0, 'copied': 0, 'failed': 0}, self.scheduler.stats())
+
+        # Once the lease is gone the chunk is copied, and no lease is granted while it is
+        self.master.leases.release(chunk_handle)
+        self.master.send_lease = lambda *args: []
+        leased = []
+        self.master.copy_chunk = lambda *args: leased.append(self.master.lease("f")) or True
+        self.assertEqual(1, self.scheduler.schedule())
+        self.assertEqual([None], leased)
+        self.assertFalse(self.master.leases.outstanding(chunk_handle))
+        self.assertIsNotNone(self.master.lease("f"))
+
+    def test_lose_host(self):
+        chunk_handles = [self.add_chunk("f{}".format(i), ["10.0.0.0", "10.0.0.{}".format(i + 1)])
+                         for i in range(4)]
+        self.add_chunk("other", ["10.0.0.4", "10.0.0.5"])
+        for chunk_handle in chunk_handles:
+            self.master.add_replica(chunk_handle, "10.0.0.5")
+
+        self.assertEqual(4, self.master.lose_host("10.0.0.0"))
+        self.assertEqual(set(), self.master.gs.get_host_chunks("10.0.0.0"))
+        self.assertEqual(4, self.scheduler.stats()['queued'])
+
+        while self.scheduler.schedule():
+            pass
+        self.assertNotIn("10.0.0.0", [target for _, _, target in self.copies])
+        for chunk_handle in chunk_handles:
+            self.assertEqual(config.replica_amount, self.master.number_of_replicas(chunk_handle))
+
+        # The new locations are logged, so they survive a restart
+        locations = dict((chunk_handle, self.master.get_chunk_locations(chunk_handle))
+                         for chunk_handle in chunk_handles)
+        self.master.oplog.close()
+        self.master = Master(run=True)
+        self.master.restore_state()
+        for chunk_handle in chunk_handles:
+            self.assertEqual(locations[chunk_handle], self.master.get_chunk_locations(chunk_handle))
+
+    def test_check_hosts(self):
+        self.master.heartbeat_listener = type('Listener', (object,), {})()
+        self.master.heartbeat_listener.hbdict = type('Beats', (object,), {
+            'get_entries': lambda beats: (set(["10.0.0.9"]), set(["10.0.0.1"]))})()
+        chunk_handle = self.add_chunk("f", ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+
+        self.assertEqual(["10.0.0.1"], self.master.check_hosts())
+        self.assertNotIn("10.0.0.1", self.master.gs.active_hosts)
+        self.assertIn("10.0.0.9", self.master.gs.active_hosts)
+        self.assertEqual(["10.0.0.2", "10.0.0.3"], self.master.get_chunk_locations(chunk_handle))
+        self.assertEqual([], self.master.check_hosts())
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
\ No newline at end of file
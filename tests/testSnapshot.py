@@ -0,0 +1,96 @@
+"""
+Tests for the binary snapshot format
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from src import snapshot
+from src.globalstate import GlobalState
+from src.snapshot import SnapshotError
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "meta.snapshot")
+
+        gs = GlobalState()
+        for name in ["a", "b", "empty"]:
+            gs.add_file(name)
+        gs.add_file_chunk("a", 1, ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        gs.add_file_chunk("a", 2, ["10.0.0.2", "10.0.0.4"])
+        gs.add_file_chunk("b", 7, [])
+        gs.update_chunk_offset(1, 1000)
+        gs.update_chunk_offset(2, 20)
+        gs.queue_delete("b")
+        self.view = gs.checkpoint_view()
+
+        with open(self.path, 'wb') as f:
+            snapshot.dump(f, 42, self.view)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testName(self):
+        pass
+
+    def test_round_trip(self):
+        sequence, gs = snapshot.load(self.path)
+        self.assertEqual(42, sequence)
+        self.assertEqual(7, gs.get_current_chunk)
+        self.assertEqual([1, 2], gs.get_chunk_handles("a"))
+        self.assertEqual([], gs.get_chunk_handles("empty"))
+        self.assertEqual(["10.0.0.1", "10.0.0.2", "10.0.0.3"], gs.get_chunk(1).chunkserver_locations)
+        self.assertEqual(["10.0.0.2", "10.0.0.4"], gs.get_chunk(2).chunkserver_locations)
+        self.assertEqual(1000, gs.get_chunk(1).offset())
+        self.assertEqual(set(["b"]), gs.to_delete)
+        self.assertEqual(sorted(self.view['chunks']), sorted(gs.checkpoint_view()['chunks']))
+
+    def test_long_files(self):
+        # Files of any length are packed in blocks, so only a bounded set of structs is cached
+        counts = [0, 255, 256, 257, 1000, 4099]
+        view = {'chunk_handle': 0, 'chunks': [], 'to_delete': [],
+                'files': [("f{}".format(count), range(count)) for count in counts]}
+        with open(self.path, 'wb') as f:
+            snapshot.dump(f, 1, view)
+        _, gs = snapshot.load(self.path)
+        for count in counts:
+            self.assertEqual(range(count), list(gs.get_chunk_handles("f{}".format(count))))
+        self.assertLessEqual(max(count for _, count in snapshot._arrays), snapshot._BLOCK)
+
+    def test_read_sequence(self):
+        self.assertEqual(42, snapshot.read_sequence(self.path))
+        with open(self.path, 'wb') as f:
+            f.write("DFS")
+        self.assertRaises(SnapshotError, snapshot.read_sequence, self.path)
+
+    def test_corrupt(self):
+        with open(self.path, 'r+b') as f:
+            f.seek(30)
+            byte = f.read(1)
+            f.seek(30)
+            f.write(chr(ord(byte) ^ 0xFF))
+        self.assertRaises(SnapshotError, snapshot.load, self.path)
+
+    def test_not_a_snapshot(self):
+        for contents in ["", "DFS", "pickle" * 10]:
+            with open(self.path, 'wb') as f:
+                f.write(contents)
+            self.assertRaises(SnapshotError, snapshot.load, self.path)
+
+    def test_unsupported_version(self):
+        version = snapshot.VERSION
+        snapshot.VERSION += 1
+        try:
+            with open(self.path, 'wb') as f:
+                snapshot.dump(f, 42, self.view)
+        finally:
+            snapshot.VERSION = version
+        self.assertRaises(SnapshotError, snapshot.load, self.path)
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
\ No newline at end of file